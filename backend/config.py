@@ -9,31 +9,24 @@ BASE_DIR = Path(__file__).parent.parent
 
 # 数据存储目录
 DATA_DIR = BASE_DIR / "data"
-DATA_DIR.mkdir(exist_ok=True)
 
 # 日志目录
 LOGS_DIR = DATA_DIR / "logs"
-LOGS_DIR.mkdir(exist_ok=True)
 
 # 对话记录目录
 CONVERSATIONS_DIR = DATA_DIR / "conversations"
-CONVERSATIONS_DIR.mkdir(exist_ok=True)
 
 # 会话历史目录
 SESSIONS_DIR = DATA_DIR / "sessions"
-SESSIONS_DIR.mkdir(exist_ok=True)
 
 # 分析报告目录
 REPORTS_DIR = DATA_DIR / "reports"
-REPORTS_DIR.mkdir(exist_ok=True)
 
 # 音频文件目录（本地临时存储）
 AUDIO_DIR = DATA_DIR / "audio"
-AUDIO_DIR.mkdir(exist_ok=True)
 
 # 导出文件目录
 EXPORTS_DIR = DATA_DIR / "exports"
-EXPORTS_DIR.mkdir(exist_ok=True)
 
 # 文件路径配置
 SETTINGS_FILE = DATA_DIR / "settings.json"
@@ -68,9 +61,29 @@ AUDIO_RETENTION_HOURS = 24  # 音频文件保留小时数
 AUTO_BACKUP_ENABLED = True
 BACKUP_INTERVAL_HOURS = 24
 BACKUP_DIR = DATA_DIR / "backups"
-BACKUP_DIR.mkdir(exist_ok=True)
 
-print(f"""
+# 需要创建的目录，导入模块时不再创建，由应用生命周期（backend.main）启动时调用 ensure_data_dirs
+DATA_DIRS = [
+    DATA_DIR,
+    LOGS_DIR,
+    CONVERSATIONS_DIR,
+    SESSIONS_DIR,
+    REPORTS_DIR,
+    AUDIO_DIR,
+    EXPORTS_DIR,
+    BACKUP_DIR,
+]
+
+
+def ensure_data_dirs() -> None:
+    """创建数据存储目录"""
+    for directory in DATA_DIRS:
+        directory.mkdir(parents=True, exist_ok=True)
+
+
+def print_storage_config() -> None:
+    """打印数据存储配置"""
+    print(f"""
 📁 数据存储配置
 ================
 数据目录: {DATA_DIR}
@@ -85,3 +98,7 @@ print(f"""
 OSS 存储: {'✅ 已启用' if OSS_ENABLED else '❌ 未启用'}
 """)
 
+
+if __name__ == "__main__":
+    ensure_data_dirs()
+    print_storage_config()
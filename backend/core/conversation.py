@@ -2,12 +2,18 @@
 对话历史管理模块
 实现三层缓存策略（L1/L2/L3）
 """
-from typing import List, Dict, Optional
-from dataclasses import dataclass, asdict
+from typing import List, Dict, Optional, Tuple
+from dataclasses import dataclass, field, asdict
 from datetime import datetime
+import asyncio
 from backend.utils.token import token_counter
+from backend.utils.logger import get_logger
 from backend.services.openai_service import openai_service
+from backend.services.llm_scheduler import LLMPriority
 from backend.core.role import Role
+from config.settings import settings
+
+logger = get_logger(__name__)
 
 
 @dataclass
@@ -17,6 +23,12 @@ class ConversationTurn:
     text: str
     timestamp: datetime
     tokens: int
+    rendered: str = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        """预先渲染上下文中使用的文本"""
+        role_name = "教师" if self.role == Role.TEACHER else "学生"
+        self.rendered = f"{role_name}: {self.text}"
     
     def to_dict(self) -> Dict:
         """转换为字典"""
@@ -36,6 +48,12 @@ class ConversationSummary:
     key_points: List[str]
     tokens: int
     timestamp: datetime
+    ai_generated: bool = False  # 是否由大模型生成（失败降级的简单摘要为 False）
+    rendered: str = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        """预先渲染上下文中使用的文本"""
+        self.rendered = f"[历史摘要]: {self.summary_text}"
     
     def to_dict(self) -> Dict:
         """转换为字典"""
@@ -55,7 +73,8 @@ class ConversationHistory:
         self,
         l1_size: int = 2,
         l2_size: int = 3,
-        compression_threshold: int = 3000
+        compression_threshold: int = 3000,
+        ai_summary: bool = False
     ):
         """
         初始化对话历史管理器
@@ -64,6 +83,7 @@ class ConversationHistory:
             l1_size: L1 缓存大小（完整保留的轮数）
             l2_size: L2 缓存大小（摘要保留的轮数）
             compression_threshold: 压缩阈值（token 数）
+            ai_summary: 是否在后台用大模型生成摘要替换简单摘要
         """
         self.l1_cache: List[ConversationTurn] = []  # 最近的完整对话
         self.l2_cache: List[ConversationSummary] = []  # 压缩的摘要
@@ -75,6 +95,19 @@ class ConversationHistory:
         
         self.total_tokens = 0
         self.total_turns = 0
+        
+        # 各层 token 数随增删增量维护；上下文按版本号缓存，历史变化时失效
+        self._l1_tokens = 0
+        self._l2_tokens = 0
+        self._version = 0
+        self._context_cache: Optional[Tuple[int, Optional[int], str]] = None
+        
+        # 后台压缩：先放入简单摘要，大模型摘要生成后再替换
+        self.ai_summary = ai_summary
+        self._compression_queue: Optional[asyncio.Queue] = None
+        self._compression_worker: Optional[asyncio.Task] = None
+        self._compression_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.ai_summaries = 0
     
     def add_turn(self, role: Role, text: str) -> None:
         """
@@ -95,20 +128,22 @@ class ConversationHistory:
         self.l1_cache.append(turn)
         self.total_tokens += tokens
         self.total_turns += 1
+        self._l1_tokens += tokens
+        self._version += 1
         
         # 检查是否需要压缩
         if self.total_tokens > self.compression_threshold:
             self._trigger_compression()
     
     def _trigger_compression(self) -> None:
-        """触发压缩（同步版本，实际应该异步）"""
+        """触发压缩：立即换成简单摘要，大模型摘要交给后台任务"""
         # 如果 L1 缓存超过限制，将旧的对话移到 L2
         while len(self.l1_cache) > self.l1_size:
             # 取出最旧的对话
             turns_to_compress = self.l1_cache[:self.l1_size]
-            self.l1_cache = self.l1_cache[self.l1_size:]
+            del self.l1_cache[:self.l1_size]
             
-            # 创建摘要（这里先用简单的文本拼接，后续会用大模型）
+            # 先用简单的文本拼接作为摘要，不阻塞调用方
             summary_text = self._create_simple_summary(turns_to_compress)
             summary_tokens = token_counter.count_text(summary_text)
             
@@ -121,10 +156,14 @@ class ConversationHistory:
             )
             
             self.l2_cache.append(summary)
+            self._schedule_ai_summary(summary, turns_to_compress)
             
             # 更新 token 计数
             original_tokens = sum(t.tokens for t in turns_to_compress)
             self.total_tokens = self.total_tokens - original_tokens + summary_tokens
+            self._l1_tokens -= original_tokens
+            self._l2_tokens += summary_tokens
+            self._version += 1
         
         # 如果 L2 缓存超过限制，将旧的摘要移到 L3
         while len(self.l2_cache) > self.l2_size:
@@ -139,6 +178,88 @@ class ConversationHistory:
                     })
             
             self.total_tokens -= old_summary.tokens
+            self._l2_tokens -= old_summary.tokens
+            self._version += 1
+    
+    def _schedule_ai_summary(self, placeholder: ConversationSummary, turns: List[ConversationTurn]) -> None:
+        """
+        将压缩任务放入后台队列
+        
+        Args:
+            placeholder: 已放入 L2 的简单摘要
+            turns: 被压缩的对话轮次
+        """
+        if not self.ai_summary:
+            return
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中（例如同步调用），保留简单摘要
+            return
+        
+        if self._compression_loop is not loop or self._compression_worker.done():
+            self._compression_loop = loop
+            self._compression_queue = asyncio.Queue()
+            self._compression_worker = loop.create_task(self._run_compression_worker())
+        
+        self._compression_queue.put_nowait((placeholder, turns))
+    
+    async def _run_compression_worker(self) -> None:
+        """后台压缩任务：生成大模型摘要并替换对应的简单摘要"""
+        queue = self._compression_queue
+        while True:
+            placeholder, turns = await queue.get()
+            try:
+                summary = await self.create_ai_summary(turns)
+                # 大模型不可用或调用失败时得到的仍是简单摘要，保留原来的即可
+                if summary.ai_generated:
+                    self._replace_summary(placeholder, summary)
+            except Exception as e:
+                logger.error(f"后台摘要生成失败: {e}")
+            finally:
+                queue.task_done()
+    
+    def _replace_summary(self, placeholder: ConversationSummary, summary: ConversationSummary) -> bool:
+        """
+        用大模型摘要替换简单摘要
+        
+        替换在同一事件循环步骤内完成，期间不会有其他协程读到中间状态。
+        
+        Args:
+            placeholder: 简单摘要
+            summary: 大模型摘要
+            
+        Returns:
+            是否替换成功（简单摘要已被移出 L2 或历史已清空时放弃）
+        """
+        for index, current in enumerate(self.l2_cache):
+            if current is placeholder:
+                self.l2_cache[index] = summary
+                self.total_tokens += summary.tokens - placeholder.tokens
+                self._l2_tokens += summary.tokens - placeholder.tokens
+                self._version += 1
+                self.ai_summaries += 1
+                return True
+        return False
+    
+    async def wait_for_compression(self) -> None:
+        """等待排队中的后台压缩任务全部完成"""
+        if self._compression_queue and self._compression_loop is asyncio.get_running_loop():
+            await self._compression_queue.join()
+    
+    async def stop_compression_worker(self) -> None:
+        """停止后台压缩任务"""
+        worker = self._compression_worker
+        if worker and not worker.done() and self._compression_loop is asyncio.get_running_loop():
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        self._compression_worker = None
+        self._compression_queue = None
+        self._compression_loop = None
     
     def _create_simple_summary(self, turns: List[ConversationTurn]) -> str:
         """
@@ -197,7 +318,8 @@ class ConversationHistory:
             summary_text = await openai_service.simple_chat(
                 prompt=conversation_text,
                 system_prompt=system_prompt,
-                temperature=0.3
+                temperature=0.3,
+                priority=LLMPriority.SUMMARY
             )
             
             return ConversationSummary(
@@ -205,7 +327,8 @@ class ConversationHistory:
                 summary_text=summary_text,
                 key_points=[],
                 tokens=token_counter.count_text(summary_text),
-                timestamp=datetime.now()
+                timestamp=datetime.now(),
+                ai_generated=True
             )
         except Exception as e:
             print(f"AI 摘要生成失败: {e}")
@@ -229,28 +352,39 @@ class ConversationHistory:
         Returns:
             上下文文本
         """
-        context_parts = []
-        current_tokens = 0
-        
-        # 首先添加 L1 缓存（最新的完整对话）
-        for turn in reversed(self.l1_cache):
-            if max_tokens and current_tokens + turn.tokens > max_tokens:
-                break
-            
-            role_name = "教师" if turn.role == Role.TEACHER else "学生"
-            context_parts.insert(0, f"{role_name}: {turn.text}")
-            current_tokens += turn.tokens
+        cached = self._context_cache
+        if cached and cached[0] == self._version and cached[1] == max_tokens:
+            return cached[2]
         
-        # 如果还有空间，添加 L2 缓存（摘要）
-        if not max_tokens or current_tokens < max_tokens:
-            for summary in reversed(self.l2_cache):
-                if max_tokens and current_tokens + summary.tokens > max_tokens:
+        if not max_tokens or self._l1_tokens + self._l2_tokens < max_tokens:
+            # 全部放得下，直接拼接预渲染的文本
+            context = "\n".join(
+                [summary.rendered for summary in self.l2_cache]
+                + [turn.rendered for turn in self.l1_cache]
+            )
+        else:
+            # 从最新的对话向前取，直到超出预算
+            turn_parts = []
+            current_tokens = 0
+            for turn in reversed(self.l1_cache):
+                if current_tokens + turn.tokens > max_tokens:
                     break
-                
-                context_parts.insert(0, f"[历史摘要]: {summary.summary_text}")
-                current_tokens += summary.tokens
+                turn_parts.append(turn.rendered)
+                current_tokens += turn.tokens
+            
+            # 如果还有空间，添加 L2 缓存（摘要）
+            summary_parts = []
+            if current_tokens < max_tokens:
+                for summary in reversed(self.l2_cache):
+                    if current_tokens + summary.tokens > max_tokens:
+                        break
+                    summary_parts.append(summary.rendered)
+                    current_tokens += summary.tokens
+            
+            context = "\n".join(summary_parts[::-1] + turn_parts[::-1])
         
-        return "\n".join(context_parts)
+        self._context_cache = (self._version, max_tokens, context)
+        return context
     
     def get_recent_questions(self, limit: int = 5) -> List[str]:
         """
@@ -280,6 +414,9 @@ class ConversationHistory:
         self.l3_index.clear()
         self.total_tokens = 0
         self.total_turns = 0
+        self._l1_tokens = 0
+        self._l2_tokens = 0
+        self._version += 1
     
     def get_stats(self) -> Dict:
         """
@@ -294,11 +431,13 @@ class ConversationHistory:
             "l1_size": len(self.l1_cache),
             "l2_size": len(self.l2_cache),
             "l3_size": len(self.l3_index),
-            "l1_tokens": sum(t.tokens for t in self.l1_cache),
-            "l2_tokens": sum(s.tokens for s in self.l2_cache)
+            "l1_tokens": self._l1_tokens,
+            "l2_tokens": self._l2_tokens,
+            "pending_summaries": self._compression_queue.qsize() if self._compression_queue else 0,
+            "ai_summaries": self.ai_summaries
         }
 
 
 # 全局实例
-conversation_history = ConversationHistory()
+conversation_history = ConversationHistory(ai_summary=settings.ai_summary_enabled)
 
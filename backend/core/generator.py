@@ -3,22 +3,41 @@
 基于大模型生成对学生提问的回复
 """
 from typing import Optional, Dict, List
+import hashlib
 from backend.services.openai_service import openai_service
 from backend.core.conversation import ConversationHistory
-from backend.core.role import Role
+from backend.core.role import Role, QUESTION_INDICATORS
+from backend.core.reply_cache import ReplyCache, reply_cache
+from backend.utils.tracing import mark_stage
+from config.settings import settings
 
 
 class ReplyGenerator:
     """回复生成器"""
     
-    def __init__(self, model: str = "qwen-plus"):
+    def __init__(
+        self,
+        model: str = "qwen-plus",
+        cache: Optional[ReplyCache] = None,
+        deadline: Optional[float] = None,
+        hedge: bool = False,
+        hedge_model: Optional[str] = None
+    ):
         """
         初始化回复生成器
         
         Args:
             model: 使用的模型名称
+            cache: 回复缓存，不指定时不缓存
+            deadline: 每次生成的时间预算（秒），不指定时不限制
+            hedge: 请求较慢时是否发起对冲请求
+            hedge_model: 对冲请求使用的模型，不指定时使用同一模型
         """
         self.model = model
+        self.cache = cache
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_model = hedge_model
         self.system_prompt = """你是一位授课助手，负责回答学生在课堂上的提问。
 
 要求：
@@ -33,6 +52,38 @@ class ReplyGenerator:
 - 如果不确定答案，诚实地说明
 - 鼓励学生独立思考"""
     
+    def context_fingerprint(
+        self,
+        context: Optional[str] = None,
+        conversation_history: Optional[ConversationHistory] = None
+    ) -> str:
+        """
+        计算上下文指纹
+        
+        同一教学片段（额外上下文、最新摘要和教师最近一句话相同）内的相同问题复用回复；
+        教师讲了新内容或摘要更新后指纹随之变化，
+        学生重复提问（只新增学生的发言）时指纹不变。
+        
+        Args:
+            context: 额外的上下文信息
+            conversation_history: 对话历史
+            
+        Returns:
+            指纹字符串
+        """
+        summary = ""
+        teacher_text = ""
+        if conversation_history:
+            if conversation_history.l2_cache:
+                summary = conversation_history.l2_cache[-1].summary_text
+            # "这个再讲一遍"之类的问题指代教师刚讲的内容
+            for turn in reversed(conversation_history.l1_cache):
+                if turn.role == Role.TEACHER:
+                    teacher_text = turn.text
+                    break
+        parts = [self.model, context or "", summary, teacher_text]
+        return hashlib.md5("\x00".join(parts).encode()).hexdigest()
+    
     async def generate(
         self,
         question: str,
@@ -55,6 +106,15 @@ class ReplyGenerator:
         if not openai_service:
             return "抱歉，AI 服务暂时不可用。"
         
+        # 重复提问直接返回缓存的回复
+        fingerprint = None
+        if self.cache:
+            fingerprint = self.context_fingerprint(context, conversation_history)
+            cached_reply = self.cache.get(question, fingerprint)
+            if cached_reply is not None:
+                mark_stage("reply_cache_hit")
+                return cached_reply
+        
         # 构建消息列表
         messages = [
             {"role": "system", "content": self.system_prompt}
@@ -81,15 +141,23 @@ class ReplyGenerator:
             "role": "user",
             "content": question
         })
+        mark_stage("context_built")
         
         try:
-            response = await openai_service.chat_completion(
+            response = await openai_service.chat_completion_hedged(
                 messages=messages,
                 model=self.model,
                 temperature=temperature,
-                max_tokens=300
+                max_tokens=300,
+                hedge_model=self.hedge_model,
+                budget=self.deadline,
+                hedge=self.hedge
             )
+            # 非流式请求在完整回复返回时才拿到第一个 token
+            mark_stage("llm_first_token")
             
+            if self.cache:
+                self.cache.set(question, response["content"], fingerprint)
             return response["content"]
         except Exception as e:
             print(f"回复生成失败: {e}")
@@ -118,6 +186,15 @@ class ReplyGenerator:
             yield "抱歉，AI 服务暂时不可用。"
             return
         
+        fingerprint = None
+        if self.cache:
+            fingerprint = self.context_fingerprint(context, conversation_history)
+            cached_reply = self.cache.get(question, fingerprint)
+            if cached_reply is not None:
+                mark_stage("reply_cache_hit")
+                yield cached_reply
+                return
+        
         # 构建消息列表（同上）
         messages = [
             {"role": "system", "content": self.system_prompt}
@@ -141,15 +218,23 @@ class ReplyGenerator:
             "role": "user",
             "content": question
         })
+        mark_stage("context_built")
         
         try:
+            chunks = []
             async for chunk in openai_service.chat_completion_stream(
                 messages=messages,
                 model=self.model,
                 temperature=temperature,
                 max_tokens=300
             ):
+                if not chunks:
+                    mark_stage("llm_first_token")
+                chunks.append(chunk)
                 yield chunk
+            
+            if self.cache:
+                self.cache.set(question, "".join(chunks), fingerprint)
         except Exception as e:
             print(f"流式回复生成失败: {e}")
             yield "抱歉，我暂时无法回答这个问题。"
@@ -181,8 +266,7 @@ class ReplyGenerator:
             return False
         
         # 包含问号或疑问词
-        question_indicators = ["?", "？", "吗", "呢", "如何", "怎么", "为什么", "什么", "哪", "是否"]
-        if any(indicator in text for indicator in question_indicators):
+        if any(indicator in text for indicator in QUESTION_INDICATORS):
             return True
         
         # 默认认为是有效的（可能是陈述式问题）
@@ -212,5 +296,10 @@ class ReplyGenerator:
 
 
 # 全局实例
-reply_generator = ReplyGenerator()
+reply_generator = ReplyGenerator(
+    cache=reply_cache if settings.reply_cache_enabled else None,
+    deadline=settings.reply_deadline_seconds,
+    hedge=settings.reply_hedge_enabled,
+    hedge_model=settings.reply_hedge_model
+)
 
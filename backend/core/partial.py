@@ -0,0 +1,128 @@
+"""
+中间识别结果处理模块
+在最终识别结果到达之前，根据趋于稳定的中间结果提前识别角色和生成回复
+"""
+import asyncio
+import re
+from difflib import SequenceMatcher
+from typing import List, Optional
+
+
+# 句末疑问标记，出现时认为一句话已经说完
+QUESTION_ENDINGS = ("?", "？", "吗", "呢")
+
+_PUNCTUATION = re.compile(r"[\s，。！？、,.!?；;：:]+")
+
+
+def normalize_transcript(text: str) -> str:
+    """
+    规范化转写文本，去除空白和标点
+    
+    Args:
+        text: 转写文本
+    
+    Returns:
+        规范化后的文本
+    """
+    return _PUNCTUATION.sub("", text).lower()
+
+
+class PartialTranscriptTracker:
+    """
+    中间结果稳定性检测
+    
+    连续多次中间结果不再变化，或以疑问标记结尾时，认为识别结果已稳定。
+    每句话只触发一次，直到最终结果到达后 reset。
+    """
+    
+    def __init__(self, stable_updates: int = 3, min_length: int = 4):
+        """
+        初始化检测器
+        
+        Args:
+            stable_updates: 判定稳定所需的连续相同中间结果次数
+            min_length: 参与判断的最短文本长度
+        """
+        self.stable_updates = stable_updates
+        self.min_length = min_length
+        self._history: List[str] = []
+        self.stable_text: Optional[str] = None
+    
+    def update(self, text: str) -> bool:
+        """
+        输入一次中间结果
+        
+        Args:
+            text: 中间识别文本
+        
+        Returns:
+            本次是否刚刚判定为稳定
+        """
+        if self.stable_text is not None:
+            return False
+        
+        text = text.strip()
+        self._history.append(text)
+        del self._history[:-self.stable_updates]
+        
+        if len(normalize_transcript(text)) < self.min_length:
+            return False
+        
+        unchanged = (
+            len(self._history) == self.stable_updates
+            and all(item == text for item in self._history)
+        )
+        if unchanged or text.endswith(QUESTION_ENDINGS):
+            self.stable_text = text
+            return True
+        return False
+    
+    def reset(self):
+        """最终结果到达后重置"""
+        self._history.clear()
+        self.stable_text = None
+
+
+class EarlyReply:
+    """根据稳定的中间结果提前启动的角色识别和回复生成任务"""
+    
+    def __init__(
+        self,
+        text: str,
+        role_task: asyncio.Task,
+        reply_task: Optional[asyncio.Task] = None
+    ):
+        """
+        初始化提前任务
+        
+        Args:
+            text: 触发提前处理的中间结果
+            role_task: 角色识别任务
+            reply_task: 回复生成任务（不是有效问题时为 None）
+        """
+        self.text = text
+        self.role_task = role_task
+        self.reply_task = reply_task
+    
+    def matches(self, final_text: str, threshold: float = 0.9) -> bool:
+        """
+        判断最终结果与提前处理的文本是否一致
+        
+        Args:
+            final_text: 最终识别文本
+            threshold: 相似度阈值
+        
+        Returns:
+            是否可以沿用提前处理的结果
+        """
+        early = normalize_transcript(self.text)
+        final = normalize_transcript(final_text)
+        if early == final:
+            return True
+        return SequenceMatcher(None, early, final).ratio() >= threshold
+    
+    def cancel(self):
+        """取消尚未完成的任务"""
+        self.role_task.cancel()
+        if self.reply_task:
+            self.reply_task.cancel()
@@ -0,0 +1,223 @@
+"""
+回复缓存模块
+学生重复提问时直接返回之前生成的回复，支持近似问题匹配
+"""
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Optional
+import numpy as np
+from backend.core.partial import normalize_transcript
+from config.settings import settings
+
+
+# MinHash 使用的梅森素数，保证 a * h + b 不超过 uint64
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+@dataclass
+class ReplyCacheEntry:
+    """回复缓存条目"""
+    question: str
+    reply: str
+    fingerprint: str
+    shingles: FrozenSet[str]
+    signature: np.ndarray
+    expire_time: float
+
+
+class ReplyCache:
+    """
+    回复缓存
+    
+    以规范化后的问题文本和上下文指纹作为键精确匹配；未命中时在同一上下文的
+    近期问题中用字符 n-gram 的 MinHash 签名查找近似问题，再用 Jaccard 相似度确认。
+    超过容量时淘汰最久未使用的条目，超过 TTL 的条目不再返回。
+    """
+    
+    def __init__(
+        self,
+        max_size: int = 256,
+        ttl: float = 3600,
+        similarity_threshold: float = 0.8,
+        ngram_size: int = 2,
+        num_perm: int = 64,
+        seed: int = 42
+    ):
+        """
+        初始化回复缓存
+        
+        Args:
+            max_size: 最大条目数
+            ttl: 过期时间（秒）
+            similarity_threshold: 近似问题的 Jaccard 相似度阈值
+            ngram_size: 字符 n-gram 长度
+            num_perm: MinHash 签名长度
+            seed: MinHash 随机种子
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.ngram_size = ngram_size
+        
+        rng = np.random.default_rng(seed)
+        self._hash_a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._hash_b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        
+        self._entries: "OrderedDict[str, ReplyCacheEntry]" = OrderedDict()
+        
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+    
+    def _shingles(self, normalized: str) -> FrozenSet[str]:
+        """
+        切分字符 n-gram
+        
+        Args:
+            normalized: 规范化后的文本
+            
+        Returns:
+            n-gram 集合
+        """
+        n = self.ngram_size
+        if len(normalized) <= n:
+            return frozenset([normalized])
+        return frozenset(normalized[i:i + n] for i in range(len(normalized) - n + 1))
+    
+    def _signature(self, shingles: FrozenSet[str]) -> np.ndarray:
+        """
+        计算 MinHash 签名
+        
+        Args:
+            shingles: n-gram 集合
+            
+        Returns:
+            签名向量
+        """
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles)
+        )
+        permuted = (self._hash_a[:, None] * hashes[None, :] + self._hash_b[:, None]) % _MERSENNE_PRIME
+        return permuted.min(axis=1)
+    
+    @staticmethod
+    def _key(normalized: str, fingerprint: str) -> str:
+        """生成精确匹配的缓存键"""
+        return f"{fingerprint}:{normalized}"
+    
+    def get(self, question: str, fingerprint: str = "") -> Optional[str]:
+        """
+        查找缓存的回复
+        
+        Args:
+            question: 学生的问题
+            fingerprint: 上下文指纹
+            
+        Returns:
+            缓存的回复，未命中返回 None
+        """
+        normalized = normalize_transcript(question)
+        now = time.time()
+        
+        # 精确匹配
+        key = self._key(normalized, fingerprint)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expire_time > now:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry.reply
+            del self._entries[key]
+        
+        # 近似匹配：同一上下文中 MinHash 估计相似度最高的问题
+        candidates: List[str] = []
+        signatures: List[np.ndarray] = []
+        for candidate_key, candidate in list(self._entries.items()):
+            if candidate.expire_time <= now:
+                del self._entries[candidate_key]
+            elif candidate.fingerprint == fingerprint:
+                candidates.append(candidate_key)
+                signatures.append(candidate.signature)
+        
+        if candidates:
+            shingles = self._shingles(normalized)
+            estimates = (np.stack(signatures) == self._signature(shingles)).mean(axis=1)
+            best = int(np.argmax(estimates))
+            if estimates[best] >= self.similarity_threshold:
+                best_key = candidates[best]
+                entry = self._entries[best_key]
+                jaccard = len(shingles & entry.shingles) / len(shingles | entry.shingles)
+                if jaccard >= self.similarity_threshold:
+                    self._entries.move_to_end(best_key)
+                    self.near_hits += 1
+                    return entry.reply
+        
+        self.misses += 1
+        return None
+    
+    def set(self, question: str, reply: str, fingerprint: str = "") -> None:
+        """
+        缓存回复
+        
+        Args:
+            question: 学生的问题
+            reply: 生成的回复
+            fingerprint: 上下文指纹
+        """
+        normalized = normalize_transcript(question)
+        if not normalized:
+            return
+        
+        shingles = self._shingles(normalized)
+        key = self._key(normalized, fingerprint)
+        self._entries[key] = ReplyCacheEntry(
+            question=question,
+            reply=reply,
+            fingerprint=fingerprint,
+            shingles=shingles,
+            signature=self._signature(shingles),
+            expire_time=time.time() + self.ttl
+        )
+        self._entries.move_to_end(key)
+        
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        """清空缓存"""
+        self._entries.clear()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+    
+    def get_stats(self) -> Dict:
+        """
+        获取缓存统计信息
+        
+        Returns:
+            统计信息字典
+        """
+        hits = self.exact_hits + self.near_hits
+        total_requests = hits + self.misses
+        
+        return {
+            "size": len(self._entries),
+            "hits": hits,
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total_requests if total_requests > 0 else 0,
+            "total_requests": total_requests
+        }
+
+
+# 全局实例
+reply_cache = ReplyCache(
+    max_size=settings.reply_cache_size,
+    ttl=settings.reply_cache_ttl,
+    similarity_threshold=settings.reply_cache_similarity
+)
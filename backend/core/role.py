@@ -2,11 +2,16 @@
 角色识别模块
 用于区分教师和学生的发言
 """
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 from enum import Enum
+import math
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from backend.services.openai_service import openai_service
+from backend.services.llm_scheduler import LLMPriority
 from backend.utils.audio import AudioProcessor
+from backend.utils.cache import cached
+from config.settings import settings
 
 
 class Role(str, Enum):
@@ -16,10 +21,141 @@ class Role(str, Enum):
     UNKNOWN = "unknown"
 
 
+# 疑问标记（回复生成模块也用于判断有效问题）
+QUESTION_INDICATORS = ["?", "？", "吗", "呢", "如何", "怎么", "为什么", "什么", "哪", "是否"]
+
+ROLE_SYSTEM_PROMPT = """你是一个角色识别助手。根据对话内容判断说话人是教师还是学生。
+
+判断规则：
+1. 教师通常：讲解知识、回答问题、引导讨论、布置任务
+2. 学生通常：提出问题、请求解释、表达困惑、回答教师提问
+
+请只回复 "teacher" 或 "student"，不要有其他内容。"""
+
+
+@cached(ttl=600)
+async def classify_role_by_llm(prompt: str) -> Role:
+    """
+    调用大模型判断角色，相同内容的结果缓存复用，同时到达的相同请求只调用一次
+    
+    Args:
+        prompt: 包含对话内容的提示词
+        
+    Returns:
+        识别的角色
+        
+    Raises:
+        Exception: 大模型调用失败（不缓存）
+    """
+    response = await openai_service.simple_chat(
+        prompt=prompt,
+        system_prompt=ROLE_SYSTEM_PROMPT,
+        temperature=0.3,
+        priority=LLMPriority.ROLE_ID
+    )
+    
+    response = response.strip().lower()
+    if "teacher" in response:
+        return Role.TEACHER
+    elif "student" in response:
+        return Role.STUDENT
+    else:
+        return Role.UNKNOWN
+
+
+class TextRoleClassifier:
+    """
+    本地文本角色分类器
+    
+    基于字符 n-gram 词表加权打分，能在微秒级判断明显的教师/学生发言，
+    置信度不足时返回 None，交由大模型判断。
+    """
+    
+    # 正权重倾向教师，负权重倾向学生
+    LEXICON: Dict[str, float] = {
+        # 教师：组织课堂、讲解、布置任务
+        "同学们": 2.5, "大家": 1.5, "我们来": 2.0, "今天我们": 2.5, "今天": 0.8,
+        "下面": 1.2, "首先": 1.2, "接下来": 1.5, "然后我们": 1.2, "注意": 1.2,
+        "记住": 1.5, "请看": 1.5, "看黑板": 2.5, "翻到": 2.0, "作业": 1.5,
+        "布置": 1.5, "讲一下": 1.2, "这节课": 2.0, "上节课": 1.5, "复习": 1.0,
+        "举个例子": 1.2, "也就是说": 1.0, "所以说": 0.8, "知识点": 1.2, "回答得": 1.5,
+        "很好": 1.0, "谁来": 2.0, "请你": 1.5, "哪位同学": 2.5, "定义": 0.8,
+        # 学生：提问、表达困惑、请求解释
+        "老师": -2.0, "请问": -2.0, "我想问": -2.5, "我不": -1.5, "不太明白": -2.5,
+        "不明白": -2.0, "不懂": -2.0, "没听懂": -2.5, "没听清": -2.0, "能不能": -1.2,
+        "可以再": -1.5, "再讲一遍": -2.5, "再解释": -2.0, "我觉得": -0.8, "我有个问题": -3.0,
+        "是不是": -0.8, "为什么": -1.0, "怎么": -0.8, "吗": -0.8, "？": -1.0, "?": -1.0,
+    }
+    
+    def __init__(self, threshold: float = 0.85):
+        """
+        初始化分类器
+        
+        Args:
+            threshold: 置信度阈值，低于该值时不做判断
+        """
+        self.threshold = threshold
+        self._ngram_sizes = sorted({len(k) for k in self.LEXICON})
+    
+    def score(self, text: str) -> float:
+        """
+        计算教师倾向得分
+        
+        Args:
+            text: 文本
+            
+        Returns:
+            得分，正数倾向教师，负数倾向学生
+        """
+        text = text.strip()
+        lexicon = self.LEXICON
+        score = 0.0
+        
+        for n in self._ngram_sizes:
+            for i in range(len(text) - n + 1):
+                weight = lexicon.get(text[i:i + n])
+                if weight:
+                    score += weight
+        
+        # 长篇讲解多为教师，简短疑问多为学生
+        if len(text) > 40:
+            score += 1.0
+        elif len(text) < 20 and any(indicator in text for indicator in QUESTION_INDICATORS):
+            score -= 0.5
+        
+        return score
+    
+    def classify(self, text: str) -> Tuple[Optional['Role'], float]:
+        """
+        判断角色
+        
+        Args:
+            text: 文本
+            
+        Returns:
+            (角色, 置信度)，置信度不足时角色为 None
+        """
+        p_teacher = 1 / (1 + math.exp(-self.score(text)))
+        if p_teacher >= 0.5:
+            role, confidence = Role.TEACHER, p_teacher
+        else:
+            role, confidence = Role.STUDENT, 1 - p_teacher
+        
+        if confidence < self.threshold:
+            return None, confidence
+        return role, confidence
+
+
 class VoiceFeature:
     """声纹特征（简化版）"""
     
-    def __init__(self, pitch: float, energy: float, speech_rate: float):
+    def __init__(
+        self,
+        pitch: float,
+        energy: float,
+        speech_rate: float,
+        embedding: Optional[np.ndarray] = None
+    ):
         """
         初始化声纹特征
         
@@ -27,10 +163,12 @@ class VoiceFeature:
             pitch: 音高
             energy: 能量
             speech_rate: 语速
+            embedding: 归一化的频谱嵌入向量（float32）
         """
         self.pitch = pitch
         self.energy = energy
         self.speech_rate = speech_rate
+        self.embedding = embedding
     
     def distance(self, other: 'VoiceFeature') -> float:
         """
@@ -40,8 +178,11 @@ class VoiceFeature:
             other: 另一个声纹特征
             
         Returns:
-            欧氏距离
+            双方都有嵌入向量时为余弦距离，否则为欧氏距离
         """
+        if self.embedding is not None and other.embedding is not None:
+            return float(1 - np.dot(self.embedding, other.embedding))
+        
         return np.sqrt(
             (self.pitch - other.pitch) ** 2 +
             (self.energy - other.energy) ** 2 +
@@ -49,22 +190,138 @@ class VoiceFeature:
         )
 
 
+class VoiceEmbedder:
+    """
+    分帧声纹嵌入提取器
+    
+    用步进视图分帧，一次性计算所有帧的对数梅尔能量，
+    取其均值和标准差作为定长的 float32 嵌入向量。
+    """
+    
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        frame_ms: int = 25,
+        hop_ms: int = 10,
+        n_fft: int = 512,
+        n_mels: int = 24
+    ):
+        """
+        初始化提取器
+        
+        Args:
+            sample_rate: 采样率
+            frame_ms: 帧长（毫秒）
+            hop_ms: 帧移（毫秒）
+            n_fft: FFT 点数
+            n_mels: 梅尔滤波器数量
+        """
+        self.sample_rate = sample_rate
+        self.frame_length = sample_rate * frame_ms // 1000
+        self.hop_length = sample_rate * hop_ms // 1000
+        self.n_fft = n_fft
+        self.n_mels = n_mels
+        self.dim = 2 * n_mels
+        
+        self.window = np.hanning(self.frame_length).astype(np.float32)
+        self.mel_filters = self._mel_filterbank()
+    
+    def _mel_filterbank(self) -> np.ndarray:
+        """构建三角梅尔滤波器组，形状为 (n_mels, n_fft // 2 + 1)"""
+        def hz_to_mel(hz):
+            return 2595 * np.log10(1 + hz / 700)
+        
+        def mel_to_hz(mel):
+            return 700 * (10 ** (mel / 2595) - 1)
+        
+        mel_points = np.linspace(hz_to_mel(0), hz_to_mel(self.sample_rate / 2), self.n_mels + 2)
+        bins = np.floor((self.n_fft + 1) * mel_to_hz(mel_points) / self.sample_rate).astype(int)
+        
+        filters = np.zeros((self.n_mels, self.n_fft // 2 + 1), dtype=np.float32)
+        for m in range(1, self.n_mels + 1):
+            left, center, right = bins[m - 1], bins[m], bins[m + 1]
+            if center > left:
+                filters[m - 1, left:center] = (np.arange(left, center) - left) / (center - left)
+            if right > center:
+                filters[m - 1, center:right] = (right - np.arange(center, right)) / (right - center)
+        
+        return filters
+    
+    def frame(self, audio_data: np.ndarray) -> np.ndarray:
+        """
+        分帧（步进视图，不复制数据）
+        
+        Args:
+            audio_data: int16 音频
+            
+        Returns:
+            形状为 (帧数, 帧长) 的视图
+        """
+        if len(audio_data) < self.frame_length:
+            audio_data = np.pad(audio_data, (0, self.frame_length - len(audio_data)))
+        return sliding_window_view(audio_data, self.frame_length)[::self.hop_length]
+    
+    def log_mel(self, frames: np.ndarray) -> np.ndarray:
+        """
+        计算每帧的对数梅尔能量
+        
+        Args:
+            frames: 分帧并归一化到 [-1, 1] 的 float32 音频
+            
+        Returns:
+            形状为 (帧数, n_mels) 的数组
+        """
+        power = np.abs(np.fft.rfft(frames * self.window, n=self.n_fft, axis=1)) ** 2
+        return np.log(power.astype(np.float32) @ self.mel_filters.T + 1e-10)
+    
+    def embed(self, frames: np.ndarray) -> np.ndarray:
+        """
+        计算定长嵌入向量（L2 归一化）
+        
+        Args:
+            frames: 分帧并归一化到 [-1, 1] 的 float32 音频
+            
+        Returns:
+            长度为 2 * n_mels 的 float32 向量
+        """
+        log_mel = self.log_mel(frames)
+        mean = log_mel.mean(axis=0)
+        # 去掉整体电平，只保留频谱形状
+        mean -= mean.mean()
+        embedding = np.concatenate((mean, log_mel.std(axis=0))).astype(np.float32)
+        
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding /= norm
+        return embedding
+
+
 class RoleIdentifier:
     """角色识别器"""
     
-    def __init__(self, similarity_threshold: float = 0.8):
+    def __init__(self, similarity_threshold: float = 0.8, fast_path_threshold: float = 0.85):
         """
         初始化角色识别器
         
         Args:
             similarity_threshold: 声纹相似度阈值
+            fast_path_threshold: 本地文本分类的置信度阈值
         """
         self.similarity_threshold = similarity_threshold
+        self.text_classifier = TextRoleClassifier(threshold=fast_path_threshold)
+        self.fast_path_count = 0
+        self.llm_count = 0
         self.role_features: Dict[Role, List[VoiceFeature]] = {
             Role.TEACHER: [],
             Role.STUDENT: []
         }
         self.audio_processor = AudioProcessor()
+        self.embedder = VoiceEmbedder()
+        
+        # 所有已注册嵌入的连续矩阵，用于一次性向量化匹配
+        self._roles = [Role.TEACHER, Role.STUDENT]
+        self._feature_matrix = np.zeros((0, self.embedder.dim), dtype=np.float32)
+        self._feature_labels = np.zeros(0, dtype=np.intp)
     
     async def identify_by_content(self, text: str, context: Optional[str] = None) -> Role:
         """
@@ -80,39 +337,19 @@ class RoleIdentifier:
         if not openai_service:
             return Role.UNKNOWN
         
-        system_prompt = """你是一个角色识别助手。根据对话内容判断说话人是教师还是学生。
-
-判断规则：
-1. 教师通常：讲解知识、回答问题、引导讨论、布置任务
-2. 学生通常：提出问题、请求解释、表达困惑、回答教师提问
-
-请只回复 "teacher" 或 "student"，不要有其他内容。"""
-        
         prompt = f"对话内容：{text}"
         if context:
             prompt = f"上下文：{context}\n\n当前对话：{text}"
         
         try:
-            response = await openai_service.simple_chat(
-                prompt=prompt,
-                system_prompt=system_prompt,
-                temperature=0.3
-            )
-            
-            response = response.strip().lower()
-            if "teacher" in response:
-                return Role.TEACHER
-            elif "student" in response:
-                return Role.STUDENT
-            else:
-                return Role.UNKNOWN
+            return await classify_role_by_llm(prompt)
         except Exception as e:
             print(f"角色识别错误: {e}")
             return Role.UNKNOWN
     
     def extract_voice_features(self, audio_data: np.ndarray) -> VoiceFeature:
         """
-        提取声纹特征（简化版）
+        提取声纹特征（逐帧统计 + 频谱嵌入）
         
         Args:
             audio_data: 音频数据
@@ -120,21 +357,21 @@ class RoleIdentifier:
         Returns:
             声纹特征
         """
-        # 简化的特征提取
-        # 实际应用中应该使用更复杂的算法（如 MFCC）
+        frames = self.embedder.frame(audio_data)
+        x = frames.astype(np.float32) / 32768.0
         
-        # 音高估算（基于零交叉率）
-        zero_crossings = np.sum(np.abs(np.diff(np.sign(audio_data)))) / 2
-        pitch = zero_crossings / len(audio_data) * 16000  # 归一化
+        # 音高估算（基于逐帧过零率）
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1])
+        pitch = float(zcr * self.embedder.sample_rate / 2)
         
         # 能量
         energy = self.audio_processor.calculate_rms(audio_data)
         
-        # 语速估算（基于能量变化）
-        energy_changes = np.sum(np.abs(np.diff(audio_data.astype(float))))
-        speech_rate = energy_changes / len(audio_data)
+        # 语速估算（基于相邻采样点的变化幅度）
+        speech_rate = float(np.mean(np.abs(np.diff(x, axis=1)))) * 32768.0
         
-        return VoiceFeature(pitch, energy, speech_rate)
+        return VoiceFeature(pitch, energy, speech_rate, self.embedder.embed(x))
     
     def identify_by_voice(self, audio_data: np.ndarray) -> Optional[Role]:
         """
@@ -149,29 +386,27 @@ class RoleIdentifier:
         if not audio_data.size:
             return None
         
+        if not len(self._feature_labels):
+            return None
+        
         feature = self.extract_voice_features(audio_data)
         
-        # 与已知角色特征比较
-        best_role = None
-        min_distance = float('inf')
+        # 与所有已知特征一次性比较，按角色求平均余弦距离
+        similarities = self._feature_matrix @ feature.embedding
+        counts = np.bincount(self._feature_labels, minlength=len(self._roles))
+        sums = np.bincount(self._feature_labels, weights=similarities, minlength=len(self._roles))
         
-        for role, features in self.role_features.items():
-            if not features:
-                continue
-            
-            # 计算与该角色所有特征的平均距离
-            distances = [feature.distance(f) for f in features]
-            avg_distance = np.mean(distances)
-            
-            if avg_distance < min_distance:
-                min_distance = avg_distance
-                best_role = role
+        distances = np.full(len(self._roles), np.inf)
+        known = counts > 0
+        distances[known] = 1 - sums[known] / counts[known]
+        
+        best = int(np.argmin(distances))
         
         # 如果距离太大，说明不匹配
-        if min_distance > (1 - self.similarity_threshold):
+        if distances[best] > (1 - self.similarity_threshold):
             return None
         
-        return best_role
+        return self._roles[best]
     
     async def identify(
         self,
@@ -180,7 +415,7 @@ class RoleIdentifier:
         context: Optional[str] = None
     ) -> Role:
         """
-        综合识别角色（声纹 + 内容）
+        综合识别角色（声纹 + 本地文本分类 + 大模型）
         
         Args:
             text: 语音转写文本
@@ -196,7 +431,14 @@ class RoleIdentifier:
             if voice_role:
                 return voice_role
         
-        # 声纹识别失败，使用内容识别
+        # 本地文本分类，明显的情况不调用大模型
+        text_role, _ = self.text_classifier.classify(text)
+        if text_role:
+            self.fast_path_count += 1
+            return text_role
+        
+        # 无法确定时使用大模型内容识别
+        self.llm_count += 1
         content_role = await self.identify_by_content(text, context)
         return content_role
     
@@ -217,6 +459,23 @@ class RoleIdentifier:
         # 限制特征数量，避免内存占用过大
         if len(self.role_features[role]) > 10:
             self.role_features[role].pop(0)
+        
+        self._rebuild_feature_matrix()
+    
+    def _rebuild_feature_matrix(self) -> None:
+        """将各角色的嵌入重建为连续矩阵"""
+        embeddings = []
+        labels = []
+        for index, role in enumerate(self._roles):
+            for feature in self.role_features[role]:
+                embeddings.append(feature.embedding)
+                labels.append(index)
+        
+        if embeddings:
+            self._feature_matrix = np.ascontiguousarray(np.stack(embeddings), dtype=np.float32)
+        else:
+            self._feature_matrix = np.zeros((0, self.embedder.dim), dtype=np.float32)
+        self._feature_labels = np.array(labels, dtype=np.intp)
     
     def clear_role_features(self, role: Optional[Role] = None) -> None:
         """
@@ -231,8 +490,10 @@ class RoleIdentifier:
             for r in Role:
                 if r != Role.UNKNOWN:
                     self.role_features[r] = []
+        
+        self._rebuild_feature_matrix()
 
 
 # 全局实例
-role_identifier = RoleIdentifier()
+role_identifier = RoleIdentifier(fast_path_threshold=settings.role_fast_path_threshold)
 
@@ -4,38 +4,123 @@ FastAPI 主应用
 """
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, List
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
 import asyncio
 import json
+import time
 from datetime import datetime
 
 from config.settings import settings
+from backend.config import ensure_data_dirs
 from backend.core.role import Role, role_identifier
 from backend.core.conversation import conversation_history
 from backend.core.generator import reply_generator
+from backend.core.reply_cache import reply_cache
+from backend.core.partial import PartialTranscriptTracker, EarlyReply
 from backend.core.exporter import ConversationExporter
 from backend.core.analyzer import ConversationAnalyzer, smart_reminder
 from backend.core.settings_manager import settings_manager
 from backend.core.session_history import session_history
-from backend.utils.audio import audio_processor
+from backend.utils.audio import audio_processor, StreamingVAD
 from backend.utils.logger import setup_logging, get_logger
-from backend.utils.middleware import RequestTracingMiddleware, ErrorHandlingMiddleware, RateLimitMiddleware
-from backend.utils.metrics import global_metrics, Timer
+from backend.utils.middleware import APIMiddleware
+from backend.utils.rate_limit import rate_limiter
+from backend.utils.metrics import global_metrics, Timer, OPENMETRICS_CONTENT_TYPE
 from backend.utils.cache import global_cache
-from backend.services.asr_service import DashScopeASR
+from backend.utils.startup import startup_warm_up
+from backend.utils.tracing import UtteranceTrace, current_trace, mark_stage, discard_stages, REPLY_STAGES
+from backend.utils.token import token_counter
+from backend.services.asr_service import DashScopeASR, ASRConnectionPool
+from backend.services.openai_service import openai_service
+from backend.services.llm_scheduler import LLMPriority, llm_context, llm_scheduler, current_llm_session
 
 # 配置日志
 setup_logging(
     level="INFO" if settings.debug else "WARNING",
-    structured=True
+    structured=True,
+    queued=settings.log_queue_enabled,
+    queue_size=settings.log_queue_size,
+    rate_limit=settings.log_rate_limit,
+    burst=settings.log_rate_limit_burst
 )
 
 logger = get_logger(__name__)
 
+
+def create_asr() -> DashScopeASR:
+    """按配置创建 ASR 实例"""
+    return DashScopeASR(
+        api_key=settings.dashscope_api_key or None,
+        frame_ms=settings.asr_frame_ms,
+        queue_size=settings.asr_send_queue_size,
+        replay_seconds=settings.asr_replay_seconds,
+        max_reconnect_attempts=settings.asr_max_reconnect_attempts
+    )
+
+
+# ASR 预热连接池
+asr_pool = ASRConnectionPool(
+    size=settings.asr_pool_size,
+    sample_rate=settings.audio_sample_rate,
+    max_idle_seconds=settings.asr_pool_max_idle_seconds,
+    factory=create_asr
+)
+
+# 推测生成统计：started 为提前开始生成的次数，wasted 为角色不是学生或最终结果变化而作废的次数，
+# early_* 为根据稳定的中间识别结果提前处理的次数；通过 count_speculation 计数，与 /metrics 保持一致
+speculation_stats = {
+    "started": 0,
+    "used": 0,
+    "wasted": 0,
+    "early_started": 0,
+    "early_used": 0,
+    "early_restarted": 0
+}
+
+
+def count_speculation(name: str) -> None:
+    """
+    推测生成计数，同时更新 /api/stats 和 /metrics 的计数器
+    
+    Args:
+        name: speculation_stats 中的计数名称
+    """
+    speculation_stats[name] += 1
+    global_metrics.increment(f"speculation.{name}")
+
+# 编码器和大模型客户端首次使用时才初始化，启动后在后台提前预热
+startup_warm_up.register("token_counter", token_counter.warm_up)
+if openai_service:
+    startup_warm_up.register("openai_client", openai_service.warm_up)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动和关闭后台任务"""
+    ensure_data_dirs()
+    if asr_pool.size > 0 and settings.dashscope_api_key:
+        await asr_pool.start()
+    if settings.startup_warm_up_enabled:
+        startup_warm_up.start()
+    global_cache.start_sweeper()
+    rate_limiter.start_sweeper()
+    
+    yield
+    
+    await startup_warm_up.stop()
+    await global_cache.stop_sweeper()
+    await rate_limiter.stop_sweeper()
+    rate_limiter.backend.close()
+    await asr_pool.close()
+    await conversation_history.stop_compression_worker()
+
+
 app = FastAPI(
     title="实时语音识别与智能回复系统",
     description="用于在线授课场景的 AI 助教系统",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
 # 配置 CORS
@@ -47,10 +132,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 添加中间件
-app.add_middleware(RequestTracingMiddleware)
-app.add_middleware(ErrorHandlingMiddleware)
-app.add_middleware(RateLimitMiddleware, max_requests=100, window_seconds=60)
+# 添加中间件（限流、错误处理、请求追踪合并为一层）
+app.add_middleware(
+    APIMiddleware,
+    max_requests=None,
+    limiter=rate_limiter if settings.rate_limit_enabled else None
+)
 
 
 class ConnectionManager:
@@ -63,11 +150,13 @@ class ConnectionManager:
         """接受连接"""
         await websocket.accept()
         self.active_connections.append(websocket)
+        global_metrics.set_gauge("ws.connections", len(self.active_connections))
     
     def disconnect(self, websocket: WebSocket):
         """断开连接"""
         if websocket in self.active_connections:
             self.active_connections.remove(websocket)
+        global_metrics.set_gauge("ws.connections", len(self.active_connections))
     
     async def send_message(self, message: Dict, websocket: WebSocket):
         """发送消息到指定客户端"""
@@ -85,6 +174,78 @@ class ConnectionManager:
 manager = ConnectionManager()
 
 
+# 音频帧协议：二进制帧为原始 16-bit little-endian PCM，控制消息仍走文本帧
+AUDIO_ENCODING = "pcm_s16le"
+SUPPORTED_SAMPLE_RATES = (8000, 16000)
+SUPPORTED_CHANNELS = (1, 2)
+
+
+def negotiate_audio_format(data: Dict) -> Dict:
+    """
+    根据客户端声明协商音频格式
+    
+    Args:
+        data: start_listening 消息，可携带 sample_rate / channels
+        
+    Returns:
+        协商后的音频格式
+        
+    Raises:
+        ValueError: 不支持的采样率或声道数
+    """
+    sample_rate = int(data.get("sample_rate", settings.audio_sample_rate))
+    channels = int(data.get("channels", settings.audio_channels))
+    
+    if sample_rate not in SUPPORTED_SAMPLE_RATES:
+        raise ValueError(f"不支持的采样率: {sample_rate}")
+    if channels not in SUPPORTED_CHANNELS:
+        raise ValueError(f"不支持的声道数: {channels}")
+    
+    return {
+        "encoding": AUDIO_ENCODING,
+        "sample_rate": sample_rate,
+        "channels": channels
+    }
+
+
+def create_vad(sample_rate: int) -> Optional[StreamingVAD]:
+    """按配置创建流式 VAD，未启用时返回 None"""
+    if not settings.vad_enabled:
+        return None
+    
+    return StreamingVAD(
+        sample_rate=sample_rate,
+        frame_ms=settings.vad_frame_ms,
+        energy_threshold=settings.vad_energy_threshold,
+        hangover_ms=settings.vad_hangover_ms,
+        preroll_ms=settings.vad_preroll_ms
+    )
+
+
+async def forward_audio(asr: DashScopeASR, vad: Optional[StreamingVAD], audio_bytes: bytes) -> int:
+    """
+    经 VAD 过滤后将音频转发给 ASR
+    
+    Args:
+        asr: ASR 会话
+        vad: 流式 VAD，为 None 时不过滤
+        audio_bytes: 单声道 PCM
+        
+    Returns:
+        实际发送的字节数（静音被跳过时为 0）
+    """
+    session = {"session": current_llm_session.get()}
+    global_metrics.increment("asr.ingest_bytes", len(audio_bytes), tags=session)
+    
+    if vad:
+        audio_bytes = vad.process(audio_bytes)
+    
+    if audio_bytes:
+        global_metrics.increment("asr.sent_bytes", len(audio_bytes), tags=session)
+        await asr.send_audio(audio_bytes)
+    return len(audio_bytes)
+
+
 @app.get("/")
 async def root():
     """根路径"""
@@ -112,10 +273,29 @@ async def get_stats():
             "conversation": conversation_history.get_stats(),
             "connections": len(manager.active_connections),
             "cache": global_cache.get_stats(),
-            "metrics": global_metrics.get_all_stats(window_seconds=300)
+            "reply_cache": reply_cache.get_stats(),
+            "asr_pool": asr_pool.get_stats(),
+            "speculation": speculation_stats,
+            "llm": openai_service.get_stats() if openai_service else None,
+            "llm_scheduler": llm_scheduler.get_stats(),
+            "startup": startup_warm_up.get_stats(),
+            "rate_limit": rate_limiter.get_stats(),
+            "metrics": global_metrics.get_all_stats(window_seconds=300),
+            "counters": global_metrics.get_counters(),
+            "gauges": global_metrics.get_gauges()
         }
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """OpenMetrics 格式的指标，供 Prometheus 抓取"""
+    from fastapi.responses import Response
+    return Response(
+        content=global_metrics.render_openmetrics(),
+        media_type=OPENMETRICS_CONTENT_TYPE
+    )
+
+
 @app.post("/api/conversation/clear")
 async def clear_conversation():
     """清空对话历史"""
@@ -123,6 +303,8 @@ async def clear_conversation():
         conversation_history.clear()
         role_identifier.clear_role_features()
         global_cache.clear()
+        # 上下文为空时各节课的上下文指纹相同，清空对话后不能再沿用缓存的回复
+        reply_cache.clear()
         logger.info("对话历史已清空")
         return {"message": "对话历史已清空"}
 
@@ -445,15 +627,16 @@ async def test_generate(question: str, context: str = None):
     with Timer(global_metrics, "api.generate.duration"):
         try:
             logger.info(f"测试生成回复: {question[:50]}...")
-            reply = await reply_generator.generate(
-                question=question,
-                context=context,
-                conversation_history=conversation_history
-            )
-            global_metrics.record("api.generate.success", 1)
+            with llm_context(priority=LLMPriority.DEBUG):
+                reply = await reply_generator.generate(
+                    question=question,
+                    context=context,
+                    conversation_history=conversation_history
+                )
+            global_metrics.increment("api.generate.success")
             return {"reply": reply}
         except Exception as e:
-            global_metrics.record("api.generate.error", 1)
+            global_metrics.increment("api.generate.error")
             logger.error(f"生成回复失败: {str(e)}", exc_info=True)
             raise HTTPException(status_code=500, detail=str(e))
 
@@ -465,6 +648,18 @@ async def websocket_audio_endpoint(websocket: WebSocket):
     接收音频数据和转写文本，返回识别结果和回复
     """
     asr = None  # ASR 服务实例
+    vad = None  # 流式 VAD，跳过静音
+    early_reply: Optional[EarlyReply] = None  # 根据中间结果提前启动的任务
+    trace: Optional[UtteranceTrace] = None  # 当前这句话的延迟追踪
+    audio_format = {
+        "encoding": AUDIO_ENCODING,
+        "sample_rate": settings.audio_sample_rate,
+        "channels": settings.audio_channels
+    }
+    
+    # 大模型请求按连接公平调度
+    session_id = f"ws-{id(websocket)}"
+    current_llm_session.set(session_id)
     
     try:
         await manager.connect(websocket)
@@ -472,30 +667,64 @@ async def websocket_audio_endpoint(websocket: WebSocket):
         
         await websocket.send_json({
             "type": "connected",
-            "message": "WebSocket 连接成功"
+            "message": "WebSocket 连接成功",
+            "audio_format": audio_format
         })
         
         logger.info("开始接收消息循环")
         
         while True:
             # 接收消息
-            logger.debug("等待接收消息...")
-            data = await websocket.receive_json()
-            logger.info(f"收到消息: {data}")
+            message = await websocket.receive()
+            received_at = time.perf_counter()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            
+            audio_bytes = message.get("bytes")
+            if audio_bytes is not None:
+                # 二进制帧：原始 PCM，直接转发给 ASR
+                frame_size = 2 * audio_format["channels"]
+                if len(audio_bytes) % frame_size:
+                    await websocket.send_json({
+                        "type": "error",
+                        "message": f"音频帧长度必须是 {frame_size} 字节的整数倍"
+                    })
+                    continue
+                
+                if asr and asr.is_active:
+                    if audio_format["channels"] > 1:
+                        audio_bytes = audio_processor.downmix_to_mono(
+                            audio_bytes, audio_format["channels"]
+                        )
+                    sent = await forward_audio(asr, vad, audio_bytes)
+                    if sent and trace is None:
+                        # 新的一句话从第一帧语音开始计时
+                        trace = UtteranceTrace(session_id, start=received_at)
+                        trace.mark("audio_received", received_at)
+                else:
+                    logger.warning("ASR 未连接，无法发送音频")
+                continue
+            
+            data = json.loads(message["text"])
             message_type = data.get("type")
+            # 只记录消息类型，音频消息包含大量采样点，不能整体格式化
+            logger.debug("收到消息: %s", message_type)
             
             if message_type == "transcript":
                 # 收到转写文本
                 await handle_transcript(websocket, data)
             
             elif message_type == "audio":
-                # 收到音频数据 - 转发给 ASR
-                if asr and asr.is_connected:
+                # 收到音频数据（旧版 JSON 整数数组协议）- 转发给 ASR
+                if asr and asr.is_active:
                     audio_data = data.get("data", [])
                     # 将数组转换为 bytes
                     import struct
                     audio_bytes = struct.pack(f'{len(audio_data)}h', *audio_data)
-                    await asr.send_audio(audio_bytes)
+                    sent = await forward_audio(asr, vad, audio_bytes)
+                    if sent and trace is None:
+                        trace = UtteranceTrace(session_id, start=received_at)
+                        trace.mark("audio_received", received_at)
                 else:
                     logger.warning("ASR 未连接，无法发送音频")
             
@@ -504,15 +733,30 @@ async def websocket_audio_endpoint(websocket: WebSocket):
                 logger.info("开始监听音频，启动 ASR 服务")
                 
                 try:
-                    # 创建 ASR 实例
-                    asr = DashScopeASR()
+                    # 协商音频格式
+                    audio_format = negotiate_audio_format(data)
+                    
+                    # 从连接池取出已预热的 ASR 会话
+                    asr = await asr_pool.acquire(sample_rate=audio_format["sample_rate"])
+                    vad = create_vad(audio_format["sample_rate"])
+                    tracker = PartialTranscriptTracker(stable_updates=settings.partial_stable_updates)
                     
                     # 设置回调
                     async def on_result(result):
+                        nonlocal early_reply, trace
                         text = result.get("text", "")
                         is_final = result.get("is_final", False)
+                        received_at = result.get("received_at") or time.perf_counter()
+                        
+                        # 回调在 ASR 接收任务中执行，需要重新设置所属会话
+                        current_llm_session.set(session_id)
                         
                         if text:
+                            if trace is None:
+                                trace = UtteranceTrace(session_id, start=received_at)
+                            trace.mark("asr_final" if is_final else "asr_partial", received_at)
+                            current_trace.set(trace)
+                            
                             # 发送识别结果到前端
                             await websocket.send_json({
                                 "type": "transcript",
@@ -523,10 +767,17 @@ async def websocket_audio_endpoint(websocket: WebSocket):
                             
                             # 如果是最终结果，处理转写文本
                             if is_final:
+                                early, early_reply = early_reply, None
+                                utterance, trace = trace, None
+                                tracker.reset()
                                 await handle_transcript(websocket, {
                                     "text": text,
                                     "is_final": True
-                                })
+                                }, early=early, trace=utterance)
+                            
+                            # 中间结果趋于稳定，提前识别角色和生成回复
+                            elif settings.early_reply_enabled and tracker.update(text):
+                                early_reply = start_early_reply(text)
                     
                     async def on_error(error):
                         logger.error(f"ASR 错误: {error}")
@@ -538,14 +789,11 @@ async def websocket_audio_endpoint(websocket: WebSocket):
                     asr.on_result = on_result
                     asr.on_error = on_error
                     
-                    # 连接并开始识别
-                    await asr.connect()
-                    await asr.start_recognition(sample_rate=16000)
-                    
                     await websocket.send_json({
                         "type": "status",
                         "status": "listening",
-                        "message": "ASR 服务已启动"
+                        "message": "ASR 服务已启动",
+                        "audio_format": audio_format
                     })
                     
                 except Exception as e:
@@ -559,6 +807,15 @@ async def websocket_audio_endpoint(websocket: WebSocket):
                 # 停止监听 - 停止 ASR
                 logger.info("停止监听音频，关闭 ASR 服务")
                 
+                if vad:
+                    global_metrics.record("vad.sent_ratio", vad.get_stats()["sent_ratio"])
+                    vad = None
+                
+                if early_reply:
+                    early_reply.cancel()
+                    early_reply = None
+                trace = None
+                
                 if asr:
                     try:
                         await asr.stop_recognition()
@@ -591,6 +848,9 @@ async def websocket_audio_endpoint(websocket: WebSocket):
             except:
                 pass
         
+        if early_reply:
+            early_reply.cancel()
+        
         manager.disconnect(websocket)
         logger.info("WebSocket 连接断开")
     
@@ -604,6 +864,9 @@ async def websocket_audio_endpoint(websocket: WebSocket):
             except:
                 pass
         
+        if early_reply:
+            early_reply.cancel()
+        
         manager.disconnect(websocket)
         try:
             await websocket.send_json({
@@ -612,15 +875,80 @@ async def websocket_audio_endpoint(websocket: WebSocket):
             })
         except:
             pass
+    
+    finally:
+        # 连接结束后删除该会话的指标序列
+        global_metrics.remove_series({"session": session_id})
 
 
-async def handle_transcript(websocket: WebSocket, data: Dict):
+def start_early_reply(text: str) -> EarlyReply:
     """
-    处理转写文本
+    根据稳定的中间识别结果提前识别角色，有效问题同时开始生成回复
+    
+    Args:
+        text: 中间识别文本
+        
+    Returns:
+        提前启动的任务
+    """
+    role_task = asyncio.create_task(role_identifier.identify(text))
+    reply_task = None
+    if settings.speculative_reply_enabled and reply_generator.is_valid_question(text):
+        reply_task = asyncio.create_task(reply_generator.generate(
+            question=text,
+            conversation_history=conversation_history
+        ))
+        count_speculation("started")
+    
+    count_speculation("early_started")
+    return EarlyReply(text, role_task, reply_task)
+
+
+async def handle_transcript(
+    websocket: WebSocket,
+    data: Dict,
+    early: Optional[EarlyReply] = None,
+    trace: Optional[UtteranceTrace] = None
+):
+    """
+    处理转写文本，并记录这句话各阶段的延迟
+    
+    Args:
+        websocket: WebSocket 连接
+        data: 消息数据
+        early: 根据中间结果提前启动的任务，与最终结果一致时沿用
+        trace: 这句话的延迟追踪，不指定时从现在开始计时
+    """
+    is_final = data.get("is_final", False)
+    if trace is None:
+        trace = UtteranceTrace(current_llm_session.get())
+        trace.mark("asr_final")
+    
+    token = current_trace.set(trace)
+    try:
+        await process_transcript(websocket, data, early)
+    finally:
+        current_trace.reset(token)
+    
+    if not is_final:
+        return
+    
+    report = trace.finish()
+    latency = trace.elapsed("asr_final", "reply_sent")
+    if latency is not None:
+        global_metrics.record("reply.latency", latency, tags={"session": trace.session_id})
+        if settings.latency_report_enabled:
+            await websocket.send_json({"type": "latency", **report})
+
+
+async def process_transcript(websocket: WebSocket, data: Dict, early: Optional[EarlyReply] = None):
+    """
+    处理转写文本：识别角色，学生提问时生成回复
     
     Args:
         websocket: WebSocket 连接
         data: 消息数据
+        early: 根据中间结果提前启动的任务，与最终结果一致时沿用
     """
     text = data.get("text", "")
     is_final = data.get("is_final", False)
@@ -635,8 +963,50 @@ async def handle_transcript(websocket: WebSocket, data: Dict):
         "text": text
     })
     
+    # 沿用中间结果提前启动的任务，最终结果差异较大时重新开始
+    role_task = None
+    speculative_task = None
+    if early:
+        if is_final and early.matches(text, settings.partial_match_threshold):
+            role_task, speculative_task = early.role_task, early.reply_task
+            count_speculation("early_used")
+        else:
+            early.cancel()
+            count_speculation("early_restarted")
+            if early.reply_task:
+                count_speculation("wasted")
+                discard_stages(REPLY_STAGES)
+    
+    # 推测生成：有效问题在识别角色的同时开始生成回复，省去一次串行的模型调用
+    if (
+        speculative_task is None
+        and is_final
+        and settings.speculative_reply_enabled
+        and reply_generator.is_valid_question(text)
+    ):
+        speculative_task = asyncio.create_task(reply_generator.generate(
+            question=text,
+            conversation_history=conversation_history
+        ))
+        count_speculation("started")
+    
     # 识别角色
-    role = await role_identifier.identify(text)
+    try:
+        role = await role_task if role_task else await role_identifier.identify(text)
+    except BaseException:
+        if role_task:
+            role_task.cancel()
+        if speculative_task:
+            speculative_task.cancel()
+        raise
+    mark_stage("role_identified")
+    
+    # 不是学生的有效提问，取消推测生成
+    if speculative_task and (role != Role.STUDENT or not reply_generator.is_valid_question(text)):
+        speculative_task.cancel()
+        speculative_task = None
+        count_speculation("wasted")
+        discard_stages(REPLY_STAGES)
     
     # 添加到对话历史
     conversation_history.add_turn(role, text)
@@ -668,11 +1038,15 @@ async def handle_transcript(websocket: WebSocket, data: Dict):
         })
         
         try:
-            # 生成回复
-            reply = await reply_generator.generate(
-                question=text,
-                conversation_history=conversation_history
-            )
+            # 生成回复（优先使用推测生成的结果）
+            if speculative_task:
+                reply = await speculative_task
+                count_speculation("used")
+            else:
+                reply = await reply_generator.generate(
+                    question=text,
+                    conversation_history=conversation_history
+                )
             
             # 将回复添加到历史
             conversation_history.add_turn(Role.TEACHER, reply)
@@ -684,6 +1058,7 @@ async def handle_transcript(websocket: WebSocket, data: Dict):
                 "question": text,
                 "timestamp": datetime.now().isoformat()
             })
+            mark_stage("reply_sent")
             
             # 发送统计信息
             await websocket.send_json({
@@ -704,6 +1079,7 @@ async def websocket_stream_endpoint(websocket: WebSocket):
     流式回复 WebSocket 端点
     支持流式输出回复内容
     """
+    current_llm_session.set(f"ws-{id(websocket)}")
     await manager.connect(websocket)
     
     try:
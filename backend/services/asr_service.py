@@ -2,12 +2,17 @@
 阿里云 DashScope 实时语音识别服务
 """
 import asyncio
+import base64
 import json
 import logging
-from typing import Optional, Callable
+import time
+from collections import deque
+from typing import Optional, Callable, Deque, Dict, Set, Tuple
+import numpy as np
 import websockets
 from websockets.client import WebSocketClientProtocol
 import os
+from backend.utils.audio import AudioRingBuffer
 
 logger = logging.getLogger(__name__)
 
@@ -15,12 +20,33 @@ logger = logging.getLogger(__name__)
 class DashScopeASR:
     """阿里云 DashScope 实时语音识别"""
     
-    def __init__(self, api_key: str = None):
+    # 音频上行消息的固定 JSON 外壳，避免每帧 json.dumps
+    _AUDIO_PREFIX = '{"type": "input_audio_buffer.append", "audio": "'
+    _AUDIO_SUFFIX = '"}'
+    
+    # 断线重连的退避间隔（秒）
+    RECONNECT_BACKOFF = (0.5, 1.0, 2.0, 4.0, 8.0)
+    
+    # 重连去重时认定为重放重复的最少字数，更短的只在完全相同时去掉
+    DEDUPE_MIN_OVERLAP = 4
+    
+    def __init__(
+        self,
+        api_key: str = None,
+        frame_ms: int = 100,
+        queue_size: int = 50,
+        replay_seconds: float = 5.0,
+        max_reconnect_attempts: int = 5
+    ):
         """
         初始化 ASR 服务
         
         Args:
             api_key: DashScope API Key
+            frame_ms: 上行音频帧时长（毫秒），小块音频会合并到该长度再发送
+            queue_size: 上行发送队列长度，队列满时丢弃最旧的帧
+            replay_seconds: 断线重连后可重放的音频时长（秒）
+            max_reconnect_attempts: 最大重连次数，为 0 时不自动重连
         """
         self.api_key = api_key or os.getenv("DASHSCOPE_API_KEY")
         if not self.api_key:
@@ -41,6 +67,35 @@ class DashScopeASR:
         # 状态
         self.task_id: Optional[str] = None
         self.is_running = False
+        
+        # 上行音频：合并缓冲 + 有界队列 + 独立发送任务
+        self.frame_ms = frame_ms
+        self.queue_size = queue_size
+        self._frame_buffer = bytearray()
+        self._frame_fill = 0
+        self._send_queue: Optional[asyncio.Queue] = None
+        self._sender_task: Optional[asyncio.Task] = None
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        
+        # 断线重连：保留最近的音频用于重放
+        self.sample_rate = 16000
+        self.replay_seconds = replay_seconds
+        self.max_reconnect_attempts = max_reconnect_attempts
+        self._ring: Optional[AudioRingBuffer] = None
+        self._session_start = 0  # 当前上游会话第一个采样点的绝对位置
+        self._acked = 0  # 已被上游确认（语音段结束）的绝对位置
+        self._online: Optional[asyncio.Event] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._recent_finals: Deque[str] = deque(maxlen=5)
+        self._dedupe_until = 0.0
+        self.reconnects = 0
+    
+    @property
+    def is_active(self) -> bool:
+        """会话是否可接收音频（包括正在重连）"""
+        return self.is_running and (self.is_connected or self._reconnect_task is not None)
     
     async def connect(self):
         """建立 WebSocket 连接"""
@@ -61,7 +116,7 @@ class DashScopeASR:
             logger.info("✅ DashScope ASR 连接成功")
             
             # 启动接收任务
-            asyncio.create_task(self._receive_loop())
+            asyncio.create_task(self._receive_loop(self.ws))
             
         except Exception as e:
             logger.error(f"❌ DashScope ASR 连接失败: {e}")
@@ -78,7 +133,25 @@ class DashScopeASR:
         if not self.is_connected:
             await self.connect()
         
-        # 配置会话（Realtime API 格式）
+        self.sample_rate = sample_rate
+        await self._send_session_config()
+        
+        # 按采样率预分配一帧的合并缓冲（16-bit 单声道）
+        self._frame_buffer = bytearray(sample_rate * 2 * self.frame_ms // 1000)
+        self._frame_fill = 0
+        self._send_queue = asyncio.Queue(maxsize=self.queue_size)
+        self._ring = AudioRingBuffer(int(sample_rate * self.replay_seconds))
+        self._session_start = 0
+        self._acked = 0
+        self._online = asyncio.Event()
+        self._online.set()
+        self._sender_task = asyncio.create_task(self._send_loop())
+        
+        self.is_running = True
+        logger.info("✅ 开始识别")
+    
+    async def _send_session_config(self):
+        """发送会话配置（Realtime API 格式）"""
         session_config = {
             "type": "session.update",
             "session": {
@@ -87,69 +160,256 @@ class DashScopeASR:
                 "transcription": {
                     "language": "zh",  # 中文
                     "input_audio_format": "pcm",
-                    "input_sample_rate": sample_rate
+                    "input_sample_rate": self.sample_rate
                 }
             }
         }
         
         await self.ws.send(json.dumps(session_config))
-        self.is_running = True
-        logger.info("✅ 开始识别")
     
     async def send_audio(self, audio_data: bytes):
         """
         发送音频数据（Realtime API 格式）
         
+        音频先合并到固定时长的帧，再交给后台发送任务，
+        调用方不会等待上游 WebSocket。
+        
         Args:
             audio_data: PCM 音频数据（16-bit）
         """
-        if not self.is_connected or not self.is_running:
+        if not self.is_active:
             logger.warning("ASR 未连接或未启动")
             return
         
-        try:
-            # Realtime API 需要 base64 编码
-            import base64
-            audio_b64 = base64.b64encode(audio_data).decode('utf-8')
+        view = memoryview(audio_data)
+        frame_size = len(self._frame_buffer)
+        
+        while view:
+            n = min(frame_size - self._frame_fill, len(view))
+            self._frame_buffer[self._frame_fill:self._frame_fill + n] = view[:n]
+            self._frame_fill += n
+            view = view[n:]
             
-            # 发送音频数据
-            audio_message = {
-                "type": "input_audio_buffer.append",
-                "audio": audio_b64
-            }
+            if self._frame_fill == frame_size:
+                self._enqueue_frame(bytes(self._frame_buffer))
+                self._frame_fill = 0
+    
+    def _enqueue_frame(self, frame: bytes) -> None:
+        """
+        将一帧放入发送队列，队列满时丢弃最旧的帧
+        
+        Args:
+            frame: 完整的 PCM 帧
+        """
+        if self._send_queue.full():
+            self._send_queue.get_nowait()
+            self._send_queue.task_done()
+            self.frames_dropped += 1
+            logger.warning("ASR 上行队列已满，丢弃最旧的音频帧")
+        
+        # 帧在发送时才写入环形缓冲区，丢弃的帧不会占用上游会话的位置
+        self._send_queue.put_nowait(frame)
+    
+    async def _send_frame(self, frame: bytes):
+        """编码并发送一帧音频"""
+        # Realtime API 需要 base64 编码
+        audio_b64 = base64.b64encode(frame).decode('ascii')
+        await self.ws.send(self._AUDIO_PREFIX + audio_b64 + self._AUDIO_SUFFIX)
+        self.frames_sent += 1
+    
+    async def _send_loop(self):
+        """上行发送循环"""
+        while True:
+            frame = await self._send_queue.get()
+            try:
+                # 重连期间等重放完成后再按顺序发送
+                await self._online.wait()
+                self._ring.write(np.frombuffer(frame, dtype='<i2'))
+                await self._send_frame(frame)
+            except websockets.exceptions.ConnectionClosed:
+                # 帧仍在环形缓冲区中，重连后会重放
+                self._schedule_reconnect()
+            except Exception as e:
+                logger.error(f"发送音频失败: {e}")
+                if self.on_error:
+                    await self.on_error(str(e))
+            finally:
+                self._send_queue.task_done()
+    
+    def _schedule_reconnect(self) -> bool:
+        """
+        在后台启动重连
+        
+        Returns:
+            是否已在重连或成功启动重连
+        """
+        if self._closing or not self.is_running or self.max_reconnect_attempts <= 0:
+            return False
+        
+        if self._reconnect_task is None:
+            self.is_connected = False
+            self._online.clear()
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+        return True
+    
+    async def _reconnect(self):
+        """按退避间隔重连，成功后重放未确认的音频"""
+        try:
+            for attempt in range(self.max_reconnect_attempts):
+                delay = self.RECONNECT_BACKOFF[min(attempt, len(self.RECONNECT_BACKOFF) - 1)]
+                logger.warning(f"ASR 连接中断，{delay}s 后第 {attempt + 1} 次重连")
+                await asyncio.sleep(delay)
+                
+                if self._closing:
+                    return
+                
+                try:
+                    await self.connect()
+                    await self._send_session_config()
+                    # 重放时连接再次中断也进入下一次重连
+                    await self._replay()
+                except Exception as e:
+                    logger.warning(f"ASR 重连失败: {e}")
+                    continue
+                
+                self.reconnects += 1
+                self._online.set()
+                logger.info("✅ ASR 已重连")
+                return
             
-            await self.ws.send(json.dumps(audio_message))
-        except Exception as e:
-            logger.error(f"发送音频失败: {e}")
+            logger.error("ASR 重连次数已用完")
+            self.is_running = False
             if self.on_error:
-                await self.on_error(str(e))
+                await self.on_error("语音识别连接中断，重连失败")
+        finally:
+            self._reconnect_task = None
+    
+    async def _replay(self):
+        """重放上次确认位置之后的音频（排队中的帧在重放后由发送任务继续发送）"""
+        samples = self._ring.read(self._acked)
+        self._session_start = self._ring.end - len(samples)
+        
+        frame_samples = len(self._frame_buffer) // 2
+        for i in range(0, len(samples), frame_samples):
+            await self._send_frame(samples[i:i + frame_samples].tobytes())
+        
+        # 重放音频可能再次产生缺口前已返回的文本
+        replay_duration = len(samples) / self.sample_rate
+        self._dedupe_until = time.monotonic() + replay_duration + self.replay_seconds
+        logger.info(f"已重放 {replay_duration:.2f}s 音频")
+    
+    def _ack(self, audio_end_ms: Optional[int] = None):
+        """
+        记录上游已确认的音频位置
+        
+        Args:
+            audio_end_ms: 当前会话内语音段结束时间（毫秒），缺省时取已发送的位置
+        """
+        if audio_end_ms is None:
+            position = self._ring.end if self._ring else 0
+        else:
+            position = self._session_start + audio_end_ms * self.sample_rate // 1000
+        self._acked = max(self._acked, position)
+    
+    def _dedupe_final(self, text: str) -> Optional[str]:
+        """
+        去除重连前后重复识别的文本
+        
+        Args:
+            text: 最终识别结果
+            
+        Returns:
+            去重后的文本，完全重复时返回 None
+        """
+        if time.monotonic() < self._dedupe_until:
+            for previous in self._recent_finals:
+                # 与之前的文本相同，或是之前文本被重放的结尾部分
+                if text == previous or (
+                    len(text) >= self.DEDUPE_MIN_OVERLAP and previous.endswith(text)
+                ):
+                    return None
+                # 新文本开头与之前文本结尾重叠时，去掉重叠部分
+                for k in range(min(len(previous), len(text)) - 1, self.DEDUPE_MIN_OVERLAP - 1, -1):
+                    if previous.endswith(text[:k]):
+                        text = text[k:]
+                        break
+        
+        self._recent_finals.append(text)
+        return text
+    
+    async def flush(self, timeout: float = 5.0):
+        """
+        发送合并缓冲中剩余的音频，并等待发送队列清空
+        
+        Args:
+            timeout: 等待队列清空的最长时间（秒）
+        """
+        if self._send_queue is None:
+            return
+        
+        if self._frame_fill:
+            self._enqueue_frame(bytes(self._frame_buffer[:self._frame_fill]))
+            self._frame_fill = 0
+        
+        if self._sender_task and not self._sender_task.done() and self._online.is_set():
+            try:
+                await asyncio.wait_for(self._send_queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("等待 ASR 上行队列清空超时")
+    
+    async def _stop_sender(self):
+        """停止上行发送任务"""
+        if self._sender_task:
+            self._sender_task.cancel()
+            try:
+                await self._sender_task
+            except asyncio.CancelledError:
+                pass
+            self._sender_task = None
     
     async def stop_recognition(self):
         """停止识别"""
         if not self.is_running:
             return
         
-        # 发送结束消息（Realtime API）
-        stop_message = {
-            "type": "session.finish"
-        }
-        
-        await self.ws.send(json.dumps(stop_message))
+        # 先发完剩余音频，再结束会话
+        await self.flush()
+        await self._stop_sender()
         self.is_running = False
+        
+        # 发送结束消息（Realtime API）
+        if self.is_connected:
+            stop_message = {
+                "type": "session.finish"
+            }
+            
+            await self.ws.send(json.dumps(stop_message))
         logger.info("✅ 停止识别")
     
-    async def _receive_loop(self):
-        """接收消息循环"""
+    async def _receive_loop(self, ws: WebSocketClientProtocol):
+        """
+        接收消息循环
+        
+        Args:
+            ws: 本循环负责的连接（重连后旧循环自行退出）
+        """
         try:
-            async for message in self.ws:
+            async for message in ws:
                 await self._handle_message(message)
         except websockets.exceptions.ConnectionClosed:
-            logger.info("ASR 连接已关闭")
-            self.is_connected = False
+            pass
         except Exception as e:
             logger.error(f"接收消息错误: {e}")
             if self.on_error:
                 await self.on_error(str(e))
+            return
+        
+        if ws is not self.ws:
+            return
+        
+        logger.info("ASR 连接已关闭")
+        if not self._schedule_reconnect():
+            self.is_connected = False
     
     async def _handle_message(self, message: str):
         """
@@ -158,6 +418,8 @@ class DashScopeASR:
         Args:
             message: JSON 消息
         """
+        # 收到事件的时间，供延迟追踪使用
+        received_at = time.perf_counter()
         try:
             data = json.loads(message)
             event_type = data.get("type")
@@ -177,8 +439,9 @@ class DashScopeASR:
                 logger.info("======VAD 检测到语音开始======")
             
             elif event_type == "input_audio_buffer.speech_stopped":
-                # VAD 检测到语音结束
+                # VAD 检测到语音结束，之前的音频不再需要重放
                 logger.info("======VAD 检测到语音结束======")
+                self._ack(data.get("audio_end_ms"))
             
             elif event_type == "conversation.item.input_audio_transcription.text":
                 # 中间识别结果
@@ -187,17 +450,19 @@ class DashScopeASR:
                     await self.on_result({
                         "text": text,
                         "is_final": False,
-                        "confidence": 1.0
+                        "confidence": 1.0,
+                        "received_at": received_at
                     })
             
             elif event_type == "conversation.item.input_audio_transcription.completed":
                 # 最终识别结果
-                text = data.get("transcript", "")
+                text = self._dedupe_final(data.get("transcript", ""))
                 if text and self.on_result:
                     await self.on_result({
                         "text": text,
                         "is_final": True,
-                        "confidence": 1.0
+                        "confidence": 1.0,
+                        "received_at": received_at
                     })
                 logger.info(f"识别完成: {text}")
             
@@ -209,16 +474,27 @@ class DashScopeASR:
                     await self.on_error(error_message)
             
             else:
-                logger.debug(f"未处理的事件: {event_type}")
+                logger.debug("未处理的事件: %s", event_type)
         
         except Exception as e:
             logger.error(f"处理消息失败: {e}")
     
     async def disconnect(self):
         """断开连接"""
+        self._closing = True
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+            try:
+                await self._reconnect_task
+            except asyncio.CancelledError:
+                pass
+            self._reconnect_task = None
+        
         if self.is_running:
             await self.stop_recognition()
         
+        await self._stop_sender()
+        
         if self.ws:
             await self.ws.close()
             self.ws = None
@@ -293,6 +569,191 @@ class ASRService:
             await self.remove_session(user_id)
 
 
+class ASRConnectionPool:
+    """
+    预热的 ASR 连接池
+    
+    预先建立并配置好若干上游会话，start_listening 时直接取用，
+    省去 TLS 握手和 session.update 的等待时间。
+    """
+    
+    def __init__(
+        self,
+        size: int = 2,
+        sample_rate: int = 16000,
+        max_idle_seconds: float = 60.0,
+        check_interval: float = 5.0,
+        factory: Optional[Callable[[], DashScopeASR]] = None
+    ):
+        """
+        初始化连接池
+        
+        Args:
+            size: 保持的预热会话数量
+            sample_rate: 预热会话使用的采样率
+            max_idle_seconds: 会话最长闲置时间（秒），超过后重新建立
+            check_interval: 后台健康检查间隔（秒）
+            factory: 创建 DashScopeASR 实例的工厂函数
+        """
+        self.size = size
+        self.sample_rate = sample_rate
+        self.max_idle_seconds = max_idle_seconds
+        self.check_interval = check_interval
+        self.factory = factory or DashScopeASR
+        
+        self._idle: Deque[Tuple[DashScopeASR, float]] = deque()
+        self._warming = 0
+        self._maintain_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # 后台关闭会话的任务，保留引用以免被回收，关闭连接池时等待完成
+        self._close_tasks: Set[asyncio.Task] = set()
+        
+        self.hits = 0
+        self.misses = 0
+    
+    async def start(self):
+        """启动后台补充任务"""
+        if self._maintain_task is None:
+            self._wakeup = asyncio.Event()
+            self._maintain_task = asyncio.create_task(self._maintain_loop())
+            logger.info(f"✅ ASR 连接池已启动（{self.size} 个预热会话）")
+    
+    async def acquire(self, sample_rate: Optional[int] = None) -> DashScopeASR:
+        """
+        取出一个已连接并已开始识别的会话
+        
+        Args:
+            sample_rate: 需要的采样率，与预热采样率不同时直接新建
+            
+        Returns:
+            DashScopeASR 实例
+        """
+        sample_rate = sample_rate or self.sample_rate
+        
+        if sample_rate == self.sample_rate:
+            now = time.monotonic()
+            while self._idle:
+                asr, created_at = self._idle.popleft()
+                if self._is_healthy(asr, created_at, now):
+                    self.hits += 1
+                    self._notify()
+                    return asr
+                self._discard(asr)
+        
+        self.misses += 1
+        self._notify()
+        return await self._create_session(sample_rate)
+    
+    async def _create_session(self, sample_rate: int) -> DashScopeASR:
+        """建立并配置一个新会话"""
+        asr = self.factory()
+        await asr.connect()
+        await asr.start_recognition(sample_rate=sample_rate)
+        return asr
+    
+    def _is_healthy(self, asr: DashScopeASR, created_at: float, now: float) -> bool:
+        """检查闲置会话是否仍可用"""
+        if now - created_at > self.max_idle_seconds:
+            return False
+        if asr.ws is None or getattr(asr.ws, "closed", False):
+            return False
+        return asr.is_connected and asr.is_running
+    
+    def _notify(self):
+        """唤醒后台任务补充会话"""
+        if self._wakeup:
+            self._wakeup.set()
+    
+    def _discard(self, asr: DashScopeASR):
+        """在后台关闭不再使用的会话"""
+        task = asyncio.create_task(self._close_session(asr))
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+    
+    async def _close_session(self, asr: DashScopeASR):
+        """关闭会话，忽略已断开连接上的错误"""
+        try:
+            await asr.disconnect()
+        except Exception as e:
+            logger.debug(f"关闭闲置 ASR 会话失败: {e}")
+    
+    async def _replenish(self):
+        """剔除失效会话并补足预热数量"""
+        now = time.monotonic()
+        healthy: Deque[Tuple[DashScopeASR, float]] = deque()
+        for asr, created_at in self._idle:
+            if self._is_healthy(asr, created_at, now):
+                healthy.append((asr, created_at))
+            else:
+                self._discard(asr)
+        self._idle = healthy
+        
+        missing = self.size - len(self._idle) - self._warming
+        if missing <= 0:
+            return
+        
+        self._warming += missing
+        try:
+            results = await asyncio.gather(
+                *[self._create_session(self.sample_rate) for _ in range(missing)],
+                return_exceptions=True
+            )
+        finally:
+            self._warming -= missing
+        
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"预热 ASR 会话失败: {result}")
+            else:
+                self._idle.append((result, time.monotonic()))
+    
+    async def _maintain_loop(self):
+        """后台补充循环"""
+        while True:
+            self._wakeup.clear()
+            try:
+                await self._replenish()
+            except Exception as e:
+                logger.error(f"ASR 连接池补充失败: {e}")
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def close(self):
+        """停止后台任务并关闭所有闲置会话"""
+        if self._maintain_task:
+            self._maintain_task.cancel()
+            try:
+                await self._maintain_task
+            except asyncio.CancelledError:
+                pass
+            self._maintain_task = None
+        
+        while self._idle:
+            asr, _ = self._idle.popleft()
+            await self._close_session(asr)
+        
+        if self._close_tasks:
+            await asyncio.gather(*self._close_tasks, return_exceptions=True)
+    
+    def get_stats(self) -> Dict[str, int]:
+        """
+        获取连接池统计信息
+        
+        Returns:
+            统计信息字典
+        """
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "warming": self._warming,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
 # 全局 ASR 服务实例
 asr_service = ASRService()
 
@@ -0,0 +1,277 @@
+"""
+大模型请求调度模块
+限制同时进行的大模型请求数，按优先级和会话公平地排队
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Deque, Dict, Optional, Tuple
+from backend.utils.metrics import global_metrics
+from config.settings import settings
+
+
+class LLMPriority(IntEnum):
+    """请求优先级，数值越小越优先"""
+    LIVE_REPLY = 0  # 学生提问的实时回复
+    ROLE_ID = 1  # 角色识别
+    SUMMARY = 2  # 对话摘要
+    DEBUG = 3  # 调试接口
+
+
+# 当前请求的优先级、所属会话和截止时间（事件循环时间），随 asyncio 任务传递
+current_llm_priority: ContextVar[LLMPriority] = ContextVar("llm_priority", default=LLMPriority.LIVE_REPLY)
+current_llm_session: ContextVar[str] = ContextVar("llm_session", default="")
+current_llm_deadline: ContextVar[Optional[float]] = ContextVar("llm_deadline", default=None)
+
+
+@contextmanager
+def llm_context(
+    priority: Optional[LLMPriority] = None,
+    session_id: Optional[str] = None,
+    deadline: Optional[float] = None
+):
+    """
+    设置代码块内大模型请求的优先级、会话和截止时间
+    
+    Args:
+        priority: 优先级
+        session_id: 会话 ID
+        deadline: 截止时间（事件循环时间），已有更早的截止时间时保留原值
+    """
+    tokens = []
+    if priority is not None:
+        tokens.append((current_llm_priority, current_llm_priority.set(priority)))
+    if session_id is not None:
+        tokens.append((current_llm_session, current_llm_session.set(session_id)))
+    if deadline is not None:
+        outer = current_llm_deadline.get()
+        if outer is not None:
+            deadline = min(deadline, outer)
+        tokens.append((current_llm_deadline, current_llm_deadline.set(deadline)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def remaining_budget() -> Optional[float]:
+    """
+    当前请求剩余的时间预算
+    
+    Returns:
+        剩余秒数，没有截止时间时返回 None
+    """
+    deadline = current_llm_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - asyncio.get_running_loop().time()
+
+
+class LLMScheduler:
+    """
+    大模型请求调度器
+    
+    同时进行的请求数达到上限后新请求排队；有空位时先调度高优先级的请求，
+    同一优先级内按会话轮转，避免单个会话占满队列。
+    部分名额只留给实时回复，后台的角色识别、摘要等请求再多也不会占满全部名额。
+    """
+    
+    def __init__(self, max_concurrency: int = 4, reserved_slots: int = 1):
+        """
+        初始化调度器
+        
+        Args:
+            max_concurrency: 最大同时进行的请求数
+            reserved_slots: 只留给实时回复的名额数，至少给其他请求留一个名额
+        """
+        self.max_concurrency = max_concurrency
+        self.reserved_slots = max(0, min(reserved_slots, max_concurrency - 1))
+        self.in_flight = 0
+        # 实时回复以外的请求正在使用的名额数
+        self.background_in_flight = 0
+        self._queues: Dict[LLMPriority, "OrderedDict[str, Deque[asyncio.Future]]"] = {
+            priority: OrderedDict() for priority in LLMPriority
+        }
+        self.scheduled: Dict[LLMPriority, int] = {priority: 0 for priority in LLMPriority}
+        self.total_wait: Dict[LLMPriority, float] = {priority: 0.0 for priority in LLMPriority}
+        self.max_wait: Dict[LLMPriority, float] = {priority: 0.0 for priority in LLMPriority}
+    
+    def queued(self, priority: Optional[LLMPriority] = None) -> int:
+        """
+        排队中的请求数
+        
+        Args:
+            priority: 优先级，不指定时统计全部
+            
+        Returns:
+            请求数
+        """
+        priorities = [priority] if priority is not None else list(LLMPriority)
+        return sum(
+            len(queue)
+            for p in priorities
+            for queue in self._queues[p].values()
+        )
+    
+    async def acquire(self, priority: Optional[LLMPriority] = None, session_id: Optional[str] = None) -> None:
+        """
+        获取请求名额，没有空位时排队等待
+        
+        Args:
+            priority: 优先级，不指定时使用当前上下文的优先级
+            session_id: 会话 ID，不指定时使用当前上下文的会话
+            
+        Raises:
+            asyncio.TimeoutError: 排队超过当前上下文的截止时间
+        """
+        priority = current_llm_priority.get() if priority is None else priority
+        session_id = current_llm_session.get() if session_id is None else session_id
+        start_time = time.perf_counter()
+        
+        if self._has_slot(priority) and not any(self._queues[p] for p in LLMPriority if p <= priority):
+            self._take_slot(priority)
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            sessions = self._queues[priority]
+            sessions.setdefault(session_id, deque()).append(waiter)
+            try:
+                # 不在队列中等到截止时间之后
+                await asyncio.wait_for(waiter, remaining_budget())
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                if waiter.done() and not waiter.cancelled():
+                    # 已分配名额但调用方被取消，归还名额
+                    self.release(priority)
+                else:
+                    self._remove_waiter(priority, session_id, waiter)
+                raise
+        
+        wait = time.perf_counter() - start_time
+        self.scheduled[priority] += 1
+        self.total_wait[priority] += wait
+        self.max_wait[priority] = max(self.max_wait[priority], wait)
+        global_metrics.record("llm.queue_time", wait, tags={"priority": priority.name.lower()})
+    
+    def release(self, priority: Optional[LLMPriority] = None) -> None:
+        """
+        归还请求名额，并调度排队中的请求
+        
+        Args:
+            priority: 获取名额时的优先级，不指定时使用当前上下文的优先级
+        """
+        priority = current_llm_priority.get() if priority is None else priority
+        self.in_flight -= 1
+        if priority != LLMPriority.LIVE_REPLY:
+            self.background_in_flight -= 1
+        while self.in_flight < self.max_concurrency:
+            entry = self._next_waiter(background=self._has_slot(LLMPriority.SUMMARY))
+            if entry is None:
+                break
+            waiter_priority, waiter = entry
+            self._take_slot(waiter_priority)
+            waiter.set_result(None)
+    
+    def _has_slot(self, priority: LLMPriority) -> bool:
+        """指定优先级的请求现在能否获得名额"""
+        if self.in_flight >= self.max_concurrency:
+            return False
+        if priority == LLMPriority.LIVE_REPLY:
+            return True
+        return self.background_in_flight < self.max_concurrency - self.reserved_slots
+    
+    def _take_slot(self, priority: LLMPriority) -> None:
+        """占用一个名额"""
+        self.in_flight += 1
+        if priority != LLMPriority.LIVE_REPLY:
+            self.background_in_flight += 1
+    
+    @asynccontextmanager
+    async def slot(self, priority: Optional[LLMPriority] = None, session_id: Optional[str] = None):
+        """
+        在请求名额内执行代码块
+        
+        Args:
+            priority: 优先级
+            session_id: 会话 ID
+        """
+        priority = current_llm_priority.get() if priority is None else priority
+        await self.acquire(priority, session_id)
+        try:
+            yield
+        finally:
+            self.release(priority)
+    
+    def _next_waiter(self, background: bool = True) -> Optional[Tuple[LLMPriority, asyncio.Future]]:
+        """
+        取出下一个应调度的请求：优先级最高，同优先级内按会话轮转
+        
+        Args:
+            background: 是否调度实时回复以外的请求
+            
+        Returns:
+            (优先级, 等待中的 Future)，没有可调度的请求时返回 None
+        """
+        for priority in LLMPriority:
+            if priority != LLMPriority.LIVE_REPLY and not background:
+                break
+            sessions = self._queues[priority]
+            while sessions:
+                session_id, queue = next(iter(sessions.items()))
+                waiter = queue.popleft()
+                if queue:
+                    sessions.move_to_end(session_id)
+                else:
+                    del sessions[session_id]
+                if not waiter.done():
+                    return priority, waiter
+        return None
+    
+    def _remove_waiter(self, priority: LLMPriority, session_id: str, waiter: asyncio.Future) -> None:
+        """从队列中移除已取消的请求"""
+        sessions = self._queues[priority]
+        queue = sessions.get(session_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del sessions[session_id]
+    
+    def get_stats(self) -> Dict:
+        """
+        获取调度统计信息
+        
+        Returns:
+            统计信息字典
+        """
+        return {
+            "max_concurrency": self.max_concurrency,
+            "reserved_slots": self.reserved_slots,
+            "in_flight": self.in_flight,
+            "background_in_flight": self.background_in_flight,
+            "queued": self.queued(),
+            "priorities": {
+                priority.name.lower(): {
+                    "queued": self.queued(priority),
+                    "scheduled": self.scheduled[priority],
+                    "avg_wait": (
+                        self.total_wait[priority] / self.scheduled[priority]
+                        if self.scheduled[priority] else 0
+                    ),
+                    "max_wait": self.max_wait[priority]
+                }
+                for priority in LLMPriority
+            }
+        }
+
+
+# 全局实例
+llm_scheduler = LLMScheduler(
+    max_concurrency=settings.llm_max_concurrency,
+    reserved_slots=settings.llm_reserved_slots
+)
@@ -2,11 +2,69 @@
 OpenAI 兼容接口服务
 用于调用通义千问大模型
 """
-from typing import List, Dict, Optional, AsyncIterator, Any
-from openai import AsyncOpenAI
+from typing import List, Dict, Optional, AsyncIterator, Any, Callable
+import asyncio
+import hashlib
+import json
+import statistics
+from collections import deque
+from contextlib import asynccontextmanager
+from backend.services.llm_scheduler import (
+    LLMScheduler, LLMPriority, llm_context, llm_scheduler, current_llm_deadline, current_llm_priority
+)
+from backend.utils.metrics import global_metrics
 from config.settings import settings
 
 
+class _Flight:
+    """进行中的非流式请求，相同请求的调用方共享结果"""
+    
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        # 获得调度名额的时间（事件循环时间），以及等待这一时刻的调用方
+        self.started_at: Optional[float] = None
+        self._started: List[asyncio.Future] = []
+    
+    def mark_started(self, started_at: float) -> None:
+        """记录已获得调度名额，并通知等待的调用方"""
+        self.started_at = started_at
+        for started in self._started:
+            _set_started(started, started_at)
+        self._started.clear()
+    
+    def notify_started(self, started: asyncio.Future) -> None:
+        """获得调度名额时设置 started 的结果"""
+        if self.started_at is not None:
+            _set_started(started, self.started_at)
+        else:
+            self._started.append(started)
+
+
+def _set_started(started: Optional[asyncio.Future], started_at: float) -> None:
+    """设置获得调度名额的时间"""
+    if started is not None and not started.done():
+        started.set_result(started_at)
+
+
+class _StreamFlight:
+    """进行中的流式请求，已收到的片段会转发给所有订阅者"""
+    
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+
+
+@asynccontextmanager
+async def _no_slot():
+    """不限制并发"""
+    yield
+
+
 class OpenAIService:
     """OpenAI 兼容接口服务"""
     
@@ -14,7 +72,9 @@ class OpenAIService:
         self,
         api_key: Optional[str] = None,
         base_url: Optional[str] = None,
-        model: Optional[str] = None
+        model: Optional[str] = None,
+        coalesce: bool = True,
+        scheduler: Optional[LLMScheduler] = None
     ):
         """
         初始化服务
@@ -23,6 +83,8 @@ class OpenAIService:
             api_key: API Key
             base_url: API 基础 URL
             model: 默认模型名称
+            coalesce: 是否合并同时进行的相同请求
+            scheduler: 请求调度器，不指定时不限制并发
         """
         self.api_key = api_key or settings.openai_api_key
         self.base_url = base_url or settings.openai_base_url
@@ -31,10 +93,69 @@ class OpenAIService:
         if not self.api_key:
             raise ValueError("OpenAI API Key is required")
         
-        self.client = AsyncOpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url
+        # 客户端（以及 openai 包本身）首次请求时再创建，避免拖慢启动
+        self._client = None
+        
+        # 请求合并：相同的消息和参数只向上游发起一次请求
+        self.coalesce = coalesce
+        self._inflight: Dict[str, _Flight] = {}
+        self._inflight_streams: Dict[str, _StreamFlight] = {}
+        self.upstream_requests = 0
+        self.coalesced_requests = 0
+        
+        self.scheduler = scheduler
+        
+        # 对冲请求：延迟取近期耗时的 p95，样本不足时使用默认值
+        self.default_hedge_delay = settings.llm_hedge_default_delay
+        self.min_hedge_samples = 20
+        self._latencies = deque(maxlen=200)
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self.deadline_exceeded = 0
+    
+    @property
+    def client(self):
+        """AsyncOpenAI 客户端，首次访问时创建"""
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url
+            )
+        return self._client
+    
+    @client.setter
+    def client(self, client) -> None:
+        self._client = client
+    
+    def warm_up(self) -> None:
+        """提前创建客户端（可在后台线程中调用）"""
+        self.client
+    
+    def _slot(self, priority: Optional[LLMPriority] = None):
+        """获取调度器名额（没有调度器时直接执行）"""
+        if self.scheduler:
+            return self.scheduler.slot(priority)
+        return _no_slot()
+    
+    @staticmethod
+    def request_key(messages: List[Dict[str, str]], **params) -> str:
+        """
+        计算请求指纹
+        
+        Args:
+            messages: 消息列表
+            **params: 模型、温度等请求参数
+            
+        Returns:
+            请求指纹
+        """
+        payload = json.dumps(
+            {"messages": messages, "params": params},
+            sort_keys=True,
+            ensure_ascii=False
         )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
     
     async def chat_completion(
         self,
@@ -42,7 +163,10 @@ class OpenAIService:
         model: Optional[str] = None,
         temperature: float = 0.7,
         max_tokens: Optional[int] = None,
-        stream: bool = False
+        stream: bool = False,
+        priority: Optional[LLMPriority] = None,
+        coalesce: Optional[bool] = None,
+        started: Optional[asyncio.Future] = None
     ) -> Dict[str, Any]:
         """
         聊天补全
@@ -53,19 +177,74 @@ class OpenAIService:
             temperature: 温度参数
             max_tokens: 最大 token 数
             stream: 是否流式输出
+            priority: 调度优先级，不指定时使用当前上下文的优先级
+            coalesce: 是否与相同请求合并，不指定时使用实例设置
+            started: 上游请求获得调度名额时设置结果（事件循环时间）
             
         Returns:
             响应字典
         """
         model = model or self.model
+        coalesce = self.coalesce if coalesce is None else coalesce
+        priority = current_llm_priority.get() if priority is None else priority
         
-        response = await self.client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            stream=stream
+        if stream or not coalesce:
+            return await self._chat_completion(
+                messages, model, temperature, max_tokens, stream, priority,
+                on_started=lambda started_at: _set_started(started, started_at)
+            )
+        
+        # 合并的请求按第一个调用方的优先级调度，只与同优先级的请求合并，
+        # 避免实时回复加入排队中的后台请求
+        key = self.request_key(
+            messages, model=model, temperature=temperature, max_tokens=max_tokens, priority=priority.name
         )
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(self._chat_completion(
+                messages, model, temperature, max_tokens, stream, priority,
+                on_started=flight.mark_started
+            ))
+            self._inflight[key] = flight
+            flight.task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced_requests += 1
+        if started is not None:
+            flight.notify_started(started)
+        
+        # 所有调用方都取消时才取消上游请求
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0:
+                flight.task.cancel()
+            raise
+    
+    async def _chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: Optional[int],
+        stream: bool,
+        priority: Optional[LLMPriority] = None,
+        on_started: Optional[Callable[[float], None]] = None
+    ) -> Dict[str, Any]:
+        """向上游发起聊天补全请求，获得调度名额后调用 on_started"""
+        async with self._slot(priority):
+            if on_started is not None:
+                on_started(asyncio.get_running_loop().time())
+            self.upstream_requests += 1
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=stream
+            )
         
         if stream:
             return response
@@ -81,6 +260,121 @@ class OpenAIService:
             }
         }
     
+    def hedge_delay(self) -> float:
+        """
+        计算发起对冲请求前的等待时间
+        
+        Returns:
+            近期请求耗时的 p95（秒），样本不足时返回默认值
+        """
+        if len(self._latencies) < self.min_hedge_samples:
+            return self.default_hedge_delay
+        return statistics.quantiles(self._latencies, n=20)[-1]
+    
+    async def chat_completion_hedged(
+        self,
+        messages: List[Dict[str, str]],
+        model: Optional[str] = None,
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        hedge_model: Optional[str] = None,
+        budget: Optional[float] = None,
+        hedge: bool = True,
+        priority: Optional[LLMPriority] = None
+    ) -> Dict[str, Any]:
+        """
+        带截止时间的对冲聊天补全
+        
+        请求获得调度名额后超过 p95 耗时仍未返回时再发起一次（可使用更快的备用模型），
+        取先成功的结果并取消另一个；超过时间预算时取消全部请求。
+        在调度器中排队的时间不计入对冲等待时间，排队时不发起对冲请求。
+        
+        Args:
+            messages: 消息列表
+            model: 模型名称
+            temperature: 温度参数
+            max_tokens: 最大 token 数
+            hedge_model: 对冲请求使用的模型，不指定时使用同一模型
+            budget: 时间预算（秒），不指定时沿用当前上下文的截止时间
+            hedge: 是否发起对冲请求
+            priority: 调度优先级
+            
+        Returns:
+            响应字典
+            
+        Raises:
+            asyncio.TimeoutError: 超过截止时间
+        """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        deadline = start_time + budget if budget else current_llm_deadline.get()
+        
+        def remaining() -> Optional[float]:
+            return None if deadline is None else deadline - loop.time()
+        
+        # 子任务创建时复制上下文，截止时间随之传递给调度器
+        started = loop.create_future()
+        with llm_context(deadline=deadline):
+            primary = asyncio.ensure_future(self.chat_completion(
+                messages, model, temperature, max_tokens, priority=priority, started=started
+            ))
+        hedge_task = None
+        
+        try:
+            pending = {primary}
+            if hedge:
+                # 先等原请求获得调度名额
+                await asyncio.wait(
+                    {primary, started}, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED
+                )
+            if hedge and started.done() and not primary.done():
+                delay = max(self.hedge_delay() - (loop.time() - started.result()), 0)
+                if deadline is not None:
+                    delay = min(delay, max(remaining(), 0))
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done and (deadline is None or remaining() > 0):
+                    # 对冲请求使用同一模型时不能与原请求合并
+                    with llm_context(deadline=deadline):
+                        hedge_task = asyncio.ensure_future(self.chat_completion(
+                            messages, hedge_model or model, temperature, max_tokens,
+                            priority=priority, coalesce=False
+                        ))
+                    pending.add(hedge_task)
+                    self.hedged_requests += 1
+                    global_metrics.increment("llm.hedge.fired")
+            
+            error: Optional[BaseException] = None
+            while pending:
+                timeout = remaining()
+                if timeout is not None and timeout <= 0:
+                    raise asyncio.TimeoutError()
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+                
+                for task in done:
+                    if task.exception() is None:
+                        # 只统计获得调度名额之后的耗时
+                        self._latencies.append(loop.time() - (started.result() if started.done() else start_time))
+                        if task is hedge_task:
+                            self.hedge_wins += 1
+                            global_metrics.increment("llm.hedge.won")
+                        return task.result()
+                    error = task.exception()
+            
+            raise error
+        except asyncio.TimeoutError:
+            self.deadline_exceeded += 1
+            global_metrics.increment("llm.deadline_exceeded")
+            raise
+        finally:
+            for task in (primary, hedge_task):
+                if task and not task.done():
+                    task.cancel()
+            started.cancel()
+    
     async def chat_completion_stream(
         self,
         messages: List[Dict[str, str]],
@@ -102,24 +396,118 @@ class OpenAIService:
         """
         model = model or self.model
         
-        stream = await self.client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            stream=True
+        if not self.coalesce:
+            async for chunk in self._stream_upstream(messages, model, temperature, max_tokens):
+                yield chunk
+            return
+        
+        key = self.request_key(
+            messages, model=model, temperature=temperature, max_tokens=max_tokens, stream=True,
+            priority=current_llm_priority.get().name
         )
+        flight = self._inflight_streams.get(key)
+        if flight is None:
+            flight = _StreamFlight()
+            flight.task = asyncio.ensure_future(
+                self._produce_stream(key, flight, messages, model, temperature, max_tokens)
+            )
+            self._inflight_streams[key] = flight
+        else:
+            self.coalesced_requests += 1
+        
+        # 后加入的订阅者先补发已收到的片段，再等待新片段
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                if index < len(flight.chunks):
+                    index += 1
+                    yield flight.chunks[index - 1]
+                    continue
+                if flight.done:
+                    if flight.error:
+                        raise flight.error
+                    return
+                async with flight.changed:
+                    await flight.changed.wait_for(
+                        lambda: len(flight.chunks) > index or flight.done
+                    )
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                flight.task.cancel()
+    
+    async def _produce_stream(
+        self,
+        key: str,
+        flight: _StreamFlight,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: Optional[int]
+    ):
+        """读取上游流式响应并通知所有订阅者"""
+        try:
+            async for chunk in self._stream_upstream(messages, model, temperature, max_tokens):
+                flight.chunks.append(chunk)
+                async with flight.changed:
+                    flight.changed.notify_all()
+        except BaseException as e:
+            flight.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            flight.done = True
+            self._inflight_streams.pop(key, None)
+            async with flight.changed:
+                flight.changed.notify_all()
+    
+    async def _stream_upstream(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        temperature: float,
+        max_tokens: Optional[int]
+    ) -> AsyncIterator[str]:
+        """向上游发起流式请求，读取完整个流之前一直占用调度名额"""
+        async with self._slot():
+            self.upstream_requests += 1
+            stream = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            
+            async for chunk in stream:
+                if chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    
+    def get_stats(self) -> Dict[str, int]:
+        """
+        获取请求统计（合并、对冲、超时）
         
-        async for chunk in stream:
-            if chunk.choices[0].delta.content:
-                yield chunk.choices[0].delta.content
+        Returns:
+            统计信息字典
+        """
+        return {
+            "upstream_requests": self.upstream_requests,
+            "coalesced_requests": self.coalesced_requests,
+            "inflight": len(self._inflight) + len(self._inflight_streams),
+            "hedged_requests": self.hedged_requests,
+            "hedge_wins": self.hedge_wins,
+            "hedge_delay": self.hedge_delay(),
+            "deadline_exceeded": self.deadline_exceeded
+        }
     
     async def simple_chat(
         self,
         prompt: str,
         system_prompt: Optional[str] = None,
         model: Optional[str] = None,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        priority: Optional[LLMPriority] = None
     ) -> str:
         """
         简单聊天（单轮对话）
@@ -129,6 +517,7 @@ class OpenAIService:
             system_prompt: 系统提示
             model: 模型名称
             temperature: 温度参数
+            priority: 调度优先级
             
         Returns:
             模型回复
@@ -143,12 +532,13 @@ class OpenAIService:
         response = await self.chat_completion(
             messages=messages,
             model=model,
-            temperature=temperature
+            temperature=temperature,
+            priority=priority
         )
         
         return response["content"]
 
 
 # 全局实例
-openai_service = OpenAIService() if settings.openai_api_key else None
+openai_service = OpenAIService(scheduler=llm_scheduler) if settings.openai_api_key else None
 
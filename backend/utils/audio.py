@@ -2,7 +2,7 @@
 音频处理工具
 """
 import numpy as np
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Dict
 import struct
 
 
@@ -46,6 +46,24 @@ class AudioProcessor:
         """
         return audio_array.astype(np.int16).tobytes()
     
+    def downmix_to_mono(self, audio_bytes: bytes, channels: int) -> bytes:
+        """
+        将交错的多声道 PCM 混合为单声道
+        
+        Args:
+            audio_bytes: 交错排列的 16-bit little-endian PCM 字节流
+            channels: 声道数
+            
+        Returns:
+            单声道 PCM 字节流
+        """
+        if channels <= 1:
+            return audio_bytes
+        
+        frames = np.frombuffer(audio_bytes, dtype='<i2').reshape(-1, channels)
+        mono = frames.mean(axis=1, dtype=np.float32)
+        return mono.astype('<i2').tobytes()
+    
     def normalize_volume(self, audio_array: np.ndarray, target_db: float = -20.0) -> np.ndarray:
         """
         音量归一化
@@ -155,6 +173,194 @@ class AudioProcessor:
         return resampled.astype(np.int16)
 
 
+class AudioRingBuffer:
+    """
+    固定容量的 PCM 环形缓冲区
+    
+    按采样点的绝对位置寻址，只保留最近 capacity 个采样点。
+    """
+    
+    def __init__(self, capacity: int):
+        """
+        初始化环形缓冲区
+        
+        Args:
+            capacity: 容量（采样点数）
+        """
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.end = 0  # 已写入的采样点总数
+    
+    @property
+    def start(self) -> int:
+        """仍保留在缓冲区中的最早采样点位置"""
+        return max(0, self.end - self.capacity)
+    
+    def write(self, samples: np.ndarray) -> None:
+        """
+        写入采样点，超出容量时覆盖最旧的数据
+        
+        Args:
+            samples: int16 采样点
+        """
+        n = len(samples)
+        if n == 0:
+            return
+        
+        skip = max(0, n - self.capacity)
+        samples = samples[skip:]
+        pos = (self.end + skip) % self.capacity
+        first = min(self.capacity - pos, len(samples))
+        
+        self.buffer[pos:pos + first] = samples[:first]
+        self.buffer[:len(samples) - first] = samples[first:]
+        self.end += n
+    
+    def read(self, from_pos: int) -> np.ndarray:
+        """
+        读取从指定位置到最新的采样点
+        
+        Args:
+            from_pos: 起始绝对位置，早于缓冲区起点时从起点读取
+            
+        Returns:
+            采样点副本
+        """
+        from_pos = max(from_pos, self.start)
+        n = self.end - from_pos
+        if n <= 0:
+            return np.zeros(0, dtype=np.int16)
+        
+        pos = from_pos % self.capacity
+        first = min(self.capacity - pos, n)
+        return np.concatenate((self.buffer[pos:pos + first], self.buffer[:n - first]))
+    
+    def clear(self) -> None:
+        """清空缓冲区"""
+        self.end = 0
+
+
+class StreamingVAD:
+    """
+    流式语音活动检测（能量 + 过零率）
+    
+    按固定时长分帧并向量化计算，只放行语音帧及其前后的预录/拖尾帧，
+    用于在上传 ASR 前跳过长时间静音。
+    """
+    
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        frame_ms: int = 20,
+        energy_threshold: float = 0.01,
+        zcr_threshold: float = 0.25,
+        hangover_ms: int = 800,
+        preroll_ms: int = 200
+    ):
+        """
+        初始化 VAD
+        
+        Args:
+            sample_rate: 采样率
+            frame_ms: 帧长（毫秒），建议 10-30
+            energy_threshold: RMS 能量阈值（0-1）
+            zcr_threshold: 过零率阈值，用于捕获能量较低的清辅音
+            hangover_ms: 语音结束后继续放行的时长（毫秒），需覆盖上游 VAD 的断句静音时长
+            preroll_ms: 语音开始前补发的时长（毫秒），避免截掉起始音
+        """
+        self.frame_samples = sample_rate * frame_ms // 1000
+        self.energy_threshold = energy_threshold
+        self.zcr_threshold = zcr_threshold
+        self.hangover_frames = hangover_ms // frame_ms
+        self.preroll_frames = preroll_ms // frame_ms
+        
+        self._remainder = b""
+        self._preroll = np.zeros((0, self.frame_samples), dtype=np.int16)
+        self._last_speech = -(self.hangover_frames + 1)  # 相对当前块起点的最近语音帧
+        
+        self.frames_total = 0
+        self.frames_sent = 0
+    
+    def classify(self, frames: np.ndarray) -> np.ndarray:
+        """
+        判断每一帧是否为语音
+        
+        Args:
+            frames: 形状为 (帧数, 每帧采样数) 的 int16 数组
+            
+        Returns:
+            每帧是否为语音的布尔数组
+        """
+        x = frames.astype(np.float32) / 32768.0
+        rms = np.sqrt(np.mean(x * x, axis=1))
+        
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        
+        return (rms >= self.energy_threshold) | (
+            (rms >= self.energy_threshold / 2) & (zcr >= self.zcr_threshold)
+        )
+    
+    def process(self, audio_bytes: bytes) -> bytes:
+        """
+        处理一段 PCM，返回需要上传的部分
+        
+        Args:
+            audio_bytes: 16-bit little-endian 单声道 PCM
+            
+        Returns:
+            需要上传的 PCM（可能为空）
+        """
+        data = self._remainder + audio_bytes
+        frame_bytes = self.frame_samples * 2
+        n = len(data) // frame_bytes
+        self._remainder = data[n * frame_bytes:]
+        if n == 0:
+            return b""
+        
+        frames = np.frombuffer(data, dtype='<i2', count=n * self.frame_samples)
+        frames = frames.reshape(n, self.frame_samples)
+        speech = self.classify(frames)
+        
+        # 拖尾：距最近语音帧不超过 hangover 帧的都视为活动
+        idx = np.arange(n)
+        last = np.maximum.accumulate(np.where(speech, idx, self._last_speech))
+        active = (idx - last) <= self.hangover_frames
+        self._last_speech = max(int(last[-1]) - n, -(self.hangover_frames + 1))
+        
+        # 预录：活动帧之前的 preroll 帧一并放行
+        p = len(self._preroll)
+        m = p + n
+        all_frames = np.concatenate((self._preroll, frames))
+        active = np.concatenate((np.zeros(p, dtype=bool), active))
+        idx = np.arange(m)
+        next_active = np.where(active, idx, m + self.preroll_frames + 1)
+        next_active = np.minimum.accumulate(next_active[::-1])[::-1]
+        send = (next_active - idx) <= self.preroll_frames
+        
+        # 未放行的尾部帧留作下一次的预录
+        sent = np.flatnonzero(send)
+        tail_start = int(sent[-1]) + 1 if len(sent) else 0
+        self._preroll = all_frames[max(tail_start, m - self.preroll_frames):]
+        
+        self.frames_total += n
+        self.frames_sent += len(sent)
+        return all_frames[send].tobytes()
+    
+    def get_stats(self) -> Dict[str, float]:
+        """
+        获取统计信息
+        
+        Returns:
+            统计信息字典
+        """
+        return {
+            "frames_total": self.frames_total,
+            "frames_sent": self.frames_sent,
+            "sent_ratio": self.frames_sent / self.frames_total if self.frames_total else 0
+        }
+
+
 # 全局实例
 audio_processor = AudioProcessor()
 
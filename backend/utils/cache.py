@@ -1,28 +1,163 @@
 """
 缓存管理模块
-提供简单的内存缓存功能
+提供分片的内存缓存，按 LRU 和 TTL 淘汰，限制条目数和内存占用
 """
+import asyncio
+import sys
+import threading
 import time
-from typing import Any, Optional, Dict, Tuple
+from collections import OrderedDict
+from itertools import islice
+from dataclasses import dataclass, fields, is_dataclass
+from typing import Any, Callable, Optional, Dict, Tuple
 from functools import wraps
 import hashlib
 import json
+from backend.utils.logger import get_logger
+from config.settings import settings
 
+logger = get_logger(__name__)
 
-class SimpleCache:
-    """简单的内存缓存"""
+# 超出容量时先检查最久未使用的几个条目，有过期的优先清理
+_EVICTION_SAMPLE = 5
+
+# 装饰器缓存键超过该长度时取哈希，避免长参数占用过多内存
+_MAX_RAW_KEY_LENGTH = 200
+
+
+def estimate_size(value: Any, _depth: int = 0) -> int:
+    """
+    估算对象占用的内存（字节），递归统计常见容器和 dataclass 实例的字段
+    
+    Args:
+        value: 对象
+        
+    Returns:
+        估算的字节数
+    """
+    size = sys.getsizeof(value)
+    if _depth >= 4:
+        return size
+    if isinstance(value, dict):
+        size += sum(
+            estimate_size(k, _depth + 1) + estimate_size(v, _depth + 1)
+            for k, v in value.items()
+        )
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, _depth + 1) for item in value)
+    elif is_dataclass(value) and not isinstance(value, type):
+        # 装饰器缓存的 _CachedValue 等包装对象，按其字段计算
+        size += sum(estimate_size(getattr(value, f.name), _depth + 1) for f in fields(value))
+    return size
+
+
+@dataclass
+class CacheEntry:
+    """缓存条目"""
+    value: Any
+    expire_time: float
+    size: int
+
+
+class _Shard:
+    """缓存分片，各分片使用独立的锁"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+    
+    def remove(self, key: str) -> CacheEntry:
+        """删除条目并更新内存占用（调用方持有锁）"""
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
+        return entry
+
+
+class LRUCache:
+    """
+    分片的内存缓存
     
-    def __init__(self, default_ttl: int = 300):
+    键按哈希分布到多个分片，每个分片一把锁，线程池中的调用方不会互相阻塞。
+    每个分片按最近使用顺序保存条目；超过条目数或内存预算时，先清理最久未使用
+    条目中已过期的，再淘汰最久未使用的条目。过期条目在读取时或由后台清理任务删除。
+    """
+    
+    def __init__(
+        self,
+        default_ttl: int = 300,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+        num_shards: int = 8,
+        sweep_interval: float = 60.0
+    ):
         """
         初始化缓存
         
         Args:
             default_ttl: 默认过期时间（秒）
+            max_entries: 最大条目数
+            max_bytes: 近似最大内存占用（字节）
+            num_shards: 分片数
+            sweep_interval: 后台清理过期条目的间隔（秒）
         """
-        self.cache: Dict[str, Tuple[Any, float]] = {}
         self.default_ttl = default_ttl
-        self.hits = 0
-        self.misses = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.num_shards = max(1, num_shards)
+        self.sweep_interval = sweep_interval
+        
+        # 预算平均分配到各分片
+        self._shard_max_entries = max(1, -(-max_entries // self.num_shards))
+        self._shard_max_bytes = max(1, max_bytes // self.num_shards)
+        self._shards = [_Shard() for _ in range(self.num_shards)]
+        self._sweeper: Optional[asyncio.Task] = None
+        self.sweeps = 0
+    
+    def _shard(self, key: str) -> _Shard:
+        """键所在的分片"""
+        return self._shards[hash(key) % self.num_shards]
+    
+    @property
+    def cache(self) -> Dict[str, Tuple[Any, float]]:
+        """所有条目的快照：键 -> (值, 过期时间)"""
+        snapshot = {}
+        for shard in self._shards:
+            with shard.lock:
+                snapshot.update(
+                    (key, (entry.value, entry.expire_time))
+                    for key, entry in shard.entries.items()
+                )
+        return snapshot
+    
+    def __len__(self) -> int:
+        """条目数"""
+        return sum(len(shard.entries) for shard in self._shards)
+    
+    @property
+    def hits(self) -> int:
+        """命中次数"""
+        return sum(shard.hits for shard in self._shards)
+    
+    @property
+    def misses(self) -> int:
+        """未命中次数"""
+        return sum(shard.misses for shard in self._shards)
+    
+    @property
+    def evictions(self) -> int:
+        """因超出容量淘汰的条目数"""
+        return sum(shard.evictions for shard in self._shards)
+    
+    @property
+    def expirations(self) -> int:
+        """因过期删除的条目数"""
+        return sum(shard.expirations for shard in self._shards)
     
     def get(self, key: str) -> Optional[Any]:
         """
@@ -34,20 +169,23 @@ class SimpleCache:
         Returns:
             缓存值，如果不存在或已过期返回 None
         """
-        if key not in self.cache:
-            self.misses += 1
-            return None
-        
-        value, expire_time = self.cache[key]
-        
-        # 检查是否过期
-        if time.time() > expire_time:
-            del self.cache[key]
-            self.misses += 1
-            return None
-        
-        self.hits += 1
-        return value
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                shard.misses += 1
+                return None
+            
+            # 检查是否过期
+            if time.time() > entry.expire_time:
+                shard.remove(key)
+                shard.expirations += 1
+                shard.misses += 1
+                return None
+            
+            shard.entries.move_to_end(key)
+            shard.hits += 1
+            return entry.value
     
     def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
         """
@@ -59,8 +197,38 @@ class SimpleCache:
             ttl: 过期时间（秒），如果不指定使用默认值
         """
         ttl = ttl if ttl is not None else self.default_ttl
-        expire_time = time.time() + ttl
-        self.cache[key] = (value, expire_time)
+        now = time.time()
+        size = estimate_size(key) + estimate_size(value)
+        
+        shard = self._shard(key)
+        with shard.lock:
+            if key in shard.entries:
+                shard.remove(key)
+            
+            # 单个条目超过分片预算时不缓存
+            if size > self._shard_max_bytes:
+                shard.rejected += 1
+                return
+            
+            shard.entries[key] = CacheEntry(value=value, expire_time=now + ttl, size=size)
+            shard.bytes += size
+            self._evict(shard, now)
+    
+    def _evict(self, shard: _Shard, now: float) -> None:
+        """超出预算时淘汰条目（调用方持有锁）"""
+        while len(shard.entries) > self._shard_max_entries or shard.bytes > self._shard_max_bytes:
+            expired = [
+                key for key, entry in islice(shard.entries.items(), _EVICTION_SAMPLE)
+                if now > entry.expire_time
+            ]
+            if expired:
+                for key in expired:
+                    shard.remove(key)
+                    shard.expirations += 1
+                continue
+            
+            shard.remove(next(iter(shard.entries)))
+            shard.evictions += 1
     
     def delete(self, key: str) -> bool:
         """
@@ -72,16 +240,24 @@ class SimpleCache:
         Returns:
             是否删除成功
         """
-        if key in self.cache:
-            del self.cache[key]
-            return True
-        return False
+        shard = self._shard(key)
+        with shard.lock:
+            if key in shard.entries:
+                shard.remove(key)
+                return True
+            return False
     
     def clear(self) -> None:
         """清空所有缓存"""
-        self.cache.clear()
-        self.hits = 0
-        self.misses = 0
+        for shard in self._shards:
+            with shard.lock:
+                shard.entries.clear()
+                shard.bytes = 0
+                shard.hits = 0
+                shard.misses = 0
+                shard.evictions = 0
+                shard.expirations = 0
+                shard.rejected = 0
     
     def cleanup(self) -> int:
         """
@@ -91,15 +267,48 @@ class SimpleCache:
             清理的缓存数量
         """
         current_time = time.time()
-        expired_keys = [
-            key for key, (_, expire_time) in self.cache.items()
-            if current_time > expire_time
-        ]
-        
-        for key in expired_keys:
-            del self.cache[key]
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                expired_keys = [
+                    key for key, entry in shard.entries.items()
+                    if current_time > entry.expire_time
+                ]
+                for key in expired_keys:
+                    shard.remove(key)
+                shard.expirations += len(expired_keys)
+                removed += len(expired_keys)
+        return removed
+    
+    async def _sweep_loop(self) -> None:
+        """定期清理过期条目"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            removed = self.cleanup()
+            self.sweeps += 1
+            if removed:
+                logger.debug(f"清理过期缓存 {removed} 条")
+    
+    def start_sweeper(self) -> asyncio.Task:
+        """
+        启动后台清理任务
         
-        return len(expired_keys)
+        Returns:
+            清理任务
+        """
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+        return self._sweeper
+    
+    async def stop_sweeper(self) -> None:
+        """停止后台清理任务"""
+        if self._sweeper and not self._sweeper.done():
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+        self._sweeper = None
     
     def get_stats(self) -> Dict[str, Any]:
         """
@@ -108,18 +317,32 @@ class SimpleCache:
         Returns:
             统计信息字典
         """
-        total_requests = self.hits + self.misses
-        hit_rate = self.hits / total_requests if total_requests > 0 else 0
+        hits = self.hits
+        misses = self.misses
+        total_requests = hits + misses
+        hit_rate = hits / total_requests if total_requests > 0 else 0
         
         return {
-            "size": len(self.cache),
-            "hits": self.hits,
-            "misses": self.misses,
+            "size": len(self),
+            "bytes": sum(shard.bytes for shard in self._shards),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "shards": self.num_shards,
+            "hits": hits,
+            "misses": misses,
             "hit_rate": hit_rate,
-            "total_requests": total_requests
+            "total_requests": total_requests,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "rejected": sum(shard.rejected for shard in self._shards),
+            "sweeps": self.sweeps
         }
 
 
+# 兼容原有名称
+SimpleCache = LRUCache
+
+
 def cache_key(*args, **kwargs) -> str:
     """
     生成缓存键
@@ -142,43 +365,143 @@ def cache_key(*args, **kwargs) -> str:
     return hashlib.md5(key_str.encode()).hexdigest()
 
 
-def cached(ttl: int = 300, cache_instance: Optional[SimpleCache] = None):
+def fast_cache_key(*args, **kwargs) -> str:
     """
-    缓存装饰器
+    生成缓存键（不序列化为 JSON，参数较短时直接使用 repr）
+    
+    Args:
+        *args: 位置参数
+        **kwargs: 关键字参数
+        
+    Returns:
+        缓存键
+    """
+    key_str = repr((args, sorted(kwargs.items()))) if kwargs else repr(args)
+    if len(key_str) <= _MAX_RAW_KEY_LENGTH:
+        return key_str
+    return hashlib.blake2b(key_str.encode(), digest_size=16).hexdigest()
+
+
+@dataclass
+class _CachedValue:
+    """装饰器缓存的值，fresh_until 之后为过期但仍可返回的旧值"""
+    value: Any
+    fresh_until: float
+
+
+def cached(
+    ttl: int = 300,
+    cache_instance: Optional[LRUCache] = None,
+    stale_ttl: float = 0,
+    key_func: Optional[Callable[..., str]] = None
+):
+    """
+    缓存装饰器，支持普通函数和协程函数
+    
+    同一个键同时未命中时只计算一次，其余调用方等待同一个结果；
+    设置 stale_ttl 时，过期后的 stale_ttl 秒内先返回旧值，并在后台刷新（仅协程函数）。
+    计算出错时不缓存，异常抛给所有等待的调用方。
     
     Args:
         ttl: 缓存过期时间（秒）
         cache_instance: 缓存实例，如果不指定使用全局缓存
+        stale_ttl: 过期后仍可返回旧值的时间（秒）
+        key_func: 生成缓存键的函数，不指定时使用 fast_cache_key
         
     Returns:
         装饰器函数
     """
-    _cache = cache_instance or global_cache
+    _cache = cache_instance if cache_instance is not None else global_cache
+    make_key = key_func or fast_cache_key
     
     def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            # 生成缓存键
-            key = f"{func.__module__}.{func.__name__}:{cache_key(*args, **kwargs)}"
+        prefix = f"{func.__module__}.{func.__qualname__}:"
+        
+        def store(key: str, value: Any) -> None:
+            _cache.set(key, _CachedValue(value, time.time() + ttl), ttl + stale_ttl)
+        
+        def invalidate(*args, **kwargs) -> bool:
+            """删除指定参数的缓存结果"""
+            return _cache.delete(prefix + make_key(*args, **kwargs))
+        
+        if asyncio.iscoroutinefunction(func):
+            inflight: Dict[str, asyncio.Task] = {}
             
-            # 尝试从缓存获取
-            cached_value = _cache.get(key)
-            if cached_value is not None:
-                return cached_value
+            async def compute(key: str, args, kwargs) -> Any:
+                result = await func(*args, **kwargs)
+                store(key, result)
+                return result
             
-            # 执行函数
-            result = func(*args, **kwargs)
+            def start(key: str, args, kwargs) -> asyncio.Task:
+                task = inflight.get(key)
+                if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+                    task = asyncio.create_task(compute(key, args, kwargs))
+                    inflight[key] = task
+                    task.add_done_callback(lambda t: _finish_compute(inflight, key, t))
+                return task
             
-            # 存入缓存
-            _cache.set(key, result, ttl)
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = prefix + make_key(*args, **kwargs)
+                entry = _cache.get(key)
+                if entry is not None:
+                    if time.time() >= entry.fresh_until:
+                        # 旧值先返回，后台刷新
+                        start(key, args, kwargs)
+                    return entry.value
+                
+                # 调用方取消时不影响其他等待同一结果的调用方
+                return await asyncio.shield(start(key, args, kwargs))
             
-            return result
+            async_wrapper.invalidate = invalidate
+            return async_wrapper
+        
+        locks: Dict[str, threading.Lock] = {}
+        locks_guard = threading.Lock()
         
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = prefix + make_key(*args, **kwargs)
+            entry = _cache.get(key)
+            if entry is not None and time.time() < entry.fresh_until:
+                return entry.value
+            
+            with locks_guard:
+                lock = locks.setdefault(key, threading.Lock())
+            try:
+                with lock:
+                    # 等待期间其他线程可能已经算好
+                    entry = _cache.get(key)
+                    if entry is not None and time.time() < entry.fresh_until:
+                        return entry.value
+                    result = func(*args, **kwargs)
+                    store(key, result)
+                    return result
+            finally:
+                with locks_guard:
+                    if locks.get(key) is lock and not lock.locked():
+                        del locks[key]
+        
+        wrapper.invalidate = invalidate
         return wrapper
     
     return decorator
 
 
+def _finish_compute(inflight: Dict[str, asyncio.Task], key: str, task: asyncio.Task) -> None:
+    """计算结束后移出进行中的列表，计算失败时记录日志"""
+    if inflight.get(key) is task:
+        del inflight[key]
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"缓存计算失败 {key}: {task.exception()}")
+
+
 # 全局缓存实例
-global_cache = SimpleCache(default_ttl=300)
+global_cache = LRUCache(
+    default_ttl=300,
+    max_entries=settings.cache_max_entries,
+    max_bytes=settings.cache_max_bytes,
+    num_shards=settings.cache_shards,
+    sweep_interval=settings.cache_sweep_interval
+)
 
@@ -1,21 +1,52 @@
 """
 日志配置模块
 提供结构化日志功能
+
+日志记录在调用线程中只做过滤和合并消息参数，然后放入队列，
+由后台线程格式化为 JSON 并写入控制台和文件，避免阻塞事件循环；
+高频调用位置的普通日志按速率限流。
 """
+import atexit
+import copy
 import logging
+import queue
 import sys
+import threading
+import time
 from datetime import datetime
-from typing import Optional
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
 import json
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson 为可选依赖
+    orjson = None
+
+
+def dumps(data: Dict) -> str:
+    """
+    序列化为 JSON，安装了 orjson 时使用 orjson
+    
+    Args:
+        data: 日志字段
+        
+    Returns:
+        JSON 字符串（保留非 ASCII 字符）
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=str).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, default=str)
+
 
 class StructuredFormatter(logging.Formatter):
     """结构化日志格式化器"""
     
     def format(self, record: logging.LogRecord) -> str:
         """格式化日志记录为 JSON"""
+        # 在后台线程格式化时，时间取记录产生的时刻
         log_data = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.fromtimestamp(record.created).isoformat(),
             "level": record.levelname,
             "logger": record.name,
             "message": record.getMessage(),
@@ -31,16 +62,128 @@ class StructuredFormatter(logging.Formatter):
         if hasattr(record, "user_id"):
             log_data["user_id"] = record.user_id
         
+        if getattr(record, "suppressed", 0):
+            log_data["suppressed"] = record.suppressed
+        
         if record.exc_info:
             log_data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # 放入队列前已转换为文本
+            log_data["exception"] = record.exc_text
         
-        return json.dumps(log_data, ensure_ascii=False)
+        return dumps(log_data)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    高频日志限流
+    
+    每个调用位置（文件 + 行号）一个令牌桶，WARNING 以下的日志超过速率时丢弃；
+    下一条通过的日志带上 suppressed 字段，记录期间丢弃的条数。
+    """
+    
+    def __init__(self, rate: float = 20.0, burst: int = 50, min_level: int = logging.WARNING):
+        """
+        初始化过滤器
+        
+        Args:
+            rate: 每个调用位置每秒允许的日志条数
+            burst: 允许的突发条数
+            min_level: 不限流的最低级别
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.min_level = min_level
+        self._buckets: Dict[Tuple[str, int], list] = {}  # 调用位置 -> [令牌数, 上次更新时间, 丢弃条数]
+        self._lock = threading.Lock()
+        self.dropped = 0
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.min_level:
+            return True
+        
+        now = time.monotonic()
+        site = (record.pathname, record.lineno)
+        with self._lock:
+            bucket = self._buckets.get(site)
+            if bucket is None:
+                bucket = self._buckets[site] = [float(self.burst), now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.dropped += 1
+                return False
+            bucket[0] = tokens - 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    放入有界队列的日志处理器
+    
+    只在调用线程中合并消息参数和转换异常堆栈，格式化由后台线程完成；
+    队列满时直接丢弃并计数，不阻塞调用方。
+    """
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """合并消息参数，异常转为文本，避免在后台线程访问调用方的可变对象"""
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(QueueListener):
+    """后台写日志的线程，停止时等待队列中的日志写完"""
+    
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+# 当前运行的后台写日志线程
+_listener: Optional[_Listener] = None
+
+
+def stop_logging() -> None:
+    """停止后台写日志线程，写完队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
 
 
 def setup_logging(
     level: str = "INFO",
     log_file: Optional[str] = None,
-    structured: bool = True
+    structured: bool = True,
+    queued: bool = False,
+    queue_size: int = 10000,
+    rate_limit: Optional[float] = None,
+    burst: int = 50
 ) -> None:
     """
     配置日志系统
@@ -49,13 +192,21 @@ def setup_logging(
         level: 日志级别
         log_file: 日志文件路径（可选）
         structured: 是否使用结构化日志
+        queued: 是否经队列由后台线程写日志
+        queue_size: 队列容量，队列满时丢弃新日志
+        rate_limit: 每个调用位置每秒最多的普通日志条数，为 None 时不限流
+        burst: 限流允许的突发条数
     """
+    global _listener
+    
     # 创建根日志器
     root_logger = logging.getLogger()
     root_logger.setLevel(getattr(logging, level.upper()))
     
     # 清除现有处理器
+    stop_logging()
     root_logger.handlers.clear()
+    handlers = []
     
     # 控制台处理器
     console_handler = logging.StreamHandler(sys.stdout)
@@ -70,7 +221,7 @@ def setup_logging(
             )
         )
     
-    root_logger.addHandler(console_handler)
+    handlers.append(console_handler)
     
     # 文件处理器（如果指定）
     if log_file:
@@ -86,7 +237,20 @@ def setup_logging(
                 )
             )
         
-        root_logger.addHandler(file_handler)
+        handlers.append(file_handler)
+    
+    if queued:
+        log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        _listener = _Listener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        handlers = [NonBlockingQueueHandler(log_queue)]
+    
+    if rate_limit is not None:
+        for handler in handlers:
+            handler.addFilter(RateLimitFilter(rate=rate_limit, burst=burst))
+    
+    for handler in handlers:
+        root_logger.addHandler(handler)
 
 
 def get_logger(name: str) -> logging.Logger:
@@ -1,12 +1,122 @@
 """
 性能监控模块
 提供性能指标收集和统计功能
+
+数值分布使用对数线性分桶的直方图（HDR 风格）按时间片滚动统计，记录开销为 O(1)，
+统计开销只与桶数有关，与样本数无关；计数器和仪表盘作为独立的指标类型。
 """
+import math
+import re
+import threading
 import time
-from typing import Dict, List, Optional
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
 from dataclasses import dataclass, field
 from datetime import datetime
-import statistics
+
+
+# 每个 2 的幂区间线性划分的子桶数，相对误差不超过 1/(2 * _SUB_BUCKETS)
+_SUB_BUCKETS = 16
+# 覆盖的指数范围，约 1e-9 到 1e19
+_MIN_EXP = -30
+_MAX_EXP = 64
+# 小于等于 0 的值单独计数
+_ZERO_BUCKET = -1
+
+# 导出 OpenMetrics 时的桶边界：约 1ms 到 1024，每个 2 的幂区间 4 个桶
+_EXPORT_MIN_EXP = -9
+_EXPORT_MAX_EXP = 10
+_EXPORT_BUCKETS_PER_OCTAVE = 4
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+_INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_:]")
+_INF_LABEL = 'le="+Inf"'
+
+TagsKey = Tuple[Tuple[str, str], ...]
+
+
+def _bucket_index(value: float) -> int:
+    """值所在的桶编号，桶为左开右闭区间，与 OpenMetrics 的 le 语义一致"""
+    if value <= 0:
+        return _ZERO_BUCKET
+    mantissa, exponent = math.frexp(value)  # value = mantissa * 2 ** exponent，mantissa ∈ [0.5, 1)
+    sub_bucket = math.ceil((mantissa - 0.5) * 2 * _SUB_BUCKETS) - 1
+    if sub_bucket < 0:
+        # 恰好是 2 的幂，属于上一段的最后一个桶
+        exponent -= 1
+        sub_bucket = _SUB_BUCKETS - 1
+    if exponent < _MIN_EXP:
+        return 0
+    if exponent > _MAX_EXP:
+        return (_MAX_EXP - _MIN_EXP + 1) * _SUB_BUCKETS - 1
+    return (exponent - _MIN_EXP) * _SUB_BUCKETS + sub_bucket
+
+
+def _bucket_value(index: int) -> float:
+    """桶的代表值（区间中点）"""
+    if index == _ZERO_BUCKET:
+        return 0.0
+    exponent, sub_bucket = divmod(index, _SUB_BUCKETS)
+    return math.ldexp(0.5 + (sub_bucket + 0.5) / (2 * _SUB_BUCKETS), exponent + _MIN_EXP)
+
+
+def bucket_upper_bound(index: int) -> float:
+    """
+    桶的上界
+    
+    Args:
+        index: 桶编号
+        
+    Returns:
+        上界值
+    """
+    if index == _ZERO_BUCKET:
+        return 0.0
+    exponent, sub_bucket = divmod(index, _SUB_BUCKETS)
+    return math.ldexp(0.5 + (sub_bucket + 1) / (2 * _SUB_BUCKETS), exponent + _MIN_EXP)
+
+
+def _metric_name(name: str) -> str:
+    """指标名转为 OpenMetrics 合法名称（点号等替换为下划线）"""
+    name = _INVALID_NAME_CHARS.sub("_", name)
+    return f"_{name}" if name[:1].isdigit() else name
+
+
+def _label_value(value: str) -> str:
+    """转义标签值"""
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(key: "TagsKey", extra: str = "") -> str:
+    """
+    生成标签文本
+
+    Args:
+        key: 标签键
+        extra: 额外的标签（如 le），已格式化
+
+    Returns:
+        形如 {a="1",le="0.5"} 的文本，没有标签时为空
+    """
+    parts = [f'{_metric_name(k)}="{_label_value(v)}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    """格式化数值，整数不带小数点"""
+    if isinstance(value, int) or (isinstance(value, float) and value.is_integer()):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _tags_key(tags: Optional[Dict[str, str]]) -> TagsKey:
+    """标签字典转为可哈希的键"""
+    if not tags:
+        return ()
+    return tuple(sorted((str(k), str(v)) for k, v in tags.items()))
 
 
 @dataclass
@@ -18,18 +128,228 @@ class Metric:
     tags: Dict[str, str] = field(default_factory=dict)
 
 
+class Histogram:
+    """
+    对数线性分桶直方图
+    
+    桶按 2 的幂分段、段内线性划分，分位数的相对误差约 3%；
+    计数、总和、最小值和最大值精确记录。两个直方图可以直接合并。
+    """
+    
+    __slots__ = ("counts", "count", "total", "sum_squares", "min", "max")
+    
+    def __init__(self):
+        """初始化直方图"""
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.sum_squares = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+    
+    def record(self, value: float) -> None:
+        """
+        记录一个值
+        
+        Args:
+            value: 指标值
+        """
+        index = _bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.sum_squares += value * value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+    
+    def merge(self, other: "Histogram") -> "Histogram":
+        """
+        合并另一个直方图
+        
+        Args:
+            other: 另一个直方图
+            
+        Returns:
+            合并后的自身
+        """
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.sum_squares += other.sum_squares
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+    
+    def copy(self) -> "Histogram":
+        """
+        复制直方图
+        
+        Returns:
+            新的直方图
+        """
+        return Histogram().merge(self)
+    
+    def quantile(self, q: float) -> float:
+        """
+        估算分位数
+        
+        Args:
+            q: 分位点，0 到 1
+            
+        Returns:
+            分位数，没有样本时返回 0
+        """
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                return min(max(_bucket_value(index), self.min), self.max)
+        return self.max
+    
+    def export_buckets(self) -> List[Tuple[float, int]]:
+        """
+        按固定边界汇总的累计桶计数，用于 OpenMetrics 导出（不需要排序）
+        
+        Returns:
+            [(上界, 小于等于上界的样本数)]，不含 +Inf
+        """
+        step = _SUB_BUCKETS // _EXPORT_BUCKETS_PER_OCTAVE
+        first = (_EXPORT_MIN_EXP - _MIN_EXP) * _SUB_BUCKETS
+        last = (_EXPORT_MAX_EXP - _MIN_EXP + 1) * _SUB_BUCKETS - 1
+        groups = [0] * ((last - first + 1) // step)
+        below = 0
+        for index, count in self.counts.items():
+            if index < first:
+                below += count
+            elif index <= last:
+                groups[(index - first) // step] += count
+        
+        buckets = []
+        running = below
+        for group, count in enumerate(groups):
+            running += count
+            buckets.append((bucket_upper_bound(first + (group + 1) * step - 1), running))
+        return buckets
+    
+    def stats(self) -> Dict[str, float]:
+        """
+        汇总统计信息
+        
+        Returns:
+            统计信息字典，没有样本时返回空字典
+        """
+        if not self.count:
+            return {}
+        
+        mean = self.total / self.count
+        if self.count > 1:
+            variance = (self.sum_squares - self.total * mean) / (self.count - 1)
+            stdev = math.sqrt(max(variance, 0.0))
+        else:
+            stdev = 0
+        
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": mean,
+            "median": self.quantile(0.5),
+            "stdev": stdev,
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class RollingHistogram:
+    """
+    滚动时间窗口直方图
+    
+    按固定时长的时间片保存直方图，查询窗口时合并最近的若干个时间片；
+    另外保留一个累计直方图用于不限窗口的查询。
+    """
+    
+    def __init__(self, slot_seconds: float = 10.0, num_slots: int = 60):
+        """
+        初始化滚动直方图
+        
+        Args:
+            slot_seconds: 每个时间片的时长（秒）
+            num_slots: 时间片数量，slot_seconds * num_slots 为最长可查询窗口
+        """
+        self.slot_seconds = slot_seconds
+        self.num_slots = num_slots
+        self._slots: List[Optional[Histogram]] = [None] * num_slots
+        self._epochs: List[int] = [-1] * num_slots
+        self.cumulative = Histogram()
+    
+    def record(self, value: float, now: Optional[float] = None) -> None:
+        """
+        记录一个值
+        
+        Args:
+            value: 指标值
+            now: 当前时间戳，不指定时取系统时间
+        """
+        epoch = int((time.time() if now is None else now) // self.slot_seconds)
+        position = epoch % self.num_slots
+        if self._epochs[position] != epoch:
+            self._slots[position] = Histogram()
+            self._epochs[position] = epoch
+        self._slots[position].record(value)
+        self.cumulative.record(value)
+    
+    def snapshot(self, window_seconds: Optional[float] = None, now: Optional[float] = None) -> Histogram:
+        """
+        合并时间窗口内的直方图
+        
+        Args:
+            window_seconds: 时间窗口（秒），不指定时返回累计直方图
+            now: 当前时间戳，不指定时取系统时间
+            
+        Returns:
+            合并后的直方图（副本）
+        """
+        if not window_seconds:
+            return self.cumulative.copy()
+        
+        current = int((time.time() if now is None else now) // self.slot_seconds)
+        slots = min(self.num_slots, max(1, math.ceil(window_seconds / self.slot_seconds)))
+        merged = Histogram()
+        for epoch in range(current - slots + 1, current + 1):
+            position = epoch % self.num_slots
+            if self._epochs[position] == epoch:
+                merged.merge(self._slots[position])
+        return merged
+
+
 class MetricsCollector:
     """指标收集器"""
     
-    def __init__(self, max_history: int = 1000):
+    def __init__(self, max_history: int = 0, slot_seconds: float = 10.0, window_slots: int = 60):
         """
         初始化指标收集器
         
         Args:
-            max_history: 最大历史记录数
+            max_history: 每个指标保留的最近原始样本数，为 0 时不保留（默认）
+            slot_seconds: 滚动窗口的时间片时长（秒）
+            window_slots: 滚动窗口的时间片数量
         """
-        self.metrics: Dict[str, List[Metric]] = {}
+        # 最近的原始样本，仅在排查问题时开启，统计信息由直方图计算
+        self.metrics: Dict[str, Deque[Metric]] = {}
         self.max_history = max_history
+        self.slot_seconds = slot_seconds
+        self.window_slots = window_slots
+        
+        self.histograms: Dict[str, Dict[TagsKey, RollingHistogram]] = {}
+        self.counters: Dict[str, Dict[TagsKey, float]] = {}
+        self.gauges: Dict[str, Dict[TagsKey, float]] = {}
+        self._lock = threading.Lock()
     
     def record(self, name: str, value: float, tags: Optional[Dict[str, str]] = None) -> None:
         """
@@ -40,16 +360,91 @@ class MetricsCollector:
             value: 指标值
             tags: 标签
         """
-        metric = Metric(name=name, value=value, tags=tags or {})
+        key = _tags_key(tags)
+        now = time.time()
         
-        if name not in self.metrics:
-            self.metrics[name] = []
+        with self._lock:
+            if self.max_history:
+                samples = self.metrics.get(name)
+                if samples is None:
+                    samples = self.metrics[name] = deque(maxlen=self.max_history)
+                samples.append(Metric(name=name, value=value, timestamp=datetime.fromtimestamp(now), tags=tags or {}))
+            
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = RollingHistogram(self.slot_seconds, self.window_slots)
+            histogram.record(value, now)
+    
+    def increment(self, name: str, value: float = 1, tags: Optional[Dict[str, str]] = None) -> None:
+        """
+        累加计数器
+        
+        Args:
+            name: 计数器名称
+            value: 增量
+            tags: 标签
+        """
+        key = _tags_key(tags)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+    
+    def set_gauge(self, name: str, value: float, tags: Optional[Dict[str, str]] = None) -> None:
+        """
+        设置仪表盘当前值
+        
+        Args:
+            name: 仪表盘名称
+            value: 当前值
+            tags: 标签
+        """
+        with self._lock:
+            self.gauges.setdefault(name, {})[_tags_key(tags)] = value
+    
+    def snapshot(
+        self,
+        name: str,
+        window_seconds: Optional[int] = None,
+        tags: Optional[Dict[str, str]] = None
+    ) -> Histogram:
+        """
+        获取指标的直方图快照
         
-        self.metrics[name].append(metric)
+        Args:
+            name: 指标名称
+            window_seconds: 时间窗口（秒），如果不指定则统计所有
+            tags: 只合并包含这些标签的序列，不指定时合并全部
+            
+        Returns:
+            合并后的直方图
+        """
+        wanted = set(_tags_key(tags))
+        now = time.time()
+        merged = Histogram()
+        with self._lock:
+            for key, histogram in self.histograms.get(name, {}).items():
+                if wanted.issubset(key):
+                    merged.merge(histogram.snapshot(window_seconds, now))
+        return merged
+    
+    def series(self, name: str, window_seconds: Optional[int] = None) -> Dict[TagsKey, Histogram]:
+        """
+        获取指标各标签序列的直方图快照
         
-        # 限制历史记录数量
-        if len(self.metrics[name]) > self.max_history:
-            self.metrics[name] = self.metrics[name][-self.max_history:]
+        Args:
+            name: 指标名称
+            window_seconds: 时间窗口（秒），如果不指定则统计所有
+            
+        Returns:
+            标签 -> 直方图
+        """
+        now = time.time()
+        with self._lock:
+            return {
+                key: histogram.snapshot(window_seconds, now)
+                for key, histogram in self.histograms.get(name, {}).items()
+            }
     
     def get_stats(self, name: str, window_seconds: Optional[int] = None) -> Dict[str, float]:
         """
@@ -62,33 +457,7 @@ class MetricsCollector:
         Returns:
             统计信息字典
         """
-        if name not in self.metrics or not self.metrics[name]:
-            return {}
-        
-        # 过滤时间窗口
-        metrics = self.metrics[name]
-        if window_seconds:
-            cutoff_time = datetime.now().timestamp() - window_seconds
-            metrics = [
-                m for m in metrics
-                if m.timestamp.timestamp() > cutoff_time
-            ]
-        
-        if not metrics:
-            return {}
-        
-        values = [m.value for m in metrics]
-        
-        return {
-            "count": len(values),
-            "min": min(values),
-            "max": max(values),
-            "mean": statistics.mean(values),
-            "median": statistics.median(values),
-            "stdev": statistics.stdev(values) if len(values) > 1 else 0,
-            "p95": statistics.quantiles(values, n=20)[18] if len(values) > 1 else values[0],
-            "p99": statistics.quantiles(values, n=100)[98] if len(values) > 1 else values[0],
-        }
+        return self.snapshot(name, window_seconds).stats()
     
     def get_all_stats(self, window_seconds: Optional[int] = None) -> Dict[str, Dict[str, float]]:
         """
@@ -102,9 +471,94 @@ class MetricsCollector:
         """
         return {
             name: self.get_stats(name, window_seconds)
-            for name in self.metrics.keys()
+            for name in list(self.histograms.keys())
         }
     
+    def get_counters(self) -> Dict[str, float]:
+        """
+        获取所有计数器的值（各标签序列求和）
+        
+        Returns:
+            计数器名称 -> 值
+        """
+        with self._lock:
+            return {name: sum(series.values()) for name, series in self.counters.items()}
+    
+    def get_gauges(self) -> Dict[str, Dict[str, float]]:
+        """
+        获取所有仪表盘的当前值
+        
+        Returns:
+            仪表盘名称 -> {标签描述: 值}
+        """
+        with self._lock:
+            return {
+                name: {",".join(f"{k}={v}" for k, v in key): value for key, value in series.items()}
+                for name, series in self.gauges.items()
+            }
+    
+    def remove_series(self, tags: Dict[str, str]) -> int:
+        """
+        删除包含指定标签的所有序列（如会话结束后删除该会话的序列）
+        
+        Args:
+            tags: 标签
+            
+        Returns:
+            删除的序列数
+        """
+        wanted = set(_tags_key(tags))
+        removed = 0
+        with self._lock:
+            for store in (self.histograms, self.counters, self.gauges):
+                for name, series in list(store.items()):
+                    for key in [key for key in series if wanted.issubset(key)]:
+                        del series[key]
+                        removed += 1
+                    if not series:
+                        del store[name]
+        return removed
+    
+    def render_openmetrics(self) -> str:
+        """
+        以 OpenMetrics 文本格式导出所有计数器、仪表盘和直方图
+        
+        直方图导出累计值（自进程启动），由各桶计数直接汇总，不涉及原始样本。
+        
+        Returns:
+            OpenMetrics 文本
+        """
+        lines: List[str] = []
+        with self._lock:
+            for name, series in self.counters.items():
+                metric = _metric_name(name)
+                if metric.endswith("_total"):
+                    metric = metric[:-len("_total")]
+                lines.append(f"# TYPE {metric} counter")
+                for key, value in series.items():
+                    lines.append(f"{metric}_total{_labels(key)} {_number(value)}")
+            
+            for name, series in self.gauges.items():
+                metric = _metric_name(name)
+                lines.append(f"# TYPE {metric} gauge")
+                for key, value in series.items():
+                    lines.append(f"{metric}{_labels(key)} {_number(value)}")
+            
+            for name, series in self.histograms.items():
+                metric = _metric_name(name)
+                lines.append(f"# TYPE {metric} histogram")
+                for key, rolling in series.items():
+                    histogram = rolling.cumulative
+                    for bound, count in histogram.export_buckets():
+                        le = 'le="' + _number(bound) + '"'
+                        lines.append(f"{metric}_bucket{_labels(key, le)} {count}")
+                    lines.append(f"{metric}_bucket{_labels(key, _INF_LABEL)} {histogram.count}")
+                    lines.append(f"{metric}_count{_labels(key)} {histogram.count}")
+                    lines.append(f"{metric}_sum{_labels(key)} {_number(histogram.total)}")
+        
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+    
     def clear(self, name: Optional[str] = None) -> None:
         """
         清空指标
@@ -112,11 +566,18 @@ class MetricsCollector:
         Args:
             name: 指标名称，如果不指定则清空所有
         """
-        if name:
-            if name in self.metrics:
-                self.metrics[name].clear()
-        else:
-            self.metrics.clear()
+        with self._lock:
+            if name:
+                if name in self.metrics:
+                    self.metrics[name].clear()
+                self.histograms.pop(name, None)
+                self.counters.pop(name, None)
+                self.gauges.pop(name, None)
+            else:
+                self.metrics.clear()
+                self.histograms.clear()
+                self.counters.clear()
+                self.gauges.clear()
 
 
 class Timer:
@@ -168,4 +629,3 @@ def timed(metric_name: str, collector: Optional[MetricsCollector] = None):
                 return func(*args, **kwargs)
         return wrapper
     return decorator
-
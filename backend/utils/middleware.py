@@ -1,156 +1,208 @@
 """
 中间件模块
-提供请求追踪、错误处理等中间件
+提供请求追踪、错误处理和限流中间件
+
+三项功能合并在同一个纯 ASGI 中间件中：每个请求只经过一层，
+不像 BaseHTTPMiddleware 那样为每层额外创建任务并包装响应流。
 """
+import math
 import time
 import uuid
-from typing import Callable
-from fastapi import Request, Response
+from typing import Optional, Tuple
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from backend.utils.rate_limit import RateLimiter, RateLimitResult, RateLimitRule
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 不经过中间件处理的路径前缀（WebSocket 连接）
+SKIP_PATH_PREFIXES: Tuple[str, ...] = ("/ws",)
+
+# 异常类型 -> 状态码、错误名称和日志前缀，按顺序匹配
+ERROR_MAPPING = (
+    (ValueError, 400, "ValidationError", "Validation error"),
+    (PermissionError, 403, "PermissionDenied", "Permission denied"),
+)
+
+TRACE_HEADER = b"x-trace-id"
 
-class RequestTracingMiddleware(BaseHTTPMiddleware):
-    """请求追踪中间件"""
+
+class APIMiddleware:
+    """
+    API 中间件（纯 ASGI）
+    
+    依次完成限流、生成追踪 ID、记录请求日志和统一错误处理，
+    与原先 限流 → 错误处理 → 请求追踪 三层中间件的行为一致：
+    被限流的请求直接返回 429，不分配追踪 ID；
+    未处理的异常按类型映射为 400/403/500 的 JSON 响应，并带上追踪 ID。
+    """
     
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        # 跳过 WebSocket 连接
-        if request.url.path.startswith("/ws"):
-            return await call_next(request)
+    def __init__(
+        self,
+        app: ASGIApp,
+        tracing: bool = True,
+        error_handling: bool = True,
+        max_requests: Optional[int] = 100,
+        window_seconds: float = 60,
+        limiter: Optional[RateLimiter] = None,
+        skip_prefixes: Tuple[str, ...] = SKIP_PATH_PREFIXES
+    ):
+        """
+        初始化中间件
         
-        # 生成追踪 ID
-        trace_id = str(uuid.uuid4())
-        request.state.trace_id = trace_id
+        Args:
+            app: 下游 ASGI 应用
+            tracing: 是否生成追踪 ID 并记录请求日志
+            error_handling: 是否将未处理的异常转换为 JSON 错误响应
+            max_requests: 每个客户端在时间窗口内的最大请求数，为 None 时不限流
+            window_seconds: 限流时间窗口（秒）
+            limiter: 限流器，指定时忽略 max_requests 和 window_seconds
+            skip_prefixes: 不处理的路径前缀
+        """
+        self.app = app
+        self.tracing = tracing
+        self.error_handling = error_handling
+        self.skip_prefixes = skip_prefixes
+        if limiter is None and max_requests is not None:
+            limiter = RateLimiter([RateLimitRule("default", max_requests, window_seconds)])
+        self.limiter = limiter
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"].startswith(self.skip_prefixes):
+            await self.app(scope, receive, send)
+            return
         
-        # 记录请求开始
-        start_time = time.time()
+        if self.limiter is not None:
+            result = await self.limiter.check_async(scope)
+            if not result.allowed:
+                await self._rate_limited(scope, receive, send, result)
+                return
         
-        logger.info(
-            f"Request started: {request.method} {request.url.path}",
-            extra={"trace_id": trace_id}
-        )
+        if not self.tracing and not self.error_handling:
+            await self.app(scope, receive, send)
+            return
         
-        # 处理请求
-        try:
-            response = await call_next(request)
-            
-            # 记录请求完成
-            duration = time.time() - start_time
+        trace_id = None
+        start_time = time.perf_counter()
+        if self.tracing:
+            trace_id = str(uuid.uuid4())
+            scope.setdefault("state", {})["trace_id"] = trace_id
             logger.info(
-                f"Request completed: {request.method} {request.url.path} - "
-                f"Status: {response.status_code} - Duration: {duration:.3f}s",
-                extra={"trace_id": trace_id, "duration": duration}
+                f"Request started: {scope['method']} {scope['path']}",
+                extra={"trace_id": trace_id}
             )
-            
-            # 添加追踪 ID 到响应头
-            response.headers["X-Trace-ID"] = trace_id
-            
-            return response
         
-        except Exception as e:
-            duration = time.time() - start_time
-            logger.error(
-                f"Request failed: {request.method} {request.url.path} - "
-                f"Error: {str(e)} - Duration: {duration:.3f}s",
-                extra={"trace_id": trace_id, "duration": duration},
-                exc_info=True
-            )
-            raise
-
-
-class ErrorHandlingMiddleware(BaseHTTPMiddleware):
-    """统一错误处理中间件"""
-    
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        # 跳过 WebSocket 连接
-        if request.url.path.startswith("/ws"):
-            return await call_next(request)
+        status_code = 500
+        response_started = False
         
-        try:
-            return await call_next(request)
-        
-        except ValueError as e:
-            logger.warning(f"Validation error: {str(e)}")
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "error": "ValidationError",
-                    "message": str(e),
-                    "trace_id": getattr(request.state, "trace_id", None)
-                }
-            )
-        
-        except PermissionError as e:
-            logger.warning(f"Permission denied: {str(e)}")
-            return JSONResponse(
-                status_code=403,
-                content={
-                    "error": "PermissionDenied",
-                    "message": str(e),
-                    "trace_id": getattr(request.state, "trace_id", None)
-                }
-            )
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code, response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+                status_code = message["status"]
+                if trace_id is not None:
+                    # 添加追踪 ID 到响应头
+                    message["headers"] = [*message.get("headers", []), (TRACE_HEADER, trace_id.encode())]
+            await send(message)
         
+        try:
+            await self.app(scope, receive, send_wrapper)
         except Exception as e:
-            logger.error(f"Unexpected error: {str(e)}", exc_info=True)
-            return JSONResponse(
-                status_code=500,
-                content={
-                    "error": "InternalServerError",
-                    "message": "An unexpected error occurred",
-                    "trace_id": getattr(request.state, "trace_id", None)
-                }
+            if self.tracing:
+                duration = time.perf_counter() - start_time
+                logger.error(
+                    f"Request failed: {scope['method']} {scope['path']} - "
+                    f"Error: {str(e)} - Duration: {duration:.3f}s",
+                    extra={"trace_id": trace_id, "duration": duration},
+                    exc_info=True
+                )
+            # 响应已经开始发送时无法再返回错误响应
+            if not self.error_handling or response_started:
+                raise
+            await self._error_response(e, trace_id)(scope, receive, send_wrapper)
+            return
+        
+        if self.tracing:
+            duration = time.perf_counter() - start_time
+            logger.info(
+                f"Request completed: {scope['method']} {scope['path']} - "
+                f"Status: {status_code} - Duration: {duration:.3f}s",
+                extra={"trace_id": trace_id, "duration": duration}
             )
-
-
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    """简单的限流中间件"""
     
-    def __init__(self, app, max_requests: int = 100, window_seconds: int = 60):
-        super().__init__(app)
-        self.max_requests = max_requests
-        self.window_seconds = window_seconds
-        self.requests = {}  # {ip: [(timestamp, count)]}
+    async def _rate_limited(self, scope: Scope, receive: Receive, send: Send, result: RateLimitResult) -> None:
+        """返回 429 响应"""
+        client = scope.get("client")
+        client_ip = client[0] if client else "unknown"
+        logger.warning(
+            f"Rate limit exceeded for {client_ip} ({result.rule})",
+            extra={"client_ip": client_ip}
+        )
+        response = JSONResponse(
+            status_code=429,
+            content={
+                "error": "RateLimitExceeded",
+                "message": "Too many requests",
+                "rule": result.rule,
+                "retry_after": round(result.retry_after, 3)
+            },
+            headers={"Retry-After": str(max(1, math.ceil(result.retry_after)))}
+        )
+        await response(scope, receive, send)
     
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        # 跳过 WebSocket 连接
-        if request.url.path.startswith("/ws"):
-            return await call_next(request)
-        
-        # 获取客户端 IP
-        client_ip = request.client.host if request.client else "unknown"
+    def _error_response(self, error: Exception, trace_id: Optional[str]) -> JSONResponse:
+        """
+        将异常转换为 JSON 错误响应
         
-        # 清理过期记录
-        current_time = time.time()
-        if client_ip in self.requests:
-            self.requests[client_ip] = [
-                (ts, count) for ts, count in self.requests[client_ip]
-                if current_time - ts < self.window_seconds
-            ]
-        
-        # 检查请求数
-        if client_ip in self.requests:
-            total_requests = sum(count for _, count in self.requests[client_ip])
-            if total_requests >= self.max_requests:
-                logger.warning(
-                    f"Rate limit exceeded for {client_ip}",
-                    extra={"client_ip": client_ip}
-                )
+        Args:
+            error: 未处理的异常
+            trace_id: 追踪 ID
+            
+        Returns:
+            错误响应
+        """
+        for error_type, status_code, name, log_prefix in ERROR_MAPPING:
+            if isinstance(error, error_type):
+                logger.warning(f"{log_prefix}: {str(error)}")
                 return JSONResponse(
-                    status_code=429,
-                    content={
-                        "error": "RateLimitExceeded",
-                        "message": "Too many requests"
-                    }
+                    status_code=status_code,
+                    content={"error": name, "message": str(error), "trace_id": trace_id}
                 )
         
-        # 记录请求
-        if client_ip not in self.requests:
-            self.requests[client_ip] = []
-        self.requests[client_ip].append((current_time, 1))
-        
-        return await call_next(request)
+        logger.error(f"Unexpected error: {str(error)}", exc_info=True)
+        return JSONResponse(
+            status_code=500,
+            content={
+                "error": "InternalServerError",
+                "message": "An unexpected error occurred",
+                "trace_id": trace_id
+            }
+        )
+
+
+class RequestTracingMiddleware(APIMiddleware):
+    """请求追踪中间件（只启用追踪）"""
+    
+    def __init__(self, app: ASGIApp):
+        super().__init__(app, tracing=True, error_handling=False, max_requests=None)
+
 
+class ErrorHandlingMiddleware(APIMiddleware):
+    """统一错误处理中间件（只启用错误处理）"""
+    
+    def __init__(self, app: ASGIApp):
+        super().__init__(app, tracing=False, error_handling=True, max_requests=None)
+
+
+class RateLimitMiddleware(APIMiddleware):
+    """简单的限流中间件（只启用限流）"""
+    
+    def __init__(self, app: ASGIApp, max_requests: int = 100, window_seconds: int = 60):
+        super().__init__(
+            app,
+            tracing=False,
+            error_handling=False,
+            max_requests=max_requests,
+            window_seconds=window_seconds
+        )
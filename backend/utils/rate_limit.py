@@ -0,0 +1,428 @@
+"""
+限流模块
+基于 GCRA（通用信元速率算法，等价于令牌桶）的限流器
+
+每个限流键只保存一个“理论到达时间”（TAT），每次请求 O(1) 更新；
+TAT 早于当前时间的键与没有记录等价，可以随时删除，由后台任务定期清理。
+状态保存在可替换的后端中：内存后端用于单进程，SQLite 后端供同一台机器上的多个 worker 共享限额。
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from starlette.types import Scope
+from backend.config import DATA_DIR
+from backend.utils.logger import get_logger
+from backend.utils.metrics import global_metrics
+from config.settings import settings
+
+logger = get_logger(__name__)
+
+# 一次检查的所有限额：(限流键, 每个请求的间隔, 允许累积的额度对应的时长)
+Limits = List[Tuple[str, float, float]]
+
+# 按会话限流时读取的请求头，与客户端 IP 组合成限流键
+SESSION_HEADER = b"x-session-id"
+
+
+@dataclass
+class RateLimitRule:
+    """限流规则：每个键在 period 秒内最多 limit 个请求，允许一次性用完"""
+    name: str
+    limit: int
+    period: float
+    path_prefix: str = ""  # 匹配的路径前缀，空字符串匹配所有路径
+    key_by: str = "ip"  # ip 或 session（IP + 会话）
+    
+    @property
+    def emission_interval(self) -> float:
+        """相邻两个请求的平均间隔（补充一个令牌的时间）"""
+        return self.period / self.limit
+    
+    def matches(self, path: str) -> bool:
+        """规则是否适用于该路径"""
+        return path.startswith(self.path_prefix)
+
+
+@dataclass
+class RateLimitResult:
+    """限流检查结果"""
+    allowed: bool
+    rule: Optional[str] = None  # 拒绝请求的规则，或最后检查的规则
+    remaining: int = 0  # 当前还可以立即发出的请求数
+    retry_after: float = 0.0  # 被拒绝时需要等待的秒数
+
+
+class MemoryRateLimitBackend:
+    """
+    内存限流后端
+    
+    键按最近使用顺序保存，超过最大键数时淘汰最久未使用的键（相当于重置其限额）。
+    """
+    
+    # 操作只涉及内存，可以直接在事件循环中调用
+    blocking = False
+    
+    def __init__(self, max_keys: int = 100000):
+        """
+        初始化后端
+        
+        Args:
+            max_keys: 最多保存的键数
+        """
+        self.max_keys = max_keys
+        self._tats: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+    
+    def acquire(self, limits: Limits, now: float) -> Tuple[bool, List[float]]:
+        """
+        同时检查多个限额，全部未超限时才消耗额度
+        
+        Args:
+            limits: 各限额的键、间隔（规则的 emission_interval）和时长（规则的 period）
+            now: 当前时间
+            
+        Returns:
+            (是否允许, 各限额在本次请求之后的理论到达时间)
+        """
+        with self._lock:
+            tats = [max(self._tats.get(key, now), now) + interval for key, interval, _ in limits]
+            if any(tat - now > period for tat, (_, _, period) in zip(tats, limits)):
+                return False, tats
+            for (key, _, _), tat in zip(limits, tats):
+                self._tats[key] = tat
+                self._tats.move_to_end(key)
+            while len(self._tats) > self.max_keys:
+                self._tats.popitem(last=False)
+                self.evictions += 1
+            return True, tats
+    
+    def sweep(self, now: float) -> int:
+        """
+        删除额度已完全恢复的键
+        
+        Args:
+            now: 当前时间
+            
+        Returns:
+            删除的键数
+        """
+        with self._lock:
+            idle = [key for key, tat in self._tats.items() if tat <= now]
+            for key in idle:
+                del self._tats[key]
+        return len(idle)
+    
+    def __len__(self) -> int:
+        return len(self._tats)
+    
+    def close(self) -> None:
+        """释放资源（内存后端无需处理）"""
+
+
+class SQLiteRateLimitBackend:
+    """
+    SQLite 限流后端
+    
+    多个 worker 进程打开同一个数据库文件即可共享限额；
+    每次更新在 BEGIN IMMEDIATE 事务中完成读-改-写，保证进程间原子性。
+    数据库在首次使用时才打开。
+    """
+    
+    # 等待其他进程释放写锁时会阻塞，需要在线程池中调用
+    blocking = True
+    
+    def __init__(self, path: str, timeout: float = 5.0):
+        """
+        初始化后端
+        
+        Args:
+            path: 数据库文件路径，":memory:" 表示进程内数据库
+            timeout: 等待其他进程释放锁的时间（秒）
+        """
+        self.path = str(path)
+        self.timeout = timeout
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+    
+    def _connection(self) -> sqlite3.Connection:
+        """数据库连接，首次访问时打开并建表（调用方需持有锁）"""
+        if self._conn is None:
+            if self.path != ":memory:":
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                isolation_level=None,
+                check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tat REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+    
+    def acquire(self, limits: Limits, now: float) -> Tuple[bool, List[float]]:
+        """
+        同时检查多个限额，全部未超限时才消耗额度
+        
+        Args:
+            limits: 各限额的键、间隔和时长
+            now: 当前时间（各进程需使用同一时钟，即 time.time）
+            
+        Returns:
+            (是否允许, 各限额在本次请求之后的理论到达时间)
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                tats = []
+                for key, interval, _ in limits:
+                    row = conn.execute("SELECT tat FROM rate_limits WHERE key = ?", (key,)).fetchone()
+                    tats.append(max(row[0] if row else now, now) + interval)
+                allowed = all(tat - now <= period for tat, (_, _, period) in zip(tats, limits))
+                if allowed:
+                    conn.executemany(
+                        "INSERT INTO rate_limits (key, tat) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET tat = excluded.tat",
+                        [(key, tat) for (key, _, _), tat in zip(limits, tats)]
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return allowed, tats
+    
+    def sweep(self, now: float) -> int:
+        """
+        删除额度已完全恢复的键
+        
+        Args:
+            now: 当前时间
+            
+        Returns:
+            删除的键数
+        """
+        with self._lock:
+            cursor = self._connection().execute("DELETE FROM rate_limits WHERE tat <= ?", (now,))
+            return cursor.rowcount
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM rate_limits").fetchone()[0]
+    
+    def close(self) -> None:
+        """关闭数据库连接"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class RateLimiter:
+    """
+    限流器
+    
+    同时检查所有匹配请求路径的规则，任一规则超限即拒绝；
+    被拒绝的请求不消耗任何规则的额度。
+    """
+    
+    def __init__(
+        self,
+        rules: List[RateLimitRule],
+        backend=None,
+        sweep_interval: float = 60.0,
+        clock: Callable[[], float] = time.time
+    ):
+        """
+        初始化限流器
+        
+        Args:
+            rules: 限流规则
+            backend: 状态后端，不指定时使用内存后端
+            sweep_interval: 后台清理空闲键的间隔（秒）
+            clock: 时钟，多进程共享后端时必须是各进程一致的墙上时间
+        """
+        self.rules = rules
+        self.backend = backend if backend is not None else MemoryRateLimitBackend()
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        self._sweeper: Optional[asyncio.Task] = None
+        self.allowed = 0
+        self.limited: Dict[str, int] = {rule.name: 0 for rule in rules}
+        self.sweeps = 0
+    
+    def _identity(self, rule: RateLimitRule, scope: Scope) -> str:
+        """规则对应的客户端标识：客户端 IP，按会话限流时再加上会话 ID"""
+        client = scope.get("client")
+        identity = "ip:" + (client[0] if client else "unknown")
+        if rule.key_by == "session":
+            # 会话 ID 由客户端提供，只能细分同一 IP 的额度，不能绕过 IP 级的限额
+            for name, value in scope.get("headers", ()):
+                if name == SESSION_HEADER:
+                    return identity + "|session:" + value.decode("latin-1")
+        return identity
+    
+    def check(self, scope: Scope) -> RateLimitResult:
+        """
+        检查请求是否超过限流，未超过时消耗额度
+        
+        Args:
+            scope: ASGI 请求信息
+            
+        Returns:
+            限流检查结果
+        """
+        path = scope["path"]
+        rules = [rule for rule in self.rules if rule.matches(path)]
+        if not rules:
+            self.allowed += 1
+            return RateLimitResult(allowed=True)
+        
+        now = self.clock()
+        limits = [
+            (f"{rule.name}:{self._identity(rule, scope)}", rule.emission_interval, rule.period)
+            for rule in rules
+        ]
+        allowed, tats = self.backend.acquire(limits, now)
+        
+        if not allowed:
+            # 报告第一个超限的规则
+            rule, tat = next((r, t) for r, t in zip(rules, tats) if t - now > r.period)
+            self.limited[rule.name] = self.limited.get(rule.name, 0) + 1
+            global_metrics.increment("http.rate_limited", tags={"rule": rule.name})
+            return RateLimitResult(allowed=False, rule=rule.name, retry_after=tat - now - rule.period)
+        
+        # 剩余额度取最紧的规则
+        result = None
+        for rule, tat in zip(rules, tats):
+            remaining = int((rule.period - (tat - now)) / rule.emission_interval + 1e-9)
+            if result is None or remaining < result.remaining:
+                result = RateLimitResult(allowed=True, rule=rule.name, remaining=remaining)
+        
+        self.allowed += 1
+        return result
+    
+    async def check_async(self, scope: Scope) -> RateLimitResult:
+        """
+        在事件循环中检查限流，后端会阻塞时在线程池中执行
+        
+        Args:
+            scope: ASGI 请求信息
+            
+        Returns:
+            限流检查结果
+        """
+        if getattr(self.backend, "blocking", False):
+            return await asyncio.to_thread(self.check, scope)
+        return self.check(scope)
+    
+    def sweep(self) -> int:
+        """
+        清理额度已完全恢复的键
+        
+        Returns:
+            删除的键数
+        """
+        return self.backend.sweep(self.clock())
+    
+    async def _sweep_loop(self) -> None:
+        """定期清理空闲键"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                if getattr(self.backend, "blocking", False):
+                    removed = await asyncio.to_thread(self.sweep)
+                else:
+                    removed = self.sweep()
+            except Exception as e:
+                logger.warning(f"清理限流状态失败: {e}")
+                continue
+            self.sweeps += 1
+            if removed:
+                logger.debug(f"清理空闲限流键 {removed} 个")
+    
+    def start_sweeper(self) -> asyncio.Task:
+        """
+        启动后台清理任务
+        
+        Returns:
+            清理任务
+        """
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+        return self._sweeper
+    
+    async def stop_sweeper(self) -> None:
+        """停止后台清理任务"""
+        if self._sweeper and not self._sweeper.done():
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+        self._sweeper = None
+    
+    def get_stats(self) -> Dict:
+        """
+        获取限流统计信息
+        
+        Returns:
+            统计信息字典
+        """
+        return {
+            "backend": type(self.backend).__name__,
+            "keys": len(self.backend),
+            "allowed": self.allowed,
+            "limited": dict(self.limited),
+            "sweeps": self.sweeps,
+            "rules": [
+                {"name": rule.name, "limit": rule.limit, "period": rule.period,
+                 "path_prefix": rule.path_prefix, "key_by": rule.key_by}
+                for rule in self.rules
+            ]
+        }
+
+
+def create_rate_limiter() -> RateLimiter:
+    """
+    按配置创建限流器
+    
+    Returns:
+        限流器
+    """
+    if settings.rate_limit_backend == "sqlite":
+        backend = SQLiteRateLimitBackend(settings.rate_limit_sqlite_path or DATA_DIR / "rate_limit.db")
+    else:
+        backend = MemoryRateLimitBackend(max_keys=settings.rate_limit_max_keys)
+    
+    rules = [
+        # 测试生成接口每次都会调用大模型，每个会话单独限额，同一 IP 的所有会话再共享一个限额
+        RateLimitRule(
+            "generate_session",
+            settings.rate_limit_generate_max_requests,
+            settings.rate_limit_generate_window_seconds,
+            path_prefix="/api/test/generate",
+            key_by="session"
+        ),
+        RateLimitRule(
+            "generate",
+            settings.rate_limit_generate_ip_max_requests,
+            settings.rate_limit_generate_window_seconds,
+            path_prefix="/api/test/generate"
+        ),
+        RateLimitRule("default", settings.rate_limit_max_requests, settings.rate_limit_window_seconds),
+    ]
+    return RateLimiter(rules, backend=backend, sweep_interval=settings.rate_limit_sweep_interval)
+
+
+# 全局实例
+rate_limiter = create_rate_limiter()
@@ -0,0 +1,189 @@
+"""
+启动优化模块
+耗时的资源（分词编码器、大模型客户端等）在启动后于后台线程预热，并提供导入耗时分析
+"""
+import asyncio
+import re
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+from backend.utils.logger import get_logger
+from backend.utils.metrics import global_metrics
+
+logger = get_logger(__name__)
+
+# python -X importtime 输出格式：import time: self [us] | cumulative | imported package
+_IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+class WarmUp:
+    """
+    后台预热
+    
+    进程启动时只注册预热函数，服务开始接收连接后在线程池中依次执行；
+    预热完成前首次使用资源的请求会自行完成初始化，不会出错。
+    """
+    
+    def __init__(self):
+        """初始化预热任务"""
+        self._steps: Dict[str, Callable[[], None]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.durations: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+    
+    def register(self, name: str, func: Callable[[], None]) -> None:
+        """
+        注册预热函数
+        
+        Args:
+            name: 资源名称
+            func: 预热函数（同步，在线程池中执行）
+        """
+        self._steps[name] = func
+    
+    @property
+    def done(self) -> bool:
+        """预热是否已结束"""
+        return self._task is not None and self._task.done()
+    
+    async def run(self) -> Dict[str, float]:
+        """
+        依次执行所有预热函数
+        
+        Returns:
+            各资源的预热耗时（秒）
+        """
+        for name, func in self._steps.items():
+            start_time = time.perf_counter()
+            try:
+                await asyncio.to_thread(func)
+            except Exception as e:
+                # 预热失败不影响服务，首次使用时会再次初始化
+                self.errors[name] = str(e)
+                logger.warning(f"预热 {name} 失败: {e}")
+                continue
+            duration = time.perf_counter() - start_time
+            self.durations[name] = duration
+            global_metrics.record("startup.warm_up", duration, tags={"resource": name})
+        
+        logger.info(f"预热完成: {', '.join(f'{k}={v:.3f}s' for k, v in self.durations.items())}")
+        return self.durations
+    
+    def start(self) -> asyncio.Task:
+        """
+        在后台启动预热
+        
+        Returns:
+            预热任务
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return self._task
+    
+    async def stop(self) -> None:
+        """取消尚未完成的预热"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    def get_stats(self) -> Dict:
+        """
+        获取预热统计信息
+        
+        Returns:
+            统计信息字典
+        """
+        return {
+            "done": self.done,
+            "pending": [name for name in self._steps if name not in self.durations and name not in self.errors],
+            "durations": dict(self.durations),
+            "errors": dict(self.errors)
+        }
+
+
+def parse_import_times(output: str) -> List[Dict]:
+    """
+    解析 python -X importtime 的输出
+    
+    Args:
+        output: 标准错误输出
+        
+    Returns:
+        模块导入耗时列表，单位毫秒
+    """
+    records = []
+    for line in output.splitlines():
+        match = _IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        records.append({
+            "module": module,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+            "depth": (len(indent) - 1) // 2
+        })
+    return records
+
+
+def profile_imports(module: str = "backend.main", top: int = 20) -> List[Dict]:
+    """
+    在子进程中导入模块并统计各依赖的导入耗时
+    
+    Args:
+        module: 要分析的模块
+        top: 返回自身耗时最高的前 N 项
+        
+    Returns:
+        按自身耗时降序排列的导入耗时列表
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败: {result.stderr.strip().splitlines()[-1:]}")
+    
+    records = parse_import_times(result.stderr)
+    records.sort(key=lambda record: record["self_ms"], reverse=True)
+    return records[:top]
+
+
+def format_import_report(module: str, records: List[Dict], total_ms: float) -> str:
+    """
+    生成导入耗时报告
+    
+    Args:
+        module: 分析的模块
+        records: 导入耗时列表
+        total_ms: 模块导入总耗时（毫秒）
+        
+    Returns:
+        报告文本
+    """
+    lines = [
+        f"导入 {module} 总耗时: {total_ms:.1f} ms",
+        f"{'自身(ms)':>10} {'累计(ms)':>10}  模块",
+    ]
+    for record in records:
+        lines.append(f"{record['self_ms']:>10.1f} {record['cumulative_ms']:>10.1f}  {record['module']}")
+    return "\n".join(lines)
+
+
+# 全局实例
+startup_warm_up = WarmUp()
+
+
+if __name__ == "__main__":
+    # 用法：python -m backend.utils.startup [模块名] [前 N 项]
+    target = sys.argv[1] if len(sys.argv) > 1 else "backend.main"
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    
+    all_records = profile_imports(target, top=10 ** 6)
+    total = next((r["cumulative_ms"] for r in all_records if r["module"] == target), 0.0)
+    print(format_import_report(target, all_records[:limit], total))
@@ -2,60 +2,168 @@
 Token 计数工具
 使用 tiktoken 精确计算 token 数量
 """
-import tiktoken
-from typing import List, Dict
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Optional
+from config.settings import settings
 
 
 class TokenCounter:
     """Token 计数器"""
     
-    def __init__(self, model: str = "gpt-3.5-turbo"):
+    def __init__(
+        self,
+        model: str = "gpt-3.5-turbo",
+        cache_size: int = 4096,
+        exact: bool = True,
+        num_threads: int = 4,
+        batch_min_chars: int = 20000
+    ):
         """
         初始化 Token 计数器
         
         Args:
             model: 模型名称，用于选择对应的编码器
+            cache_size: 计数结果缓存的最大条目数
+            exact: 默认是否精确计数，False 时使用估算
+            num_threads: 批量编码使用的线程数
+            batch_min_chars: 未缓存文本的总字符数达到该值时才多线程编码
         """
-        try:
-            self.encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            # 如果模型不存在，使用默认编码器
-            self.encoding = tiktoken.get_encoding("cl100k_base")
+        # 编码器加载较慢，首次使用时再加载，避免拖慢启动
+        self.model = model
+        self._encoding = None
+        self._encoding_lock = threading.Lock()
+        
+        self.exact = exact
+        self.num_threads = num_threads
+        self.batch_min_chars = batch_min_chars
+        
+        # 相同文本（摘要、系统提示等）反复计数时直接返回缓存结果
+        self.cache_size = cache_size
+        self._memo: "OrderedDict[str, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    @property
+    def encoding(self):
+        """tiktoken 编码器，首次访问时加载"""
+        if self._encoding is None:
+            with self._encoding_lock:
+                if self._encoding is None:
+                    import tiktoken
+                    try:
+                        self._encoding = tiktoken.encoding_for_model(self.model)
+                    except KeyError:
+                        # 如果模型不存在，使用默认编码器
+                        self._encoding = tiktoken.get_encoding("cl100k_base")
+        return self._encoding
+    
+    @property
+    def loaded(self) -> bool:
+        """编码器是否已加载"""
+        return self._encoding is not None
     
-    def count_text(self, text: str) -> int:
+    def warm_up(self) -> None:
+        """提前加载编码器（可在后台线程中调用）"""
+        self.encoding.encode("warm up")
+    
+    def _remember(self, text: str, tokens: int) -> None:
+        """写入计数缓存，超过容量时淘汰最久未使用的条目"""
+        self._memo[text] = tokens
+        if len(self._memo) > self.cache_size:
+            self._memo.popitem(last=False)
+    
+    def count_text(self, text: str, exact: Optional[bool] = None) -> int:
         """
         计算文本的 token 数量
         
         Args:
             text: 输入文本
+            exact: 是否精确计数，不指定时使用默认设置
             
         Returns:
             token 数量
         """
         if not text:
             return 0
-        return len(self.encoding.encode(text))
+        
+        if not (self.exact if exact is None else exact):
+            return self.estimate_tokens(text)
+        
+        tokens = self._memo.get(text)
+        if tokens is not None:
+            self._memo.move_to_end(text)
+            self.hits += 1
+            return tokens
+        
+        self.misses += 1
+        tokens = len(self.encoding.encode(text))
+        self._remember(text, tokens)
+        return tokens
+    
+    def count_batch(self, texts: List[str], exact: Optional[bool] = None) -> List[int]:
+        """
+        批量计算 token 数量，未缓存的文本较多时一次性多线程编码
+        
+        Args:
+            texts: 文本列表
+            exact: 是否精确计数，不指定时使用默认设置
+            
+        Returns:
+            与输入顺序一致的 token 数量列表
+        """
+        if not (self.exact if exact is None else exact):
+            return [self.estimate_tokens(text) if text else 0 for text in texts]
+        
+        counts: List[Optional[int]] = []
+        missing: Dict[str, List[int]] = {}
+        for index, text in enumerate(texts):
+            if not text:
+                counts.append(0)
+                continue
+            
+            tokens = self._memo.get(text)
+            if tokens is not None:
+                self._memo.move_to_end(text)
+                self.hits += 1
+            else:
+                missing.setdefault(text, []).append(index)
+            counts.append(tokens)
+        
+        if missing:
+            unique_texts = list(missing)
+            self.misses += len(unique_texts)
+            if sum(len(text) for text in unique_texts) >= self.batch_min_chars:
+                # encode_batch 每次调用都会新建线程池，只在文本足够多时才划算
+                encoded = self.encoding.encode_batch(unique_texts, num_threads=self.num_threads)
+                lengths = [len(tokens) for tokens in encoded]
+            else:
+                lengths = [len(self.encoding.encode(text)) for text in unique_texts]
+            for text, tokens in zip(unique_texts, lengths):
+                self._remember(text, tokens)
+                for index in missing[text]:
+                    counts[index] = tokens
+        
+        return counts
     
-    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+    def count_messages(self, messages: List[Dict[str, str]], exact: Optional[bool] = None) -> int:
         """
         计算消息列表的 token 数量
         
         Args:
             messages: 消息列表，格式 [{"role": "user", "content": "..."}]
+            exact: 是否精确计数，不指定时使用默认设置
             
         Returns:
             总 token 数量
         """
-        total_tokens = 0
+        values = [str(value) for message in messages for value in message.values()]
+        name_count = sum(1 for message in messages for key in message if key == "name")
         
-        for message in messages:
-            # 每条消息的基础 token（role + 分隔符）
-            total_tokens += 4
-            
-            for key, value in message.items():
-                total_tokens += self.count_text(str(value))
-                if key == "name":
-                    total_tokens += -1  # role 已经计算过了
+        # 每条消息的基础 token（role + 分隔符），name 字段少计 1 个（role 已经计算过了）
+        total_tokens = 4 * len(messages) - name_count
+        total_tokens += sum(self.count_batch(values, exact=exact))
         
         # 每次对话的结束 token
         total_tokens += 2
@@ -72,13 +180,30 @@ class TokenCounter:
         Returns:
             估算的 token 数量
         """
+        if not text:
+            return 0
+        
         # 粗略估算：中文约 1.5 字符/token，英文约 4 字符/token
-        chinese_chars = sum(1 for c in text if '\u4e00' <= c <= '\u9fff')
-        other_chars = len(text) - chinese_chars
+        code_points = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        chinese_chars = int(np.count_nonzero((code_points >= 0x4E00) & (code_points <= 0x9FFF)))
+        other_chars = len(code_points) - chinese_chars
         
         return int(chinese_chars / 1.5 + other_chars / 4)
+    
+    def get_stats(self) -> Dict[str, int]:
+        """
+        获取计数缓存统计
+        
+        Returns:
+            统计信息字典
+        """
+        return {
+            "loaded": self.loaded,
+            "size": len(self._memo),
+            "hits": self.hits,
+            "misses": self.misses
+        }
 
 
 # 全局实例
-token_counter = TokenCounter()
-
+token_counter = TokenCounter(exact=settings.token_count_exact)
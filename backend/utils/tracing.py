@@ -0,0 +1,185 @@
+"""
+延迟追踪模块
+记录每句话从收到音频到发出回复各阶段的时间点，写入直方图并可发送给前端
+"""
+import time
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Tuple
+from backend.utils.metrics import MetricsCollector, global_metrics
+
+
+# 问题→回复流水线的阶段，按正常先后顺序排列
+STAGES = (
+    "audio_received",  # 收到这句话的第一帧语音
+    "asr_partial",  # 收到第一个中间识别结果
+    "asr_final",  # 收到最终识别结果
+    "role_identified",  # 角色识别完成
+    "reply_cache_hit",  # 命中回复缓存（不再调用大模型）
+    "context_built",  # 回复生成的上下文构建完成
+    "llm_first_token",  # 收到大模型的第一个 token
+    "reply_sent",  # 回复发送给前端
+)
+
+# 回复生成阶段，提前生成的回复被放弃时需要删除
+REPLY_STAGES = ("reply_cache_hit", "context_built", "llm_first_token")
+
+# 当前正在处理的一句话，随 asyncio 任务传递到角色识别和回复生成
+current_trace: ContextVar[Optional["UtteranceTrace"]] = ContextVar("utterance_trace", default=None)
+
+
+class UtteranceTrace:
+    """
+    单句话的延迟追踪
+    
+    各阶段记录单调时钟的时间点，同一阶段只记录第一次；
+    结束时按时间先后计算每个阶段相对上一个阶段的耗时。
+    """
+    
+    def __init__(self, session_id: str = "", start: Optional[float] = None):
+        """
+        初始化追踪
+        
+        Args:
+            session_id: 所属会话 ID
+            start: 起始时间（time.perf_counter），不指定时取当前时间
+        """
+        self.session_id = session_id
+        self.start = time.perf_counter() if start is None else start
+        self.marks: Dict[str, float] = {}
+        self.finished = False
+    
+    def mark(self, stage: str, at: Optional[float] = None) -> None:
+        """
+        记录阶段时间点
+        
+        Args:
+            stage: 阶段名称
+            at: 时间点（time.perf_counter），不指定时取当前时间
+        """
+        if stage not in self.marks:
+            self.marks[stage] = time.perf_counter() if at is None else at
+    
+    def discard(self, stages: Iterable[str]) -> None:
+        """
+        删除阶段记录（提前处理的结果被放弃时使用）
+        
+        Args:
+            stages: 阶段名称
+        """
+        for stage in stages:
+            self.marks.pop(stage, None)
+    
+    def elapsed(self, since: str, until: str) -> Optional[float]:
+        """
+        两个阶段之间的耗时
+        
+        Args:
+            since: 起始阶段
+            until: 结束阶段
+            
+        Returns:
+            耗时（秒），任一阶段未记录时返回 None
+        """
+        if since not in self.marks or until not in self.marks:
+            return None
+        return self.marks[until] - self.marks[since]
+    
+    def _ordered(self) -> List[Tuple[str, float]]:
+        """按时间先后排列的阶段，时间相同时按流水线顺序"""
+        return sorted(
+            self.marks.items(),
+            key=lambda item: (item[1], STAGES.index(item[0]) if item[0] in STAGES else len(STAGES))
+        )
+    
+    def offsets(self) -> Dict[str, float]:
+        """
+        各阶段相对起始时间的偏移
+        
+        Returns:
+            阶段 -> 秒
+        """
+        return {stage: at - self.start for stage, at in self._ordered()}
+    
+    def breakdown(self) -> Dict[str, float]:
+        """
+        各阶段的耗时（距上一个阶段的时间）
+        
+        Returns:
+            阶段 -> 秒
+        """
+        result = {}
+        previous = self.start
+        for stage, at in self._ordered():
+            result[stage] = max(at - previous, 0.0)
+            previous = max(previous, at)
+        return result
+    
+    def total(self) -> float:
+        """
+        起始到最后一个阶段的总耗时
+        
+        Returns:
+            秒
+        """
+        if not self.marks:
+            return 0.0
+        return max(self.marks.values()) - self.start
+    
+    def finish(self, collector: Optional[MetricsCollector] = None) -> Dict:
+        """
+        结束追踪，各阶段耗时写入直方图
+        
+        Args:
+            collector: 指标收集器，不指定时使用全局收集器
+            
+        Returns:
+            延迟报告（毫秒）
+        """
+        if not self.finished:
+            self.finished = True
+            collector = collector or global_metrics
+            for stage, duration in self.breakdown().items():
+                collector.record(
+                    "pipeline.stage",
+                    duration,
+                    tags={"stage": stage, "session": self.session_id}
+                )
+            collector.record("pipeline.total", self.total(), tags={"session": self.session_id})
+        return self.report()
+    
+    def report(self) -> Dict:
+        """
+        生成延迟报告
+        
+        Returns:
+            包含各阶段偏移、耗时和总耗时的字典（毫秒）
+        """
+        return {
+            "stages": {stage: round(value * 1000, 1) for stage, value in self.offsets().items()},
+            "breakdown": {stage: round(value * 1000, 1) for stage, value in self.breakdown().items()},
+            "total_ms": round(self.total() * 1000, 1)
+        }
+
+
+def mark_stage(stage: str) -> None:
+    """
+    在当前追踪上记录阶段时间点，没有追踪时忽略
+    
+    Args:
+        stage: 阶段名称
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.mark(stage)
+
+
+def discard_stages(stages: Iterable[str]) -> None:
+    """
+    从当前追踪中删除阶段记录，没有追踪时忽略
+    
+    Args:
+        stages: 阶段名称
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.discard(stages)
@@ -26,16 +26,94 @@ class Settings(BaseSettings):
     app_port: int = 8000
     debug: bool = True
     
+    # 日志配置（由后台线程写日志、队列容量、每个调用位置每秒最多的普通日志条数和突发条数）
+    log_queue_enabled: bool = True
+    log_queue_size: int = 10000
+    log_rate_limit: float = 20.0
+    log_rate_limit_burst: int = 50
+    
+    # 启动后在后台预热分词编码器和大模型客户端
+    startup_warm_up_enabled: bool = True
+    
     # 音频配置
     audio_sample_rate: int = 16000
     audio_channels: int = 1
     audio_chunk_size: int = 3200
     
+    # 大模型请求调度（最大同时进行的请求数、只留给实时回复的名额数、对冲请求的默认等待时间）
+    llm_max_concurrency: int = 4
+    llm_reserved_slots: int = 1
+    llm_hedge_default_delay: float = 2.0
+    
+    # ASR 上行配置
+    asr_frame_ms: int = 100
+    asr_send_queue_size: int = 50
+    asr_pool_size: int = 2
+    asr_pool_max_idle_seconds: float = 60.0
+    asr_replay_seconds: float = 5.0
+    asr_max_reconnect_attempts: int = 5
+    
+    # 服务端 VAD 配置（跳过静音，不上传 ASR）
+    vad_enabled: bool = True
+    vad_frame_ms: int = 20
+    vad_energy_threshold: float = 0.01
+    vad_hangover_ms: int = 800
+    vad_preroll_ms: int = 200
+    
+    # 角色识别配置（本地文本分类置信度阈值，低于该值调用大模型）
+    role_fast_path_threshold: float = 0.85
+    
+    # 推测生成：识别角色的同时开始生成回复
+    speculative_reply_enabled: bool = True
+    
+    # 回复生成的时间预算和对冲请求（慢请求改用更快的备用模型再发一次）
+    reply_deadline_seconds: float = 8.0
+    reply_hedge_enabled: bool = True
+    reply_hedge_model: str = "qwen-turbo"
+    
+    # 中间识别结果稳定后提前处理（连续相同次数、与最终结果的相似度阈值）
+    early_reply_enabled: bool = True
+    partial_stable_updates: int = 3
+    partial_match_threshold: float = 0.9
+    
+    # 回复后向前端发送各阶段延迟（latency 消息）
+    latency_report_enabled: bool = False
+    
+    # 回复缓存配置（容量、过期时间、近似问题相似度阈值）
+    reply_cache_enabled: bool = True
+    reply_cache_size: int = 256
+    reply_cache_ttl: float = 3600.0
+    reply_cache_similarity: float = 0.8
+    
+    # 通用缓存配置（最大条目数、近似内存上限、分片数、过期清理间隔）
+    cache_max_entries: int = 10000
+    cache_max_bytes: int = 64 * 1024 * 1024
+    cache_shards: int = 8
+    cache_sweep_interval: float = 60.0
+    
+    # 限流配置（每个客户端的请求预算、测试生成接口每个会话和每个 IP 的单独预算）
+    rate_limit_enabled: bool = True
+    rate_limit_max_requests: int = 100
+    rate_limit_window_seconds: float = 60.0
+    rate_limit_generate_max_requests: int = 5
+    rate_limit_generate_ip_max_requests: int = 10
+    rate_limit_generate_window_seconds: float = 60.0
+    
+    # 限流状态后端（memory 或 sqlite，多个 worker 共享限额时使用 sqlite）、最大键数、空闲键清理间隔
+    rate_limit_backend: str = "memory"
+    rate_limit_sqlite_path: str = ""
+    rate_limit_max_keys: int = 100000
+    rate_limit_sweep_interval: float = 60.0
+    
     # 压缩策略配置
     l1_cache_size: int = 2
     l2_cache_size: int = 3
     compression_threshold: int = 3000
     
+    # Token 计数：False 时用字符数估算代替 tiktoken 编码
+    token_count_exact: bool = True
+    ai_summary_enabled: bool = True
+    
     class Config:
         env_file = ".env"
         case_sensitive = False
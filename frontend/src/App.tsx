@@ -148,7 +148,7 @@ function App() {
         setStatusMessage('正在启动音频采集...');
 
         // 通知后端开始监听
-        wsService.send({ type: 'start_listening' });
+        wsService.send({ type: 'start_listening', sample_rate: 16000, channels: 1 });
 
         // 开始音频采集
         await audioCaptureService.startCapture(audioSource, (audioData) => {
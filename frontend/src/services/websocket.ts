@@ -4,8 +4,10 @@
  */
 
 export interface WebSocketMessage {
-  type: 'audio' | 'transcript' | 'reply' | 'status' | 'error' | 'connected' | 'pong';
+  type: 'audio' | 'transcript' | 'reply' | 'status' | 'error' | 'connected' | 'pong' | 'ping' | 'start_listening' | 'stop_listening';
   data?: any;
+  sample_rate?: number;
+  channels?: number;
   text?: string;
   role?: string;
   timestamp?: string;
@@ -44,6 +46,7 @@ export class WebSocketService {
       
       try {
         this.ws = new WebSocket(url);
+        this.ws.binaryType = 'arraybuffer';
 
         this.ws.onopen = () => {
           console.log('✅ WebSocket 连接成功');
@@ -133,13 +136,17 @@ export class WebSocketService {
   }
 
   /**
-   * 发送音频数据
+   * 发送音频数据（二进制帧，16-bit little-endian PCM）
    */
   sendAudio(audioData: Int16Array): void {
-    this.send({
-      type: 'audio',
-      data: Array.from(audioData), // 转换为普通数组以便 JSON 序列化
-    });
+    if (this.ws?.readyState === WebSocket.OPEN) {
+      this.ws.send(audioData.buffer.slice(
+        audioData.byteOffset,
+        audioData.byteOffset + audioData.byteLength
+      ));
+    } else {
+      console.warn('WebSocket 未连接，无法发送音频');
+    }
   }
 
   /**
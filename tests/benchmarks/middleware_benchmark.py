@@ -0,0 +1,202 @@
+"""
+中间件性能基准
+对比原先三层 BaseHTTPMiddleware 与合并后的纯 ASGI 中间件每秒可处理的请求数
+
+两种组合使用相同的限流配置（每个 IP 每分钟 100 次），请求轮流来自多个客户端 IP，
+每个 IP 都不超过限额，避免测到旧限流器在请求记录很多时的开销；
+各组合交替测量多轮，取最好的一轮以减少噪声。
+
+用法：python -m tests.benchmarks.middleware_benchmark [请求数] [轮数]
+"""
+import asyncio
+import sys
+import time
+import uuid
+from typing import Callable, Dict, List
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from backend.utils.middleware import APIMiddleware
+
+
+class _LegacyTracing(BaseHTTPMiddleware):
+    """原先的请求追踪中间件（只保留每个请求都会执行的部分）"""
+    
+    async def dispatch(self, request: Request, call_next: Callable):
+        if request.url.path.startswith("/ws"):
+            return await call_next(request)
+        trace_id = str(uuid.uuid4())
+        request.state.trace_id = trace_id
+        response = await call_next(request)
+        response.headers["X-Trace-ID"] = trace_id
+        return response
+
+
+class _LegacyErrorHandling(BaseHTTPMiddleware):
+    """原先的错误处理中间件"""
+    
+    async def dispatch(self, request: Request, call_next: Callable):
+        if request.url.path.startswith("/ws"):
+            return await call_next(request)
+        try:
+            return await call_next(request)
+        except Exception:
+            return JSONResponse(status_code=500, content={"error": "InternalServerError"})
+
+
+class _LegacyRateLimit(BaseHTTPMiddleware):
+    """原先的限流中间件（按 IP 保存请求时间列表）"""
+    
+    def __init__(self, app, max_requests: int, window_seconds: int = 60):
+        super().__init__(app)
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.requests = {}
+    
+    async def dispatch(self, request: Request, call_next: Callable):
+        if request.url.path.startswith("/ws"):
+            return await call_next(request)
+        client_ip = request.client.host if request.client else "unknown"
+        current_time = time.time()
+        records = [
+            (ts, count) for ts, count in self.requests.get(client_ip, [])
+            if current_time - ts < self.window_seconds
+        ]
+        if sum(count for _, count in records) >= self.max_requests:
+            return JSONResponse(status_code=429, content={"error": "RateLimitExceeded"})
+        records.append((current_time, 1))
+        self.requests[client_ip] = records
+        return await call_next(request)
+
+
+# 每个客户端 IP 在一轮测量中发出的请求数，低于限流额度
+_REQUESTS_PER_CLIENT = 50
+
+
+def build_app(stack: str, max_requests: int = 100) -> FastAPI:
+    """
+    创建带指定中间件的测试应用
+    
+    Args:
+        stack: "none"（不加中间件）、"legacy"（三层 BaseHTTPMiddleware）或 "fused"（合并后的中间件）
+        max_requests: 限流窗口内的最大请求数
+        
+    Returns:
+        FastAPI 应用
+    """
+    app = FastAPI()
+    
+    @app.get("/api/ping")
+    async def ping():
+        return {"status": "ok"}
+    
+    if stack == "legacy":
+        app.add_middleware(_LegacyTracing)
+        app.add_middleware(_LegacyErrorHandling)
+        app.add_middleware(_LegacyRateLimit, max_requests=max_requests)
+    elif stack == "fused":
+        app.add_middleware(APIMiddleware, max_requests=max_requests)
+    elif stack != "none":
+        raise ValueError(f"未知的中间件组合: {stack}")
+    return app
+
+
+async def _request(app, path: str, client_ip: str = "127.0.0.1") -> int:
+    """直接调用 ASGI 应用完成一次 GET 请求，返回状态码"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"testserver")],
+        "client": (client_ip, 50000),
+        "server": ("testserver", 80),
+    }
+    status = 0
+    body_sent = False
+    disconnected = asyncio.Event()
+    
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # 请求体之后只有断开连接消息，响应完成前一直等待
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+    
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+    
+    await app(scope, receive, send)
+    return status
+
+
+def _client_ips(requests: int) -> List[str]:
+    """为每个请求分配客户端 IP，每个 IP 最多 _REQUESTS_PER_CLIENT 个请求"""
+    return [
+        f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"
+        for i in (index // _REQUESTS_PER_CLIENT for index in range(requests))
+    ]
+
+
+async def measure(app, requests: int = 5000, path: str = "/api/ping", ip_prefix: str = "") -> float:
+    """
+    测量应用每秒处理的请求数
+    
+    Args:
+        app: 带中间件的应用
+        requests: 请求数
+        path: 请求路径
+        ip_prefix: 客户端 IP 的前缀，每轮使用不同的前缀，避免沿用上一轮的限流记录
+        
+    Returns:
+        每秒请求数
+    """
+    client_ips = [ip_prefix + ip for ip in _client_ips(requests)]
+    start_time = time.perf_counter()
+    for client_ip in client_ips:
+        status = await _request(app, path, client_ip)
+        if status != 200:
+            raise RuntimeError(f"返回了状态码 {status}")
+    return requests / (time.perf_counter() - start_time)
+
+
+async def run_benchmark(requests: int = 5000, rounds: int = 3) -> Dict[str, float]:
+    """
+    交替测量各中间件组合，取每种组合最好的一轮
+    
+    Args:
+        requests: 每轮的请求数
+        rounds: 轮数
+        
+    Returns:
+        组合 -> 每秒请求数
+    """
+    stacks = ("none", "legacy", "fused")
+    apps = {stack: build_app(stack) for stack in stacks}
+    for stack, app in apps.items():
+        # 预热
+        await measure(app, min(requests, 100), ip_prefix="warmup-")
+    
+    results = {stack: 0.0 for stack in stacks}
+    for round_index in range(rounds):
+        for stack, app in apps.items():
+            rps = await measure(app, requests, ip_prefix=f"r{round_index}-")
+            results[stack] = max(results[stack], rps)
+    return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    results = asyncio.run(run_benchmark(count, rounds))
+    for name, rps in results.items():
+        print(f"{name:>8}: {rps:>10.0f} req/s  ({rps / results['legacy']:.2f}x legacy)")
@@ -3,9 +3,16 @@
 """
 import pytest
 from fastapi.testclient import TestClient
-from backend.main import app, manager
+import asyncio
+from backend.main import (
+    app, manager, negotiate_audio_format, speculation_stats,
+    handle_transcript, start_early_reply
+)
 from backend.core.conversation import conversation_history
-from backend.core.role import role_identifier
+from backend.core.role import Role, role_identifier
+from backend.core.generator import reply_generator
+from backend.core.reply_cache import reply_cache
+from backend.utils.metrics import global_metrics
 
 
 @pytest.fixture
@@ -50,12 +57,26 @@ class TestMainAPI:
         data = response.json()
         assert "conversation" in data
         assert "connections" in data
+        assert "speculation" in data
+        assert "reply_cache" in data
+    
+    def test_metrics_endpoint(self, client):
+        """测试 OpenMetrics 指标导出"""
+        client.get("/api/stats")
+        
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/openmetrics-text")
+        assert "# TYPE api_stats_duration histogram" in response.text
+        assert 'api_stats_duration_bucket{le="+Inf"}' in response.text
+        assert response.text.endswith("# EOF\n")
     
     def test_clear_conversation(self, client):
         """测试清空对话"""
         # 先添加一些对话
         from backend.core.role import Role
         conversation_history.add_turn(Role.TEACHER, "Hello")
+        reply_cache.set("什么是光合作用", "上一节课的回复")
         
         response = client.post("/api/conversation/clear")
         assert response.status_code == 200
@@ -63,6 +84,7 @@ class TestMainAPI:
         # 验证已清空
         stats = conversation_history.get_stats()
         assert stats["total_turns"] == 0
+        assert reply_cache.get("什么是光合作用") is None
     
     def test_get_conversation_history(self, client):
         """测试获取对话历史"""
@@ -126,6 +148,106 @@ class TestWebSocket:
             assert "role" in role_msg
             assert "text" in role_msg
     
+    def test_websocket_speculative_reply(self, client, monkeypatch):
+        """测试学生提问时识别角色与生成回复并行执行"""
+        events = []
+        
+        async def fake_identify(text, *args, **kwargs):
+            events.append("identify_start")
+            await asyncio.sleep(0.05)
+            events.append("identify_end")
+            return Role.STUDENT
+        
+        async def fake_generate(question, **kwargs):
+            events.append("generate_start")
+            return "回复"
+        
+        monkeypatch.setattr(role_identifier, "identify", fake_identify)
+        monkeypatch.setattr(reply_generator, "generate", fake_generate)
+        used = speculation_stats["used"]
+        
+        with client.websocket_connect("/ws/audio") as websocket:
+            websocket.receive_json()
+            websocket.send_json({
+                "type": "transcript",
+                "text": "老师，这个为什么是这样？",
+                "is_final": True
+            })
+            
+            messages = [websocket.receive_json() for _ in range(5)]
+            assert [m["type"] for m in messages] == ["status", "role_identified", "status", "reply", "stats"]
+            assert messages[3]["text"] == "回复"
+        
+        assert events.index("generate_start") < events.index("identify_end")
+        assert speculation_stats["used"] == used + 1
+    
+    def test_websocket_speculative_reply_cancelled(self, client, monkeypatch):
+        """测试角色为教师时取消推测生成"""
+        cancelled = []
+        
+        async def fake_identify(text, *args, **kwargs):
+            await asyncio.sleep(0.05)
+            return Role.TEACHER
+        
+        async def fake_generate(question, **kwargs):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(question)
+                raise
+        
+        monkeypatch.setattr(role_identifier, "identify", fake_identify)
+        monkeypatch.setattr(reply_generator, "generate", fake_generate)
+        wasted = speculation_stats["wasted"]
+        
+        with client.websocket_connect("/ws/audio") as websocket:
+            websocket.receive_json()
+            websocket.send_json({
+                "type": "transcript",
+                "text": "大家知道为什么吗？",
+                "is_final": True
+            })
+            
+            assert websocket.receive_json()["type"] == "status"
+            assert websocket.receive_json()["role"] == "teacher"
+            websocket.send_json({"type": "ping"})
+            assert websocket.receive_json()["type"] == "pong"
+        
+        assert cancelled == ["大家知道为什么吗？"]
+        assert speculation_stats["wasted"] == wasted + 1
+    
+    def test_websocket_connect_audio_format(self, client):
+        """测试连接消息携带音频格式"""
+        with client.websocket_connect("/ws/audio") as websocket:
+            data = websocket.receive_json()
+            assert data["audio_format"]["encoding"] == "pcm_s16le"
+            assert data["audio_format"]["sample_rate"] == 16000
+            assert data["audio_format"]["channels"] == 1
+    
+    def test_websocket_binary_audio_frame(self, client):
+        """测试二进制音频帧（ASR 未启动时丢弃，不影响后续消息）"""
+        with client.websocket_connect("/ws/audio") as websocket:
+            # 跳过连接消息
+            websocket.receive_json()
+            
+            websocket.send_bytes(b"\x00\x01" * 160)
+            websocket.send_json({"type": "ping"})
+            
+            data = websocket.receive_json()
+            assert data["type"] == "pong"
+    
+    def test_websocket_binary_audio_frame_misaligned(self, client):
+        """测试长度未对齐的二进制音频帧"""
+        with client.websocket_connect("/ws/audio") as websocket:
+            # 跳过连接消息
+            websocket.receive_json()
+            
+            websocket.send_bytes(b"\x00\x01\x02")
+            
+            data = websocket.receive_json()
+            assert data["type"] == "error"
+            assert "音频帧长度" in data["message"]
+    
     def test_websocket_unknown_type(self, client):
         """测试未知消息类型"""
         with client.websocket_connect("/ws/audio") as websocket:
@@ -141,6 +263,167 @@ class TestWebSocket:
             assert "未知的消息类型" in data["message"]
 
 
+class TestNegotiateAudioFormat:
+    """测试音频格式协商"""
+    
+    def test_defaults(self):
+        """测试默认格式"""
+        audio_format = negotiate_audio_format({"type": "start_listening"})
+        assert audio_format == {
+            "encoding": "pcm_s16le",
+            "sample_rate": 16000,
+            "channels": 1
+        }
+    
+    def test_custom(self):
+        """测试客户端声明的格式"""
+        audio_format = negotiate_audio_format({"sample_rate": 8000, "channels": 2})
+        assert audio_format["sample_rate"] == 8000
+        assert audio_format["channels"] == 2
+    
+    def test_unsupported(self):
+        """测试不支持的格式"""
+        with pytest.raises(ValueError):
+            negotiate_audio_format({"sample_rate": 44100})
+        with pytest.raises(ValueError):
+            negotiate_audio_format({"channels": 6})
+
+
+class FakeClientWebSocket:
+    """记录发送内容的假客户端连接"""
+    
+    def __init__(self):
+        self.sent = []
+    
+    async def send_json(self, data):
+        self.sent.append(data)
+
+
+class TestEarlyReply:
+    """测试根据中间结果提前处理"""
+    
+    @pytest.mark.asyncio
+    async def test_final_matches_early(self, monkeypatch):
+        """测试最终结果与中间结果一致时沿用提前生成的回复"""
+        calls = []
+        
+        async def fake_identify(text, *args, **kwargs):
+            calls.append(("identify", text))
+            return Role.STUDENT
+        
+        async def fake_generate(question, **kwargs):
+            calls.append(("generate", question))
+            return f"回复：{question}"
+        
+        monkeypatch.setattr(role_identifier, "identify", fake_identify)
+        monkeypatch.setattr(reply_generator, "generate", fake_generate)
+        
+        early = start_early_reply("老师这个公式怎么推导的")
+        websocket = FakeClientWebSocket()
+        await handle_transcript(websocket, {"text": "老师，这个公式怎么推导的？", "is_final": True}, early=early)
+        
+        assert calls == [("identify", "老师这个公式怎么推导的"), ("generate", "老师这个公式怎么推导的")]
+        reply = [m for m in websocket.sent if m["type"] == "reply"][0]
+        assert reply["question"] == "老师，这个公式怎么推导的？"
+    
+    @pytest.mark.asyncio
+    async def test_final_differs_restarts(self, monkeypatch):
+        """测试最终结果差异较大时取消提前任务并重新处理"""
+        async def fake_identify(text, *args, **kwargs):
+            return Role.STUDENT
+        
+        async def fake_generate(question, **kwargs):
+            return f"回复：{question}"
+        
+        monkeypatch.setattr(role_identifier, "identify", fake_identify)
+        monkeypatch.setattr(reply_generator, "generate", fake_generate)
+        restarted = speculation_stats["early_restarted"]
+        wasted = speculation_stats["wasted"]
+        wasted_metric = global_metrics.get_counters().get("speculation.wasted", 0)
+        
+        early = start_early_reply("老师这个公式怎么推导的")
+        websocket = FakeClientWebSocket()
+        final = "老师这个公式怎么推导的，还有下一题为什么选B？"
+        await handle_transcript(websocket, {"text": final, "is_final": True}, early=early)
+        
+        await asyncio.sleep(0)
+        assert early.role_task.cancelled()
+        assert speculation_stats["early_restarted"] == restarted + 1
+        # 提前生成的回复作废，/api/stats 和 /metrics 的计数一致
+        assert speculation_stats["wasted"] == wasted + 1
+        assert global_metrics.get_counters()["speculation.wasted"] == wasted_metric + 1
+        reply = [m for m in websocket.sent if m["type"] == "reply"][0]
+        assert reply["text"] == f"回复：{final}"
+
+
+class TestLatencyTracing:
+    """测试问题→回复流水线的延迟追踪"""
+    
+    @pytest.mark.asyncio
+    async def test_latency_report(self, monkeypatch):
+        """测试回复后记录各阶段延迟并发送 latency 消息"""
+        from config.settings import settings
+        from backend.utils.tracing import UtteranceTrace, mark_stage
+        
+        async def fake_identify(text, *args, **kwargs):
+            await asyncio.sleep(0.01)
+            return Role.STUDENT
+        
+        async def fake_generate(question, **kwargs):
+            mark_stage("context_built")
+            await asyncio.sleep(0.03)
+            mark_stage("llm_first_token")
+            return "回复"
+        
+        monkeypatch.setattr(role_identifier, "identify", fake_identify)
+        monkeypatch.setattr(reply_generator, "generate", fake_generate)
+        monkeypatch.setattr(settings, "latency_report_enabled", True)
+        
+        trace = UtteranceTrace("ws-test")
+        trace.mark("audio_received", trace.start)
+        trace.mark("asr_final")
+        websocket = FakeClientWebSocket()
+        count = global_metrics.get_stats("pipeline.total").get("count", 0)
+        
+        await handle_transcript(websocket, {"text": "这个公式怎么推导的？", "is_final": True}, trace=trace)
+        
+        latency = websocket.sent[-1]
+        assert latency["type"] == "latency"
+        assert list(latency["stages"]) == [
+            "audio_received", "asr_final", "context_built", "role_identified", "llm_first_token", "reply_sent"
+        ]
+        assert latency["total_ms"] >= latency["stages"]["llm_first_token"]
+        assert trace.finished
+        assert global_metrics.get_stats("pipeline.total")["count"] == count + 1
+        assert global_metrics.snapshot("pipeline.stage", tags={"stage": "reply_sent"}).count >= 1
+    
+    @pytest.mark.asyncio
+    async def test_no_report_for_teacher(self, monkeypatch):
+        """测试教师发言不发送 latency 消息，推测生成的阶段被删除"""
+        from config.settings import settings
+        from backend.utils.tracing import UtteranceTrace, mark_stage
+        
+        async def fake_identify(text, *args, **kwargs):
+            await asyncio.sleep(0.01)
+            return Role.TEACHER
+        
+        async def fake_generate(question, **kwargs):
+            mark_stage("context_built")
+            return "回复"
+        
+        monkeypatch.setattr(role_identifier, "identify", fake_identify)
+        monkeypatch.setattr(reply_generator, "generate", fake_generate)
+        monkeypatch.setattr(settings, "latency_report_enabled", True)
+        
+        trace = UtteranceTrace("ws-test")
+        websocket = FakeClientWebSocket()
+        await handle_transcript(websocket, {"text": "大家想想这个公式怎么推导？", "is_final": True}, trace=trace)
+        
+        assert all(m["type"] != "latency" for m in websocket.sent)
+        assert "role_identified" in trace.marks
+        assert "context_built" not in trace.marks
+
+
 class TestStreamWebSocket:
     """测试流式 WebSocket"""
     
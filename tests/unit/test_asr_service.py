@@ -0,0 +1,405 @@
+"""
+测试 ASR 服务模块
+"""
+import pytest
+import pytest_asyncio
+import asyncio
+import base64
+import json
+import websockets
+from backend.services.asr_service import DashScopeASR, ASRConnectionPool
+
+
+class FakeWebSocket:
+    """记录发送内容的假 WebSocket"""
+    
+    def __init__(self):
+        self.sent = []
+    
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+    
+    async def close(self):
+        pass
+
+
+async def start_fake_asr(**kwargs) -> DashScopeASR:
+    """创建使用假 WebSocket 的 ASR 实例并开始识别"""
+    asr = DashScopeASR(api_key="test-key", **kwargs)
+    asr.ws = FakeWebSocket()
+    asr.is_connected = True
+    await asr.start_recognition(sample_rate=16000)
+    return asr
+
+
+def audio_messages(ws: FakeWebSocket):
+    """提取发送的音频消息"""
+    return [m for m in ws.sent if m["type"] == "input_audio_buffer.append"]
+
+
+class TestDashScopeASRUplink:
+    """测试 DashScopeASR 上行发送"""
+    
+    def test_init_without_key_raises(self, monkeypatch):
+        """测试没有 API Key 时抛出异常"""
+        monkeypatch.delenv("DASHSCOPE_API_KEY", raising=False)
+        with pytest.raises(ValueError):
+            DashScopeASR()
+    
+    @pytest.mark.asyncio
+    async def test_coalesces_small_chunks(self):
+        """测试小块音频合并为固定时长的帧"""
+        asr = await start_fake_asr(frame_ms=100)
+        
+        # 100ms @ 16kHz 16-bit = 3200 字节，分 4 块送入
+        for i in range(4):
+            await asr.send_audio(bytes([i]) * 800)
+        await asr.flush()
+        
+        messages = audio_messages(asr.ws)
+        assert len(messages) == 1
+        audio = base64.b64decode(messages[0]["audio"])
+        assert audio == b"\x00" * 800 + b"\x01" * 800 + b"\x02" * 800 + b"\x03" * 800
+        assert asr.frames_sent == 1
+        
+        await asr.disconnect()
+    
+    @pytest.mark.asyncio
+    async def test_splits_large_chunk(self):
+        """测试大块音频被拆分为多帧"""
+        asr = await start_fake_asr(frame_ms=100)
+        
+        await asr.send_audio(b"\x01" * 8000)
+        await asr.flush()
+        
+        sizes = [len(base64.b64decode(m["audio"])) for m in audio_messages(asr.ws)]
+        assert sizes == [3200, 3200, 1600]
+        
+        await asr.disconnect()
+    
+    @pytest.mark.asyncio
+    async def test_stop_sends_remaining_audio_before_finish(self):
+        """测试停止识别时先发送剩余音频再结束会话"""
+        asr = await start_fake_asr(frame_ms=100)
+        
+        await asr.send_audio(b"\x01" * 100)
+        await asr.stop_recognition()
+        
+        types = [m["type"] for m in asr.ws.sent]
+        assert types == ["session.update", "input_audio_buffer.append", "session.finish"]
+        
+        await asr.disconnect()
+    
+    @pytest.mark.asyncio
+    async def test_full_queue_drops_oldest(self):
+        """测试队列满时丢弃最旧的帧而不阻塞调用方"""
+        asr = await start_fake_asr(frame_ms=10, queue_size=2)
+        
+        # 10ms = 320 字节，一次送入 5 帧，发送任务尚未运行
+        frames = b"".join(bytes([i]) * 320 for i in range(5))
+        await asr.send_audio(frames)
+        assert asr.frames_dropped == 3
+        
+        await asr.flush()
+        sent = [base64.b64decode(m["audio"])[0] for m in audio_messages(asr.ws)]
+        assert sent == [3, 4]
+        
+        await asr.disconnect()
+    
+    @pytest.mark.asyncio
+    async def test_dropped_frames_not_in_replay_buffer(self):
+        """测试丢弃的帧不写入重放缓冲区，上游确认位置与缓冲区位置一致"""
+        asr = await start_fake_asr(frame_ms=10, queue_size=2)
+        
+        frames = b"".join(bytes([i, 0]) * 160 for i in range(5))
+        await asr.send_audio(frames)
+        await asr.flush()
+        assert asr._ring.end == 2 * 160
+        
+        # 上游收到的第一帧结束于 10ms，对应缓冲区中第 160 个采样点
+        asr._ack(10)
+        assert asr._acked == 160
+        assert asr._ring.read(asr._acked).tobytes() == bytes([4, 0]) * 160
+        
+        await asr.disconnect()
+    
+    @pytest.mark.asyncio
+    async def test_send_audio_when_not_running(self):
+        """测试未启动时发送音频被忽略"""
+        asr = DashScopeASR(api_key="test-key")
+        await asr.send_audio(b"\x00" * 320)
+        assert asr.frames_sent == 0
+
+
+
+@pytest_asyncio.fixture
+async def fake_realtime_server():
+    """本地假 Realtime WebSocket 服务器，代替 DashScope"""
+    connections = []
+    
+    async def handler(ws):
+        ws.received = []
+        connections.append(ws)
+        await ws.send(json.dumps({"type": "session.created", "session": {"id": "fake"}}))
+        async for message in ws:
+            data = json.loads(message)
+            ws.received.append(data)
+            if data["type"] == "session.update":
+                await ws.send(json.dumps({"type": "session.updated"}))
+    
+    server = await websockets.serve(handler, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    
+    def factory():
+        asr = DashScopeASR(api_key="test-key")
+        asr.url = f"ws://127.0.0.1:{port}"
+        return asr
+    
+    yield factory, connections
+    
+    server.close()
+    await server.wait_closed()
+
+
+async def wait_until(predicate, timeout: float = 2.0):
+    """等待条件成立"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("等待超时")
+        await asyncio.sleep(0.01)
+
+
+class TestASRConnectionPool:
+    """测试 ASRConnectionPool 类"""
+    
+    @pytest.mark.asyncio
+    async def test_warms_sessions(self, fake_realtime_server):
+        """测试启动后预热指定数量的会话"""
+        factory, connections = fake_realtime_server
+        pool = ASRConnectionPool(size=2, factory=factory)
+        
+        await pool.start()
+        await wait_until(lambda: pool.get_stats()["idle"] == 2)
+        
+        assert len(connections) == 2
+        await pool.close()
+    
+    @pytest.mark.asyncio
+    async def test_acquire_warm_session_and_replenish(self, fake_realtime_server):
+        """测试取出预热会话后自动补充"""
+        factory, connections = fake_realtime_server
+        pool = ASRConnectionPool(size=1, factory=factory)
+        
+        await pool.start()
+        await wait_until(lambda: pool.get_stats()["idle"] == 1)
+        
+        asr = await pool.acquire()
+        assert asr.is_connected
+        assert asr.is_running
+        assert pool.hits == 1
+        
+        await wait_until(lambda: pool.get_stats()["idle"] == 1)
+        assert len(connections) == 2
+        
+        await asr.disconnect()
+        await pool.close()
+    
+    @pytest.mark.asyncio
+    async def test_acquire_without_warm_session(self, fake_realtime_server):
+        """测试没有预热会话时直接新建"""
+        factory, _ = fake_realtime_server
+        pool = ASRConnectionPool(size=1, factory=factory)
+        
+        asr = await pool.acquire()
+        assert asr.is_running
+        assert pool.misses == 1
+        
+        await asr.disconnect()
+    
+    @pytest.mark.asyncio
+    async def test_acquire_different_sample_rate(self, fake_realtime_server):
+        """测试采样率不同时不使用预热会话"""
+        factory, _ = fake_realtime_server
+        pool = ASRConnectionPool(size=1, sample_rate=16000, factory=factory)
+        
+        await pool.start()
+        await wait_until(lambda: pool.get_stats()["idle"] == 1)
+        
+        asr = await pool.acquire(sample_rate=8000)
+        assert pool.misses == 1
+        assert pool.get_stats()["idle"] == 1
+        
+        await asr.disconnect()
+        await pool.close()
+    
+    @pytest.mark.asyncio
+    async def test_stale_session_discarded(self, fake_realtime_server):
+        """测试闲置过久的会话被丢弃"""
+        factory, _ = fake_realtime_server
+        pool = ASRConnectionPool(size=1, max_idle_seconds=0, check_interval=60, factory=factory)
+        
+        await pool.start()
+        await wait_until(lambda: pool.get_stats()["idle"] == 1)
+        
+        asr = await pool.acquire()
+        assert pool.hits == 0
+        assert pool.misses == 1
+        
+        await asr.disconnect()
+        await pool.close()
+    
+    @pytest.mark.asyncio
+    async def test_close_waits_for_discarded_sessions(self):
+        """测试关闭连接池时等待后台关闭会话的任务完成"""
+        closed = []
+        
+        class SlowASR:
+            async def disconnect(self):
+                await asyncio.sleep(0.05)
+                closed.append(self)
+        
+        pool = ASRConnectionPool(size=0)
+        asr = SlowASR()
+        pool._discard(asr)
+        assert len(pool._close_tasks) == 1
+        
+        await pool.close()
+        assert closed == [asr]
+        assert not pool._close_tasks
+
+
+
+class TestDashScopeASRReconnect:
+    """测试 DashScopeASR 断线重连"""
+    
+    @pytest.mark.asyncio
+    async def test_reconnect_replays_unacknowledged_audio(self, fake_realtime_server):
+        """测试重连后只重放未确认的音频"""
+        factory, connections = fake_realtime_server
+        asr = factory()
+        asr.RECONNECT_BACKOFF = (0.01,)
+        await asr.connect()
+        await asr.start_recognition(sample_rate=16000)
+        
+        # 第一帧（100ms = 1600 采样点）被上游确认
+        await asr.send_audio(b"\x01\x00" * 1600)
+        await wait_until(lambda: len(audio_messages_of(connections[0])) == 1)
+        await connections[0].send(json.dumps({
+            "type": "input_audio_buffer.speech_stopped",
+            "audio_end_ms": 100
+        }))
+        await wait_until(lambda: asr._acked == 1600)
+        
+        # 第二帧发出后连接中断
+        await asr.send_audio(b"\x02\x00" * 1600)
+        await wait_until(lambda: len(audio_messages_of(connections[0])) == 2)
+        await connections[0].close()
+        
+        await wait_until(lambda: asr.reconnects == 1)
+        assert asr.is_connected
+        
+        replayed = audio_messages_of(connections[1])
+        assert connections[1].received[0]["type"] == "session.update"
+        assert len(replayed) == 1
+        assert base64.b64decode(replayed[0]["audio"]) == b"\x02\x00" * 1600
+        
+        await asr.disconnect()
+    
+    @pytest.mark.asyncio
+    async def test_audio_during_reconnect_is_kept(self, fake_realtime_server):
+        """测试重连期间送入的音频在重连后发送"""
+        factory, connections = fake_realtime_server
+        asr = factory()
+        asr.RECONNECT_BACKOFF = (0.2,)
+        await asr.connect()
+        await asr.start_recognition(sample_rate=16000)
+        await wait_until(lambda: len(connections) == 1)
+        
+        await connections[0].close()
+        await wait_until(lambda: not asr.is_connected)
+        
+        assert asr.is_active
+        await asr.send_audio(b"\x03\x00" * 1600)
+        
+        await wait_until(lambda: asr.reconnects == 1)
+        await wait_until(lambda: len(audio_messages_of(connections[1])) == 1)
+        assert base64.b64decode(audio_messages_of(connections[1])[0]["audio"]) == b"\x03\x00" * 1600
+        
+        await asr.disconnect()
+    
+    @pytest.mark.asyncio
+    async def test_connection_closed_during_replay_retries(self, fake_realtime_server):
+        """测试重放时连接再次中断会继续重连"""
+        factory, connections = fake_realtime_server
+        asr = factory()
+        asr.RECONNECT_BACKOFF = (0.01,)
+        await asr.connect()
+        await asr.start_recognition(sample_rate=16000)
+        await wait_until(lambda: len(connections) == 1)
+        
+        replay = asr._replay
+        calls = []
+        
+        async def flaky_replay():
+            calls.append(1)
+            if len(calls) == 1:
+                raise websockets.exceptions.ConnectionClosed(None, None)
+            await replay()
+        
+        asr._replay = flaky_replay
+        await connections[0].close()
+        
+        await wait_until(lambda: asr.reconnects == 1)
+        assert len(calls) == 2
+        assert len(connections) == 3
+        assert asr._online.is_set()
+        assert asr.is_active
+        
+        await asr.disconnect()
+    
+    @pytest.mark.asyncio
+    async def test_no_reconnect_after_disconnect(self, fake_realtime_server):
+        """测试主动断开后不重连"""
+        factory, connections = fake_realtime_server
+        asr = factory()
+        await asr.connect()
+        await asr.start_recognition(sample_rate=16000)
+        
+        await asr.disconnect()
+        await asyncio.sleep(0.05)
+        
+        assert len(connections) == 1
+        assert asr.reconnects == 0
+    
+    def test_dedupe_final_after_reconnect(self):
+        """测试重连窗口内去除重复的识别结果"""
+        asr = DashScopeASR(api_key="test-key")
+        assert asr._dedupe_final("今天我们学习二次函数") == "今天我们学习二次函数"
+        
+        asr._dedupe_until = float("inf")
+        assert asr._dedupe_final("学习二次函数") is None
+        assert asr._dedupe_final("学习二次函数的图像") == "的图像"
+        assert asr._dedupe_final("老师这个怎么算") == "老师这个怎么算"
+        assert asr._dedupe_final("老师这个怎么算") is None
+    
+    def test_dedupe_keeps_short_utterances(self):
+        """测试重连窗口内出现在之前句子中的简短回答不会被去掉"""
+        asr = DashScopeASR(api_key="test-key")
+        asr._dedupe_until = float("inf")
+        asr._dedupe_final("好的我们来看下一题对不对")
+        
+        assert asr._dedupe_final("好的") == "好的"
+        assert asr._dedupe_final("对") == "对"
+        assert asr._dedupe_final("下一题") == "下一题"
+        # 之前句子被重放的结尾仍然去掉
+        assert asr._dedupe_final("来看下一题对不对") is None
+
+
+def audio_messages_of(connection):
+    """提取假服务器某个连接收到的音频消息"""
+    return [m for m in connection.received if m["type"] == "input_audio_buffer.append"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -3,7 +3,7 @@
 """
 import pytest
 import numpy as np
-from backend.utils.audio import AudioProcessor, audio_processor
+from backend.utils.audio import AudioProcessor, AudioRingBuffer, StreamingVAD, audio_processor
 
 
 class TestAudioProcessor:
@@ -44,6 +44,21 @@ class TestAudioProcessor:
         recovered = processor.bytes_to_numpy(result)
         np.testing.assert_array_equal(recovered, test_data)
     
+    def test_downmix_to_mono(self):
+        """测试多声道混合为单声道"""
+        processor = AudioProcessor()
+        stereo = np.array([100, 300, -200, -400, 0, 10], dtype=np.int16)
+        
+        result = processor.downmix_to_mono(stereo.tobytes(), channels=2)
+        mono = processor.bytes_to_numpy(result)
+        np.testing.assert_array_equal(mono, np.array([200, -300, 5], dtype=np.int16))
+    
+    def test_downmix_to_mono_passthrough(self):
+        """测试单声道直接返回"""
+        processor = AudioProcessor()
+        audio_bytes = np.array([1, 2, 3], dtype=np.int16).tobytes()
+        assert processor.downmix_to_mono(audio_bytes, channels=1) is audio_bytes
+    
     def test_calculate_rms_silence(self):
         """测试静音的 RMS"""
         processor = AudioProcessor()
@@ -149,6 +164,109 @@ class TestAudioProcessor:
         assert audio_processor.sample_rate == 16000
 
 
+
+class TestAudioRingBuffer:
+    """测试 AudioRingBuffer 类"""
+    
+    def test_write_and_read(self):
+        """测试写入和读取"""
+        ring = AudioRingBuffer(capacity=10)
+        ring.write(np.arange(4, dtype=np.int16))
+        
+        np.testing.assert_array_equal(ring.read(0), np.arange(4))
+        np.testing.assert_array_equal(ring.read(2), np.array([2, 3]))
+        assert ring.end == 4
+    
+    def test_wraparound(self):
+        """测试覆盖最旧的数据"""
+        ring = AudioRingBuffer(capacity=5)
+        ring.write(np.arange(4, dtype=np.int16))
+        ring.write(np.arange(4, 8, dtype=np.int16))
+        
+        assert ring.start == 3
+        np.testing.assert_array_equal(ring.read(0), np.arange(3, 8))
+        np.testing.assert_array_equal(ring.read(6), np.array([6, 7]))
+    
+    def test_write_larger_than_capacity(self):
+        """测试单次写入超过容量"""
+        ring = AudioRingBuffer(capacity=3)
+        ring.write(np.arange(1, dtype=np.int16))
+        ring.write(np.arange(10, dtype=np.int16))
+        
+        assert ring.end == 11
+        np.testing.assert_array_equal(ring.read(0), np.array([7, 8, 9]))
+    
+    def test_read_past_end(self):
+        """测试读取位置超过已写入数据"""
+        ring = AudioRingBuffer(capacity=3)
+        ring.write(np.arange(2, dtype=np.int16))
+        assert len(ring.read(5)) == 0
+
+
+
+def make_tone(ms: int, amplitude: int = 10000, sample_rate: int = 16000) -> bytes:
+    """生成指定时长的正弦波 PCM"""
+    t = np.arange(sample_rate * ms // 1000) / sample_rate
+    return (np.sin(2 * np.pi * 440 * t) * amplitude).astype(np.int16).tobytes()
+
+
+def make_silence(ms: int, sample_rate: int = 16000) -> bytes:
+    """生成指定时长的静音 PCM"""
+    return np.zeros(sample_rate * ms // 1000, dtype=np.int16).tobytes()
+
+
+class TestStreamingVAD:
+    """测试 StreamingVAD 类"""
+    
+    def test_silence_is_skipped(self):
+        """测试静音不放行"""
+        vad = StreamingVAD()
+        assert vad.process(make_silence(1000)) == b""
+        assert vad.frames_total == 50
+        assert vad.frames_sent == 0
+    
+    def test_speech_is_sent(self):
+        """测试语音全部放行"""
+        vad = StreamingVAD()
+        tone = make_tone(200)
+        assert vad.process(tone) == tone
+    
+    def test_preroll_before_onset(self):
+        """测试语音开始前补发预录音频"""
+        vad = StreamingVAD(frame_ms=20, preroll_ms=100)
+        vad.process(make_silence(500))
+        
+        out = vad.process(make_tone(100))
+        # 5 帧预录 + 5 帧语音
+        assert len(out) == 2 * 16000 * 200 // 1000
+    
+    def test_hangover_after_speech(self):
+        """测试语音结束后的拖尾"""
+        vad = StreamingVAD(frame_ms=20, hangover_ms=100, preroll_ms=0)
+        vad.process(make_tone(100))
+        
+        out = vad.process(make_silence(500))
+        assert len(out) == 2 * 16000 * 100 // 1000
+    
+    def test_partial_frames_across_chunks(self):
+        """测试不足一帧的数据跨块拼接"""
+        vad = StreamingVAD(frame_ms=20)
+        tone = make_tone(40)
+        
+        out = vad.process(tone[:500]) + vad.process(tone[500:])
+        assert out == tone
+    
+    def test_get_stats(self):
+        """测试统计信息"""
+        vad = StreamingVAD(frame_ms=20, hangover_ms=0, preroll_ms=0)
+        vad.process(make_tone(100) + make_silence(100))
+        
+        stats = vad.get_stats()
+        assert stats["frames_total"] == 10
+        assert stats["frames_sent"] == 5
+        assert stats["sent_ratio"] == 0.5
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
 
@@ -2,8 +2,12 @@
 测试缓存模块
 """
 import pytest
+import asyncio
 import time
-from backend.utils.cache import SimpleCache, cache_key, cached, global_cache
+from concurrent.futures import ThreadPoolExecutor
+from backend.utils.cache import (
+    SimpleCache, LRUCache, cache_key, fast_cache_key, cached, global_cache, estimate_size
+)
 
 
 class TestSimpleCache:
@@ -108,6 +112,106 @@ class TestSimpleCache:
         assert stats["total_requests"] == 2
 
 
+class TestLRUCache:
+    """测试 LRUCache 的淘汰和分片"""
+    
+    def test_lru_eviction(self):
+        """测试超过条目数时淘汰最久未使用的条目"""
+        cache = LRUCache(max_entries=3, num_shards=1)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        cache.get("a")
+        cache.set("d", 4)
+        
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("d") == 4
+        assert cache.get_stats()["evictions"] == 1
+    
+    def test_expired_evicted_first(self):
+        """测试超出容量时优先清理已过期的条目"""
+        cache = LRUCache(max_entries=2, num_shards=1)
+        cache.set("a", 1)
+        cache.set("short", 2, ttl=-1)
+        cache.get("a")
+        cache.set("c", 3)
+        
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        stats = cache.get_stats()
+        assert stats["evictions"] == 0
+        assert stats["expirations"] == 1
+    
+    def test_bytes_budget(self):
+        """测试超过内存预算时淘汰条目"""
+        value = "x" * 1000
+        cache = LRUCache(max_bytes=estimate_size(value) * 3, num_shards=1)
+        for i in range(10):
+            cache.set(f"key{i}", value)
+        
+        stats = cache.get_stats()
+        assert stats["size"] < 3
+        assert stats["bytes"] <= cache.max_bytes
+        assert cache.get("key9") == value
+    
+    def test_oversized_value_rejected(self):
+        """测试单个条目超过预算时不缓存"""
+        cache = LRUCache(max_bytes=100, num_shards=1)
+        cache.set("big", "x" * 1000)
+        
+        assert cache.get("big") is None
+        assert cache.get_stats()["rejected"] == 1
+    
+    def test_overwrite_updates_bytes(self):
+        """测试覆盖写入时更新内存占用"""
+        cache = LRUCache(num_shards=1)
+        cache.set("key", "x" * 1000)
+        cache.set("key", "y")
+        
+        assert cache.get_stats()["bytes"] == estimate_size("key") + estimate_size("y")
+        cache.delete("key")
+        assert cache.get_stats()["bytes"] == 0
+    
+    def test_concurrent_threads(self):
+        """测试线程池并发读写"""
+        cache = LRUCache(max_entries=500, num_shards=4)
+        
+        def worker(n):
+            for i in range(200):
+                cache.set(f"{n}-{i}", i)
+                cache.get(f"{n}-{i}")
+        
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(worker, range(8)))
+        
+        stats = cache.get_stats()
+        assert stats["size"] <= 500
+        assert stats["hits"] + stats["misses"] == 1600
+        assert stats["size"] + stats["evictions"] == 1600
+    
+    @pytest.mark.asyncio
+    async def test_sweeper(self):
+        """测试后台任务定期清理过期条目"""
+        cache = LRUCache(sweep_interval=0.01)
+        cache.set("a", 1, ttl=-1)
+        cache.set("b", 2)
+        
+        cache.start_sweeper()
+        await asyncio.sleep(0.05)
+        await cache.stop_sweeper()
+        
+        stats = cache.get_stats()
+        assert stats["size"] == 1
+        assert stats["expirations"] == 1
+        assert stats["sweeps"] >= 1
+    
+    def test_simple_cache_alias(self):
+        """测试兼容原有名称"""
+        assert SimpleCache is LRUCache
+        assert isinstance(global_cache, LRUCache)
+
+
 class TestCacheKey:
     """测试 cache_key 函数"""
     
@@ -171,6 +275,167 @@ class TestCachedDecorator:
         
         stats = custom_cache.get_stats()
         assert stats["hits"] == 1
+    
+    def test_sync_single_flight(self):
+        """测试多线程同时未命中时只计算一次"""
+        calls = []
+        
+        @cached(ttl=10, cache_instance=LRUCache())
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.05)
+            return x * 2
+        
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(slow, [1, 1, 1, 1]))
+        
+        assert results == [2, 2, 2, 2]
+        assert calls == [1]
+    
+    def test_large_results_respect_bytes_budget(self):
+        """测试装饰器缓存的大结果计入内存预算并触发淘汰"""
+        value = "x" * 100000
+        cache = LRUCache(max_bytes=estimate_size(value) * 3, num_shards=1)
+        
+        @cached(ttl=10, cache_instance=cache)
+        def func(x):
+            return value
+        
+        for i in range(10):
+            func(i)
+        
+        stats = cache.get_stats()
+        assert stats["size"] < 3
+        assert stats["evictions"] > 0
+        assert stats["bytes"] <= cache.max_bytes
+    
+    def test_cache_none_and_invalidate(self):
+        """测试缓存 None 结果和手动失效"""
+        calls = []
+        
+        @cached(ttl=10, cache_instance=LRUCache())
+        def func(x):
+            calls.append(x)
+            return None
+        
+        assert func(1) is None
+        assert func(1) is None
+        assert len(calls) == 1
+        
+        assert func.invalidate(1)
+        func(1)
+        assert len(calls) == 2
+
+
+class TestAsyncCachedDecorator:
+    """测试 cached 装饰器用于协程函数"""
+    
+    @pytest.mark.asyncio
+    async def test_cached_coroutine(self):
+        """测试缓存协程的结果而不是协程对象"""
+        calls = []
+        
+        @cached(ttl=10, cache_instance=LRUCache())
+        async def func(x):
+            calls.append(x)
+            return x + 1
+        
+        assert await func(1) == 2
+        assert await func(1) == 2
+        assert await func(2) == 3
+        assert calls == [1, 2]
+    
+    @pytest.mark.asyncio
+    async def test_single_flight(self):
+        """测试同时未命中时只计算一次"""
+        calls = []
+        
+        @cached(ttl=10, cache_instance=LRUCache())
+        async def slow(x):
+            calls.append(x)
+            await asyncio.sleep(0.02)
+            return x * 2
+        
+        results = await asyncio.gather(*(slow(3) for _ in range(5)))
+        
+        assert results == [6] * 5
+        assert calls == [3]
+    
+    @pytest.mark.asyncio
+    async def test_error_not_cached(self):
+        """测试计算出错时所有等待方收到异常且不缓存"""
+        calls = []
+        
+        @cached(ttl=10, cache_instance=LRUCache())
+        async def broken():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+        
+        results = await asyncio.gather(broken(), broken(), return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+        assert len(calls) == 1
+        
+        with pytest.raises(ValueError):
+            await broken()
+        assert len(calls) == 2
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_caller_does_not_cancel_others(self):
+        """测试一个调用方取消时其他调用方仍能拿到结果"""
+        @cached(ttl=10, cache_instance=LRUCache())
+        async def slow():
+            await asyncio.sleep(0.03)
+            return "done"
+        
+        first = asyncio.create_task(slow())
+        second = asyncio.create_task(slow())
+        await asyncio.sleep(0.01)
+        first.cancel()
+        
+        assert await second == "done"
+        assert first.cancelled()
+    
+    @pytest.mark.asyncio
+    async def test_stale_while_revalidate(self):
+        """测试过期后先返回旧值并在后台刷新"""
+        version = 0
+        
+        @cached(ttl=0.05, stale_ttl=10, cache_instance=LRUCache())
+        async def func():
+            nonlocal version
+            version += 1
+            await asyncio.sleep(0.01)
+            return version
+        
+        assert await func() == 1
+        await asyncio.sleep(0.06)
+        
+        # 过期后立即返回旧值，刷新在后台进行
+        assert await func() == 1
+        await asyncio.sleep(0.03)
+        assert await func() == 2
+        assert version == 2
+
+
+class TestFastCacheKey:
+    """测试 fast_cache_key 函数"""
+    
+    def test_distinguishes_types(self):
+        """测试不同类型的参数生成不同键"""
+        keys = {fast_cache_key(1), fast_cache_key("1"), fast_cache_key(True), fast_cache_key(1.0)}
+        assert len(keys) == 4
+    
+    def test_kwargs_order(self):
+        """测试关键字参数顺序不影响键"""
+        assert fast_cache_key(a=1, b=2) == fast_cache_key(b=2, a=1)
+    
+    def test_long_key_hashed(self):
+        """测试过长的键取哈希"""
+        key = fast_cache_key("x" * 1000)
+        assert len(key) == 32
+        assert key == fast_cache_key("x" * 1000)
+        assert key != fast_cache_key("y" * 1000)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,7 @@
 测试对话历史管理模块
 """
 import pytest
+import asyncio
 from datetime import datetime
 from backend.core.conversation import (
     ConversationTurn,
@@ -11,6 +12,33 @@ from backend.core.conversation import (
 from backend.core.role import Role
 
 
+class SlowSummaryService:
+    """等待放行后才返回摘要的假模型服务"""
+    
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.calls = 0
+    
+    async def simple_chat(self, prompt, **kwargs):
+        self.calls += 1
+        await self.release.wait()
+        return "AI摘要"
+
+
+class FailingSummaryService:
+    """调用总是失败的假模型服务"""
+    
+    async def simple_chat(self, prompt, **kwargs):
+        raise RuntimeError("upstream error")
+
+
+def fill_history(history: ConversationHistory, rounds: int = 3):
+    """添加足够触发压缩的对话"""
+    for i in range(rounds):
+        history.add_turn(Role.TEACHER, f"This is a long sentence number {i} with many words to increase token count.")
+        history.add_turn(Role.STUDENT, f"Question {i}?")
+
+
 class TestConversationTurn:
     """测试 ConversationTurn 类"""
     
@@ -123,6 +151,41 @@ class TestConversationHistory:
         assert "Hello" in context
         assert "Hi" in context
     
+    def test_get_context_order_and_budget(self):
+        """测试摘要在前、对话在后，并按预算从最新的对话向前截取"""
+        history = ConversationHistory(l1_size=2, compression_threshold=10 ** 6)
+        for i in range(4):
+            history.add_turn(Role.TEACHER, f"turn{i}")
+        history._trigger_compression()
+        turn_tokens = history.l1_cache[-1].tokens
+        
+        assert history.get_context() == (
+            "[历史摘要]: 教师: turn0 | 教师: turn1\n教师: turn2\n教师: turn3"
+        )
+        assert history.get_context(max_tokens=turn_tokens * 2) == "教师: turn2\n教师: turn3"
+    
+    def test_get_context_cache_invalidated(self):
+        """测试添加对话后上下文缓存失效"""
+        history = ConversationHistory()
+        history.add_turn(Role.TEACHER, "Hello")
+        assert history.get_context(max_tokens=2000) == "教师: Hello"
+        
+        history.add_turn(Role.STUDENT, "Hi")
+        assert history.get_context(max_tokens=2000) == "教师: Hello\n学生: Hi"
+        
+        history.clear()
+        assert history.get_context(max_tokens=2000) == ""
+    
+    def test_running_token_totals(self):
+        """测试压缩后各层 token 数与实际一致"""
+        history = ConversationHistory(l1_size=2, l2_size=2, compression_threshold=50)
+        fill_history(history, rounds=8)
+        
+        stats = history.get_stats()
+        assert stats["l1_tokens"] == sum(t.tokens for t in history.l1_cache)
+        assert stats["l2_tokens"] == sum(s.tokens for s in history.l2_cache)
+        assert stats["total_tokens"] == stats["l1_tokens"] + stats["l2_tokens"]
+    
     def test_get_context_with_token_limit(self):
         """测试带 token 限制的上下文获取"""
         history = ConversationHistory()
@@ -214,6 +277,88 @@ class TestConversationHistory:
         assert len(history.l1_cache) <= 2 * 2  # 2轮 * 2条消息
 
 
+
+class TestBackgroundCompression:
+    """测试后台压缩"""
+    
+    @pytest.mark.asyncio
+    async def test_simple_summary_then_ai_summary(self, monkeypatch):
+        """测试先放入简单摘要，大模型摘要生成后替换"""
+        service = SlowSummaryService()
+        monkeypatch.setattr("backend.core.conversation.openai_service", service)
+        history = ConversationHistory(l1_size=2, compression_threshold=50, ai_summary=True)
+        
+        fill_history(history)
+        assert len(history.l2_cache) > 0
+        assert all("AI摘要" != s.summary_text for s in history.l2_cache)
+        
+        service.release.set()
+        await history.wait_for_compression()
+        
+        assert all(s.summary_text == "AI摘要" for s in history.l2_cache)
+        assert history.ai_summaries == len(history.l2_cache)
+        expected_tokens = sum(t.tokens for t in history.l1_cache) + sum(s.tokens for s in history.l2_cache)
+        assert history.total_tokens == expected_tokens
+        
+        await history.stop_compression_worker()
+    
+    @pytest.mark.asyncio
+    async def test_add_turn_does_not_wait_for_ai(self, monkeypatch):
+        """测试添加对话不等待大模型摘要"""
+        service = SlowSummaryService()
+        monkeypatch.setattr("backend.core.conversation.openai_service", service)
+        history = ConversationHistory(l1_size=2, compression_threshold=50, ai_summary=True)
+        
+        fill_history(history)
+        assert history.get_stats()["pending_summaries"] > 0
+        assert history.ai_summaries == 0
+        
+        await history.stop_compression_worker()
+    
+    @pytest.mark.asyncio
+    async def test_failed_ai_summary_not_counted(self, monkeypatch):
+        """测试大模型摘要失败降级时保留简单摘要，不计入大模型摘要数"""
+        monkeypatch.setattr("backend.core.conversation.openai_service", FailingSummaryService())
+        history = ConversationHistory(l1_size=2, compression_threshold=50, ai_summary=True)
+        
+        fill_history(history)
+        placeholders = list(history.l2_cache)
+        version = history._version
+        await history.wait_for_compression()
+        
+        assert history.ai_summaries == 0
+        assert history.l2_cache == placeholders
+        assert all(a is b for a, b in zip(history.l2_cache, placeholders))
+        assert history._version == version
+        
+        await history.stop_compression_worker()
+    
+    @pytest.mark.asyncio
+    async def test_result_dropped_after_clear(self, monkeypatch):
+        """测试历史清空后丢弃迟到的摘要"""
+        service = SlowSummaryService()
+        monkeypatch.setattr("backend.core.conversation.openai_service", service)
+        history = ConversationHistory(l1_size=2, compression_threshold=50, ai_summary=True)
+        
+        fill_history(history)
+        history.clear()
+        service.release.set()
+        await history.wait_for_compression()
+        
+        assert history.l2_cache == []
+        assert history.total_tokens == 0
+        
+        await history.stop_compression_worker()
+    
+    def test_without_event_loop_keeps_simple_summary(self):
+        """测试不在事件循环中时只使用简单摘要"""
+        history = ConversationHistory(l1_size=2, compression_threshold=50, ai_summary=True)
+        fill_history(history)
+        
+        assert len(history.l2_cache) > 0
+        assert history.get_stats()["pending_summaries"] == 0
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
 
@@ -2,9 +2,31 @@
 测试回复生成模块
 """
 import pytest
+from datetime import datetime
 from backend.core.generator import ReplyGenerator, reply_generator
-from backend.core.conversation import ConversationHistory
+from backend.core.conversation import ConversationHistory, ConversationSummary
 from backend.core.role import Role
+from backend.core.reply_cache import ReplyCache
+from backend.utils.tracing import UtteranceTrace, current_trace
+
+
+class FakeOpenAIService:
+    """记录调用次数的假模型服务"""
+    
+    def __init__(self):
+        self.calls = 0
+    
+    async def chat_completion(self, messages, **kwargs):
+        self.calls += 1
+        return {"content": f"回复{self.calls}"}
+    
+    async def chat_completion_hedged(self, messages, **kwargs):
+        return await self.chat_completion(messages, **kwargs)
+    
+    async def chat_completion_stream(self, messages, **kwargs):
+        self.calls += 1
+        for chunk in ["回复", str(self.calls)]:
+            yield chunk
 
 
 class TestReplyGenerator:
@@ -100,6 +122,95 @@ class TestReplyGenerator:
         )
         assert reply is None
     
+    @pytest.mark.asyncio
+    async def test_generate_uses_cache(self, monkeypatch):
+        """测试重复提问命中缓存，不再调用模型"""
+        fake = FakeOpenAIService()
+        monkeypatch.setattr("backend.core.generator.openai_service", fake)
+        generator = ReplyGenerator(cache=ReplyCache())
+        
+        first = await generator.generate("老师这个再讲一遍可以吗？")
+        second = await generator.generate("老师，这个再讲一遍可以吗")
+        assert first == second == "回复1"
+        assert fake.calls == 1
+        
+        # 上下文不同时重新生成
+        third = await generator.generate("老师这个再讲一遍可以吗？", context="第二章")
+        assert third == "回复2"
+    
+    @pytest.mark.asyncio
+    async def test_generate_stream_uses_cache(self, monkeypatch):
+        """测试流式生成的回复写入缓存"""
+        fake = FakeOpenAIService()
+        monkeypatch.setattr("backend.core.generator.openai_service", fake)
+        generator = ReplyGenerator(cache=ReplyCache())
+        
+        chunks = [chunk async for chunk in generator.generate_stream("什么是变量？")]
+        assert "".join(chunks) == "回复1"
+        
+        cached = [chunk async for chunk in generator.generate_stream("什么是变量")]
+        assert cached == ["回复1"]
+        assert fake.calls == 1
+    
+    @pytest.mark.asyncio
+    async def test_generate_marks_stages(self, monkeypatch):
+        """测试生成回复时在当前追踪上记录各阶段"""
+        fake = FakeOpenAIService()
+        monkeypatch.setattr("backend.core.generator.openai_service", fake)
+        generator = ReplyGenerator(cache=ReplyCache())
+        
+        trace = UtteranceTrace()
+        token = current_trace.set(trace)
+        try:
+            await generator.generate("什么是函数？")
+            assert set(trace.marks) == {"context_built", "llm_first_token"}
+            
+            cached_trace = UtteranceTrace()
+            current_trace.set(cached_trace)
+            await generator.generate("什么是函数")
+            assert set(cached_trace.marks) == {"reply_cache_hit"}
+        finally:
+            current_trace.reset(token)
+    
+    def test_context_fingerprint(self):
+        """测试教师发言或摘要更新后上下文指纹变化，学生发言不影响指纹"""
+        generator = ReplyGenerator()
+        history = ConversationHistory()
+        before = generator.context_fingerprint(conversation_history=history)
+        
+        history.add_turn(Role.TEACHER, "今天学习Python")
+        after_teacher = generator.context_fingerprint(conversation_history=history)
+        assert after_teacher != before
+        
+        history.add_turn(Role.STUDENT, "什么是变量")
+        assert generator.context_fingerprint(conversation_history=history) == after_teacher
+        
+        history.l2_cache.append(ConversationSummary(1, "变量的定义", [], 5, datetime.now()))
+        assert generator.context_fingerprint(conversation_history=history) != after_teacher
+    
+    @pytest.mark.asyncio
+    async def test_new_teacher_turn_invalidates_cache(self, monkeypatch):
+        """测试两次相同的提问之间教师讲了新内容时不命中缓存"""
+        fake = FakeOpenAIService()
+        monkeypatch.setattr("backend.core.generator.openai_service", fake)
+        generator = ReplyGenerator(cache=ReplyCache())
+        history = ConversationHistory()
+        
+        history.add_turn(Role.TEACHER, "变量用来保存数据")
+        history.add_turn(Role.STUDENT, "老师这个再讲一遍可以吗？")
+        first = await generator.generate("老师这个再讲一遍可以吗？", conversation_history=history)
+        
+        # 学生重复提问，教师没有讲新内容，命中缓存
+        history.add_turn(Role.STUDENT, "老师这个再讲一遍可以吗？")
+        assert await generator.generate("老师这个再讲一遍可以吗？", conversation_history=history) == first
+        assert fake.calls == 1
+        
+        history.add_turn(Role.TEACHER, "函数是一段可以复用的代码")
+        history.add_turn(Role.STUDENT, "老师这个再讲一遍可以吗？")
+        second = await generator.generate("老师这个再讲一遍可以吗？", conversation_history=history)
+        assert second != first
+        assert fake.calls == 2
+    
     def test_global_instance(self):
         """测试全局实例"""
         assert reply_generator is not None
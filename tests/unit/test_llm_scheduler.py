@@ -0,0 +1,175 @@
+"""
+测试大模型请求调度模块
+"""
+import pytest
+import asyncio
+from backend.services.llm_scheduler import (
+    LLMScheduler, LLMPriority, llm_context, current_llm_priority, current_llm_session
+)
+
+
+async def hold_slot(scheduler: LLMScheduler, order: list, name: str, priority: LLMPriority, session_id: str = ""):
+    """获取名额后记录调度顺序"""
+    async with scheduler.slot(priority, session_id):
+        order.append(name)
+        await asyncio.sleep(0)
+
+
+class TestLLMScheduler:
+    """测试 LLMScheduler 类"""
+    
+    @pytest.mark.asyncio
+    async def test_limits_concurrency(self):
+        """测试同时进行的请求数不超过上限"""
+        scheduler = LLMScheduler(max_concurrency=2)
+        running = []
+        peak = []
+        
+        async def job():
+            async with scheduler.slot():
+                running.append(1)
+                peak.append(len(running))
+                await asyncio.sleep(0.01)
+                running.pop()
+        
+        await asyncio.gather(*[job() for _ in range(6)])
+        assert max(peak) == 2
+        assert scheduler.in_flight == 0
+    
+    @pytest.mark.asyncio
+    async def test_priority_order(self):
+        """测试有空位时先调度高优先级请求"""
+        scheduler = LLMScheduler(max_concurrency=1)
+        order = []
+        
+        await scheduler.acquire()
+        tasks = [
+            asyncio.create_task(hold_slot(scheduler, order, "debug", LLMPriority.DEBUG)),
+            asyncio.create_task(hold_slot(scheduler, order, "summary", LLMPriority.SUMMARY)),
+            asyncio.create_task(hold_slot(scheduler, order, "reply", LLMPriority.LIVE_REPLY)),
+            asyncio.create_task(hold_slot(scheduler, order, "role", LLMPriority.ROLE_ID)),
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.queued() == 4
+        
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        assert order == ["reply", "role", "summary", "debug"]
+    
+    @pytest.mark.asyncio
+    async def test_fair_across_sessions(self):
+        """测试同一优先级内按会话轮转"""
+        scheduler = LLMScheduler(max_concurrency=1)
+        order = []
+        
+        await scheduler.acquire()
+        tasks = [
+            asyncio.create_task(hold_slot(scheduler, order, f"a{i}", LLMPriority.LIVE_REPLY, "a"))
+            for i in range(3)
+        ] + [
+            asyncio.create_task(hold_slot(scheduler, order, f"b{i}", LLMPriority.LIVE_REPLY, "b"))
+            for i in range(2)
+        ]
+        await asyncio.sleep(0)
+        
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        assert order == ["a0", "b0", "a1", "b1", "a2"]
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_removed(self):
+        """测试排队中取消的请求不占用名额"""
+        scheduler = LLMScheduler(max_concurrency=1)
+        order = []
+        
+        await scheduler.acquire()
+        cancelled = asyncio.create_task(hold_slot(scheduler, order, "cancelled", LLMPriority.LIVE_REPLY))
+        waiting = asyncio.create_task(hold_slot(scheduler, order, "waiting", LLMPriority.SUMMARY))
+        await asyncio.sleep(0)
+        
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.queued() == 1
+        
+        scheduler.release()
+        await waiting
+        assert order == ["waiting"]
+        assert scheduler.in_flight == 0
+    
+    @pytest.mark.asyncio
+    async def test_reserved_slot_for_live_reply(self):
+        """测试后台请求占满可用名额时，实时回复仍能立即获得预留的名额"""
+        scheduler = LLMScheduler(max_concurrency=3, reserved_slots=1)
+        order = []
+        done = asyncio.Event()
+        
+        async def background(name: str, priority: LLMPriority):
+            async with scheduler.slot(priority, name):
+                order.append(name)
+                await done.wait()
+        
+        tasks = [
+            asyncio.create_task(background(f"summary{i}", LLMPriority.SUMMARY))
+            for i in range(3)
+        ] + [
+            asyncio.create_task(background(f"role{i}", LLMPriority.ROLE_ID))
+            for i in range(2)
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.in_flight == 2
+        assert scheduler.background_in_flight == 2
+        assert scheduler.queued() == 3
+        
+        # 后台请求在排队，实时回复不用等待
+        await asyncio.wait_for(scheduler.acquire(LLMPriority.LIVE_REPLY), 0.1)
+        assert scheduler.in_flight == 3
+        scheduler.release(LLMPriority.LIVE_REPLY)
+        
+        # 归还实时回复的名额后，后台请求仍不能占用预留的名额
+        assert scheduler.in_flight == 2
+        assert scheduler.queued() == 3
+        
+        done.set()
+        await asyncio.gather(*tasks)
+        assert len(order) == 5
+        assert scheduler.in_flight == 0
+        assert scheduler.background_in_flight == 0
+    
+    def test_reserved_slots_leave_one_for_background(self):
+        """测试预留名额不会超过上限减一"""
+        assert LLMScheduler(max_concurrency=1, reserved_slots=1).reserved_slots == 0
+        assert LLMScheduler(max_concurrency=4, reserved_slots=2).reserved_slots == 2
+    
+    @pytest.mark.asyncio
+    async def test_context_priority_and_session(self):
+        """测试从上下文读取优先级和会话"""
+        scheduler = LLMScheduler(max_concurrency=1)
+        
+        with llm_context(priority=LLMPriority.SUMMARY, session_id="s1"):
+            assert current_llm_priority.get() == LLMPriority.SUMMARY
+            assert current_llm_session.get() == "s1"
+            async with scheduler.slot():
+                pass
+        
+        assert current_llm_priority.get() == LLMPriority.LIVE_REPLY
+        assert scheduler.get_stats()["priorities"]["summary"]["scheduled"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_queue_time_stats(self):
+        """测试记录排队时间"""
+        scheduler = LLMScheduler(max_concurrency=1)
+        
+        await scheduler.acquire()
+        task = asyncio.create_task(hold_slot(scheduler, [], "reply", LLMPriority.LIVE_REPLY))
+        await asyncio.sleep(0.02)
+        scheduler.release()
+        await task
+        
+        stats = scheduler.get_stats()["priorities"]["live_reply"]
+        assert stats["scheduled"] == 2
+        assert stats["max_wait"] >= 0.02
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
+
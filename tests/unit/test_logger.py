@@ -4,14 +4,32 @@
 import pytest
 import logging
 import json
+import queue
 from backend.utils.logger import (
     StructuredFormatter,
+    RateLimitFilter,
+    NonBlockingQueueHandler,
+    dumps,
     setup_logging,
+    stop_logging,
     get_logger,
     log_with_trace
 )
 
 
+def make_record(msg="Test message", level=logging.INFO, lineno=10, args=(), exc_info=None):
+    """构造日志记录"""
+    return logging.LogRecord(
+        name="test",
+        level=level,
+        pathname="test.py",
+        lineno=lineno,
+        msg=msg,
+        args=args,
+        exc_info=exc_info
+    )
+
+
 class TestStructuredFormatter:
     """测试 StructuredFormatter 类"""
     
@@ -82,6 +100,14 @@ class TestStructuredFormatter:
             
             assert "exception" in data
             assert "ValueError" in data["exception"]
+    
+    def test_dumps_keeps_unicode(self):
+        """测试 JSON 序列化保留中文，不支持的类型转为字符串"""
+        result = dumps({"message": "收到消息", "value": object.__new__(object)})
+        data = json.loads(result)
+        
+        assert "收到消息" in result
+        assert data["value"].startswith("<object")
 
 
 class TestSetupLogging:
@@ -110,6 +136,94 @@ class TestSetupLogging:
         assert has_structured
 
 
+class TestRateLimitFilter:
+    """测试高频日志限流"""
+    
+    def test_drops_over_rate(self):
+        """测试同一调用位置超过突发条数后丢弃"""
+        log_filter = RateLimitFilter(rate=0.001, burst=3)
+        results = [log_filter.filter(make_record()) for _ in range(10)]
+        
+        assert results == [True] * 3 + [False] * 7
+        assert log_filter.dropped == 7
+    
+    def test_sites_are_independent(self):
+        """测试不同调用位置分别限流"""
+        log_filter = RateLimitFilter(rate=0.001, burst=1)
+        
+        assert log_filter.filter(make_record(lineno=1))
+        assert not log_filter.filter(make_record(lineno=1))
+        assert log_filter.filter(make_record(lineno=2))
+    
+    def test_warnings_not_limited(self):
+        """测试警告及以上级别不限流"""
+        log_filter = RateLimitFilter(rate=0.001, burst=1)
+        
+        assert all(log_filter.filter(make_record(level=logging.WARNING)) for _ in range(5))
+    
+    def test_reports_suppressed(self):
+        """测试恢复后的第一条日志带上丢弃条数"""
+        log_filter = RateLimitFilter(rate=1000, burst=1)
+        log_filter.filter(make_record())
+        
+        # 手动耗尽令牌
+        log_filter._buckets[("test.py", 10)][0] = 0
+        log_filter._buckets[("test.py", 10)][2] = 4
+        
+        import time
+        time.sleep(0.01)
+        record = make_record()
+        assert log_filter.filter(record)
+        assert record.suppressed == 4
+        assert json.loads(StructuredFormatter().format(record))["suppressed"] == 4
+
+
+class TestQueuedLogging:
+    """测试经队列由后台线程写日志"""
+    
+    def test_prepare_merges_args_and_exception(self):
+        """测试放入队列前合并消息参数并转换异常"""
+        handler = NonBlockingQueueHandler(queue.Queue())
+        try:
+            raise ValueError("Test error")
+        except ValueError:
+            import sys
+            record = make_record("收到消息: %s", args=("audio",), exc_info=sys.exc_info())
+        
+        prepared = handler.prepare(record)
+        assert prepared.msg == "收到消息: audio"
+        assert prepared.args is None
+        assert prepared.exc_info is None
+        
+        data = json.loads(StructuredFormatter().format(prepared))
+        assert data["message"] == "收到消息: audio"
+        assert "ValueError" in data["exception"]
+    
+    def test_queue_full_drops(self):
+        """测试队列满时丢弃而不阻塞"""
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+        handler.handle(make_record())
+        handler.handle(make_record())
+        
+        assert handler.dropped == 1
+    
+    def test_writes_in_background(self, tmp_path):
+        """测试后台线程写入日志文件"""
+        log_file = tmp_path / "app.log"
+        setup_logging(level="INFO", log_file=str(log_file), queued=True, rate_limit=1000)
+        try:
+            root_logger = logging.getLogger()
+            assert isinstance(root_logger.handlers[0], NonBlockingQueueHandler)
+            
+            get_logger("test_queued").info("后台写入 %d", 1)
+        finally:
+            stop_logging()
+            setup_logging(level="INFO", structured=False)
+        
+        lines = log_file.read_text(encoding="utf-8").splitlines()
+        assert json.loads(lines[-1])["message"] == "后台写入 1"
+
+
 class TestGetLogger:
     """测试 get_logger 函数"""
     
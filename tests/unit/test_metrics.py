@@ -2,8 +2,12 @@
 测试性能监控模块
 """
 import pytest
+import random
+import statistics
 import time
-from backend.utils.metrics import MetricsCollector, Timer, timed, global_metrics
+from backend.utils.metrics import (
+    MetricsCollector, Histogram, RollingHistogram, Timer, timed, global_metrics
+)
 
 
 class TestMetricsCollector:
@@ -15,9 +19,17 @@ class TestMetricsCollector:
         assert collector.max_history == 100
         assert len(collector.metrics) == 0
     
+    def test_record_without_history(self):
+        """测试默认不保留原始样本，只写入直方图"""
+        collector = MetricsCollector()
+        collector.record("test_metric", 1.5)
+        
+        assert len(collector.metrics) == 0
+        assert collector.get_stats("test_metric")["count"] == 1
+    
     def test_record(self):
         """测试记录指标"""
-        collector = MetricsCollector()
+        collector = MetricsCollector(max_history=10)
         collector.record("test_metric", 1.5)
         
         assert "test_metric" in collector.metrics
@@ -26,7 +38,7 @@ class TestMetricsCollector:
     
     def test_record_with_tags(self):
         """测试带标签的指标记录"""
-        collector = MetricsCollector()
+        collector = MetricsCollector(max_history=10)
         collector.record("test_metric", 2.0, tags={"env": "test"})
         
         metric = collector.metrics["test_metric"][0]
@@ -74,7 +86,7 @@ class TestMetricsCollector:
     
     def test_clear_specific(self):
         """测试清空特定指标"""
-        collector = MetricsCollector()
+        collector = MetricsCollector(max_history=10)
         collector.record("metric1", 1.0)
         collector.record("metric2", 2.0)
         
@@ -85,13 +97,178 @@ class TestMetricsCollector:
     
     def test_clear_all(self):
         """测试清空所有指标"""
-        collector = MetricsCollector()
+        collector = MetricsCollector(max_history=10)
         collector.record("metric1", 1.0)
         collector.record("metric2", 2.0)
         
         collector.clear()
         
         assert len(collector.metrics) == 0
+    
+    def test_window_stats(self):
+        """测试按时间窗口统计"""
+        collector = MetricsCollector(slot_seconds=1, window_slots=10)
+        collector.record("metric", 1.0)
+        
+        assert collector.get_stats("metric", window_seconds=5)["count"] == 1
+        assert collector.get_stats("metric")["count"] == 1
+    
+    def test_tags_series(self):
+        """测试按标签分序列统计并可合并"""
+        collector = MetricsCollector()
+        collector.record("latency", 1.0, tags={"priority": "live_reply"})
+        collector.record("latency", 2.0, tags={"priority": "summary"})
+        collector.record("latency", 3.0, tags={"priority": "summary"})
+        
+        assert collector.get_stats("latency")["count"] == 3
+        assert collector.snapshot("latency", tags={"priority": "summary"}).count == 2
+        assert len(collector.series("latency")) == 2
+    
+    def test_counters_and_gauges(self):
+        """测试计数器和仪表盘"""
+        collector = MetricsCollector()
+        collector.increment("requests")
+        collector.increment("requests", 2, tags={"status": "error"})
+        collector.set_gauge("connections", 3)
+        collector.set_gauge("connections", 1)
+        
+        assert collector.get_counters() == {"requests": 3}
+        assert collector.get_gauges() == {"connections": {"": 1}}
+        assert "requests" not in collector.get_all_stats()
+        
+        collector.clear("requests")
+        assert collector.get_counters() == {}
+
+
+class TestOpenMetrics:
+    """测试 OpenMetrics 导出"""
+    
+    def test_render(self):
+        """测试导出计数器、仪表盘和直方图"""
+        collector = MetricsCollector()
+        collector.increment("asr.ingest_bytes", 3200, tags={"session": "ws-1"})
+        collector.set_gauge("ws.connections", 2)
+        collector.record("reply.latency", 0.5, tags={"session": "ws-1", "stage": "llm"})
+        collector.record("reply.latency", 1.5, tags={"session": "ws-1", "stage": "llm"})
+        
+        text = collector.render_openmetrics()
+        
+        assert "# TYPE asr_ingest_bytes counter" in text
+        assert 'asr_ingest_bytes_total{session="ws-1"} 3200' in text
+        assert "ws_connections 2" in text
+        assert "# TYPE reply_latency histogram" in text
+        assert 'reply_latency_bucket{session="ws-1",stage="llm",le="0.5"} 1' in text
+        assert 'reply_latency_bucket{session="ws-1",stage="llm",le="+Inf"} 2' in text
+        assert 'reply_latency_count{session="ws-1",stage="llm"} 2' in text
+        assert 'reply_latency_sum{session="ws-1",stage="llm"} 2' in text
+        assert text.endswith("# EOF\n")
+    
+    def test_label_escaping(self):
+        """测试标签值转义"""
+        collector = MetricsCollector()
+        collector.increment("errors", tags={"message": 'bad "value"\n'})
+        
+        assert 'errors_total{message="bad \\"value\\"\\n"} 1' in collector.render_openmetrics()
+    
+    def test_export_buckets_cumulative(self):
+        """测试导出的桶计数单调递增且包含所有样本"""
+        histogram = Histogram()
+        for value in [0.0, 0.0005, 0.01, 0.2, 3.0, 5000.0]:
+            histogram.record(value)
+        
+        buckets = histogram.export_buckets()
+        counts = [count for _, count in buckets]
+        bounds = [bound for bound, _ in buckets]
+        
+        assert counts == sorted(counts)
+        assert bounds == sorted(bounds)
+        assert counts[0] == 2
+        assert counts[-1] == 5
+    
+    def test_remove_series(self):
+        """测试删除会话的指标序列"""
+        collector = MetricsCollector()
+        collector.increment("asr.ingest_bytes", 10, tags={"session": "a"})
+        collector.increment("asr.ingest_bytes", 10, tags={"session": "b"})
+        collector.record("reply.latency", 1.0, tags={"session": "a"})
+        
+        assert collector.remove_series({"session": "a"}) == 2
+        assert collector.get_counters() == {"asr.ingest_bytes": 10}
+        assert "reply.latency" not in collector.histograms
+
+
+class TestHistogram:
+    """测试 Histogram 类"""
+    
+    def test_quantiles_within_error(self):
+        """测试分位数估算的相对误差"""
+        rng = random.Random(0)
+        values = [rng.lognormvariate(0, 1) for _ in range(5000)]
+        histogram = Histogram()
+        for value in values:
+            histogram.record(value)
+        
+        exact = statistics.quantiles(values, n=100)
+        assert histogram.quantile(0.5) == pytest.approx(statistics.median(values), rel=0.05)
+        assert histogram.quantile(0.95) == pytest.approx(exact[94], rel=0.05)
+        assert histogram.quantile(0.99) == pytest.approx(exact[98], rel=0.05)
+        
+        stats = histogram.stats()
+        assert stats["count"] == 5000
+        assert stats["min"] == min(values)
+        assert stats["max"] == max(values)
+        assert stats["mean"] == pytest.approx(statistics.mean(values))
+        assert stats["stdev"] == pytest.approx(statistics.stdev(values))
+    
+    def test_zero_and_single_value(self):
+        """测试零值和单个样本"""
+        histogram = Histogram()
+        histogram.record(0.0)
+        assert histogram.stats()["p99"] == 0.0
+        
+        single = Histogram()
+        single.record(0.25)
+        assert single.stats()["median"] == 0.25
+        assert single.stats()["stdev"] == 0
+    
+    def test_merge(self):
+        """测试合并快照"""
+        a = Histogram()
+        b = Histogram()
+        for i in range(1, 51):
+            a.record(float(i))
+        for i in range(51, 101):
+            b.record(float(i))
+        
+        merged = a.copy().merge(b)
+        assert merged.count == 100
+        assert merged.min == 1.0
+        assert merged.max == 100.0
+        assert merged.quantile(0.5) == pytest.approx(50, rel=0.05)
+        assert a.count == 50
+
+
+class TestRollingHistogram:
+    """测试 RollingHistogram 类"""
+    
+    def test_old_slots_expire(self):
+        """测试窗口外的时间片不参与统计"""
+        histogram = RollingHistogram(slot_seconds=10, num_slots=6)
+        histogram.record(1.0, now=0)
+        histogram.record(2.0, now=35)
+        histogram.record(3.0, now=55)
+        
+        assert histogram.snapshot(30, now=55).count == 2
+        assert histogram.snapshot(10, now=55).count == 1
+        assert histogram.snapshot(None).count == 3
+    
+    def test_slot_reused_after_wraparound(self):
+        """测试时间片循环复用时清空旧数据"""
+        histogram = RollingHistogram(slot_seconds=10, num_slots=3)
+        histogram.record(1.0, now=0)
+        histogram.record(2.0, now=30)
+        
+        assert histogram.snapshot(30, now=30).count == 1
 
 
 class TestTimer:
@@ -104,9 +281,9 @@ class TestTimer:
         with Timer(collector, "test_duration"):
             time.sleep(0.1)
         
-        assert "test_duration" in collector.metrics
-        duration = collector.metrics["test_duration"][0].value
-        assert 0.09 < duration < 0.15
+        stats = collector.get_stats("test_duration")
+        assert stats["count"] == 1
+        assert 0.09 < stats["max"] < 0.15
     
     def test_timer_with_tags(self):
         """测试带标签的计时器"""
@@ -115,8 +292,8 @@ class TestTimer:
         with Timer(collector, "test_duration", tags={"operation": "test"}):
             time.sleep(0.05)
         
-        metric = collector.metrics["test_duration"][0]
-        assert metric.tags["operation"] == "test"
+        assert collector.snapshot("test_duration", tags={"operation": "test"}).count == 1
+        assert collector.snapshot("test_duration", tags={"operation": "other"}).count == 0
 
 
 class TestTimedDecorator:
@@ -134,9 +311,9 @@ class TestTimedDecorator:
         result = slow_function()
         
         assert result == "done"
-        assert "func_duration" in collector.metrics
-        duration = collector.metrics["func_duration"][0].value
-        assert 0.04 < duration < 0.1
+        stats = collector.get_stats("func_duration")
+        assert stats["count"] == 1
+        assert 0.04 < stats["max"] < 0.1
 
 
 if __name__ == "__main__":
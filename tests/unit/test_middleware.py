@@ -2,13 +2,15 @@
 测试中间件模块
 """
 import pytest
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, WebSocket
 from fastapi.testclient import TestClient
 from backend.utils.middleware import (
+    APIMiddleware,
     RequestTracingMiddleware,
     ErrorHandlingMiddleware,
     RateLimitMiddleware
 )
+from tests.benchmarks.middleware_benchmark import run_benchmark
 
 
 @pytest.fixture
@@ -66,6 +68,33 @@ def app_with_rate_limit():
     return app
 
 
+@pytest.fixture
+def app_with_api_middleware():
+    """创建带合并中间件的应用"""
+    app = FastAPI()
+    app.add_middleware(APIMiddleware, max_requests=3, window_seconds=60)
+    
+    @app.get("/test")
+    async def test_endpoint(request: Request):
+        return {"trace_id": request.state.trace_id}
+    
+    @app.get("/value_error")
+    async def value_error_endpoint():
+        raise ValueError("Validation failed")
+    
+    @app.get("/generic_error")
+    async def generic_error_endpoint():
+        raise RuntimeError("Something went wrong")
+    
+    @app.websocket("/ws/echo")
+    async def echo(websocket: WebSocket):
+        await websocket.accept()
+        await websocket.send_text(await websocket.receive_text())
+        await websocket.close()
+    
+    return app
+
+
 class TestRequestTracingMiddleware:
     """测试请求追踪中间件"""
     
@@ -158,6 +187,62 @@ class TestRateLimitMiddleware:
         assert data["error"] == "RateLimitExceeded"
 
 
+
+class TestAPIMiddleware:
+    """测试合并后的中间件"""
+    
+    def test_trace_id_in_state_and_header(self, app_with_api_middleware):
+        """测试追踪ID同时写入请求状态和响应头"""
+        client = TestClient(app_with_api_middleware)
+        response = client.get("/test")
+        
+        assert response.status_code == 200
+        assert response.json()["trace_id"] == response.headers["X-Trace-ID"]
+    
+    def test_error_response_carries_trace_id(self, app_with_api_middleware):
+        """测试错误响应带有追踪ID"""
+        client = TestClient(app_with_api_middleware)
+        response = client.get("/value_error")
+        
+        assert response.status_code == 400
+        data = response.json()
+        assert data["error"] == "ValidationError"
+        assert data["trace_id"] == response.headers["X-Trace-ID"]
+        
+        response = client.get("/generic_error")
+        assert response.status_code == 500
+        assert response.json()["error"] == "InternalServerError"
+    
+    def test_rate_limited_before_tracing(self, app_with_api_middleware):
+        """测试被限流的请求直接返回 429，不分配追踪ID"""
+        client = TestClient(app_with_api_middleware)
+        for _ in range(3):
+            assert client.get("/test").status_code == 200
+        
+        response = client.get("/test")
+        assert response.status_code == 429
+        assert response.json()["error"] == "RateLimitExceeded"
+        assert "X-Trace-ID" not in response.headers
+    
+    def test_websocket_bypasses_middleware(self, app_with_api_middleware):
+        """测试 WebSocket 连接不经过限流和追踪"""
+        client = TestClient(app_with_api_middleware)
+        for _ in range(5):
+            with client.websocket_connect("/ws/echo") as websocket:
+                websocket.send_text("hello")
+                assert websocket.receive_text() == "hello"
+        
+        assert client.get("/test").status_code == 200
+    
+    @pytest.mark.asyncio
+    async def test_benchmark_runs(self):
+        """测试性能基准可以运行"""
+        results = await run_benchmark(requests=20, rounds=1)
+        
+        assert set(results) == {"none", "legacy", "fused"}
+        assert all(rps > 0 for rps in results.values())
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
 
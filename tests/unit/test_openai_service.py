@@ -2,7 +2,52 @@
 测试 OpenAI 服务模块
 """
 import pytest
+import asyncio
+from types import SimpleNamespace
 from backend.services.openai_service import OpenAIService
+from backend.services.llm_scheduler import LLMScheduler, LLMPriority
+
+
+class FakeCompletions:
+    """假的 chat.completions 接口，记录上游请求次数"""
+    
+    def __init__(self, delay: float = 0.05, chunks=("你", "好"), model_delays=None):
+        self.delay = delay
+        self.chunks = chunks
+        self.model_delays = model_delays or {}
+        self.calls = 0
+        self.models = []
+        self.cancelled = 0
+    
+    async def create(self, model, messages, temperature, max_tokens, stream):
+        self.calls += 1
+        self.models.append(model)
+        try:
+            await asyncio.sleep(self.model_delays.get(model, self.delay))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        
+        if stream:
+            return self._stream()
+        
+        message = SimpleNamespace(content=f'{model}:{messages[-1]["content"]}', role="assistant")
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=message, finish_reason="stop")],
+            usage=SimpleNamespace(prompt_tokens=1, completion_tokens=1, total_tokens=2)
+        )
+    
+    async def _stream(self):
+        for text in self.chunks:
+            await asyncio.sleep(self.delay)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+def make_service(**kwargs) -> OpenAIService:
+    """创建使用假客户端的服务"""
+    service = OpenAIService(api_key="test-key", base_url="https://test.com", model="test-model")
+    service.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(**kwargs)))
+    return service
 
 
 class TestOpenAIService:
@@ -20,6 +65,17 @@ class TestOpenAIService:
         assert service.base_url == "https://test.com"
         assert service.model == "test-model"
     
+    def test_client_created_lazily(self):
+        """测试客户端首次访问时才创建"""
+        service = OpenAIService(api_key="test-key", base_url="https://test.com")
+        assert service._client is None
+        
+        service.warm_up()
+        client = service.client
+        assert client is not None
+        assert service.client is client
+        assert str(client.base_url).startswith("https://test.com")
+    
     def test_init_without_key_raises(self):
         """测试没有 API Key 时抛出异常"""
         # 需要模拟 settings 中也没有 key 的情况
@@ -79,6 +135,239 @@ class TestOpenAIService:
             pytest.skip(f"API 调用失败: {e}")
 
 
+
+class TestRequestCoalescing:
+    """测试相同请求合并"""
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_identical_requests_share_upstream(self):
+        """测试同时进行的相同请求只发起一次上游调用"""
+        service = make_service()
+        messages = [{"role": "user", "content": "什么是变量"}]
+        
+        results = await asyncio.gather(*[
+            service.chat_completion(messages=messages, temperature=0.1) for _ in range(5)
+        ])
+        
+        assert all(r["content"] == "test-model:什么是变量" for r in results)
+        assert service.client.chat.completions.calls == 1
+        assert service.get_stats()["coalesced_requests"] == 4
+        assert service.get_stats()["inflight"] == 0
+    
+    @pytest.mark.asyncio
+    async def test_different_params_not_coalesced(self):
+        """测试参数不同的请求分别调用"""
+        service = make_service()
+        messages = [{"role": "user", "content": "什么是变量"}]
+        
+        await asyncio.gather(
+            service.chat_completion(messages=messages, temperature=0.1),
+            service.chat_completion(messages=messages, temperature=0.9)
+        )
+        assert service.client.chat.completions.calls == 2
+    
+    @pytest.mark.asyncio
+    async def test_sequential_requests_not_coalesced(self):
+        """测试前一个请求完成后再次请求会重新调用"""
+        service = make_service(delay=0)
+        messages = [{"role": "user", "content": "什么是变量"}]
+        
+        await service.chat_completion(messages=messages)
+        await service.chat_completion(messages=messages)
+        assert service.client.chat.completions.calls == 2
+    
+    @pytest.mark.asyncio
+    async def test_cancel_one_waiter_keeps_request(self):
+        """测试部分调用方取消时上游请求继续，全部取消时才取消"""
+        service = make_service(delay=0.1)
+        messages = [{"role": "user", "content": "什么是变量"}]
+        
+        first = asyncio.create_task(service.chat_completion(messages=messages))
+        second = asyncio.create_task(service.chat_completion(messages=messages))
+        await asyncio.sleep(0.01)
+        
+        first.cancel()
+        assert (await second)["content"] == "test-model:什么是变量"
+        assert service.client.chat.completions.cancelled == 0
+        
+        third = asyncio.create_task(service.chat_completion(messages=messages))
+        await asyncio.sleep(0.01)
+        third.cancel()
+        await asyncio.sleep(0.01)
+        assert service.client.chat.completions.cancelled == 1
+    
+    @pytest.mark.asyncio
+    async def test_stream_fan_out(self):
+        """测试流式请求的片段转发给所有订阅者"""
+        service = make_service(delay=0.02, chunks=("变量", "是", "容器"))
+        messages = [{"role": "user", "content": "什么是变量"}]
+        
+        async def collect(delay: float = 0):
+            await asyncio.sleep(delay)
+            return [chunk async for chunk in service.chat_completion_stream(messages=messages)]
+        
+        # 第二个订阅者在第一个片段之后加入，仍能收到完整内容
+        results = await asyncio.gather(collect(), collect(0.05))
+        assert results == [["变量", "是", "容器"]] * 2
+        assert service.client.chat.completions.calls == 1
+    
+    @pytest.mark.asyncio
+    async def test_coalesce_disabled(self):
+        """测试关闭合并时每次都调用上游"""
+        service = make_service()
+        service.coalesce = False
+        messages = [{"role": "user", "content": "什么是变量"}]
+        
+        await asyncio.gather(*[service.chat_completion(messages=messages) for _ in range(3)])
+        assert service.client.chat.completions.calls == 3
+
+    
+    @pytest.mark.asyncio
+    async def test_scheduler_priority(self):
+        """测试通过调度器时实时回复先于摘要执行"""
+        service = make_service(delay=0.01)
+        service.scheduler = LLMScheduler(max_concurrency=1)
+        order = []
+        
+        async def call(content, priority):
+            response = await service.chat_completion(
+                messages=[{"role": "user", "content": content}], priority=priority
+            )
+            order.append(response["content"].split(":")[1])
+        
+        await asyncio.gather(
+            call("debug", LLMPriority.DEBUG),
+            call("summary", LLMPriority.SUMMARY),
+            call("reply", LLMPriority.LIVE_REPLY)
+        )
+        assert order == ["debug", "reply", "summary"]
+    
+    @pytest.mark.asyncio
+    async def test_live_reply_not_coalesced_with_background(self):
+        """测试实时回复不会加入排队中的同内容后台请求"""
+        service = make_service(delay=0.01)
+        service.scheduler = LLMScheduler(max_concurrency=2, reserved_slots=1)
+        messages = [{"role": "user", "content": "问题"}]
+        
+        # 后台名额被占满，摘要请求排队
+        await service.scheduler.acquire(LLMPriority.SUMMARY)
+        summary = asyncio.create_task(service.chat_completion(messages=messages, priority=LLMPriority.SUMMARY))
+        await asyncio.sleep(0.01)
+        assert service.scheduler.queued() == 1
+        
+        response = await asyncio.wait_for(
+            service.chat_completion(messages=messages, priority=LLMPriority.LIVE_REPLY), 0.5
+        )
+        assert response["content"] == "test-model:问题"
+        assert service.coalesced_requests == 0
+        assert not summary.done()
+        
+        service.scheduler.release(LLMPriority.SUMMARY)
+        await summary
+        assert service.client.chat.completions.calls == 2
+
+
+
+class TestHedgedCompletion:
+    """测试对冲和截止时间"""
+    
+    @pytest.mark.asyncio
+    async def test_fast_primary_no_hedge(self):
+        """测试原请求及时返回时不发起对冲"""
+        service = make_service(delay=0.01)
+        service.default_hedge_delay = 0.1
+        
+        response = await service.chat_completion_hedged(
+            messages=[{"role": "user", "content": "问题"}], hedge_model="fast-model"
+        )
+        assert response["content"] == "test-model:问题"
+        assert service.hedged_requests == 0
+    
+    @pytest.mark.asyncio
+    async def test_hedge_wins_and_cancels_primary(self):
+        """测试原请求过慢时对冲请求获胜并取消原请求"""
+        service = make_service(delay=0.01, model_delays={"test-model": 1.0})
+        service.default_hedge_delay = 0.05
+        completions = service.client.chat.completions
+        
+        response = await service.chat_completion_hedged(
+            messages=[{"role": "user", "content": "问题"}], hedge_model="fast-model"
+        )
+        await asyncio.sleep(0.01)
+        
+        assert response["content"] == "fast-model:问题"
+        assert completions.models == ["test-model", "fast-model"]
+        assert completions.cancelled == 1
+        assert service.hedge_wins == 1
+    
+    @pytest.mark.asyncio
+    async def test_hedge_same_model_not_coalesced(self):
+        """测试对冲请求使用同一模型时仍然单独发起"""
+        service = make_service(delay=0.1)
+        service.default_hedge_delay = 0.01
+        
+        await service.chat_completion_hedged(messages=[{"role": "user", "content": "问题"}])
+        assert service.client.chat.completions.calls == 2
+    
+    @pytest.mark.asyncio
+    async def test_hedge_delay_starts_after_scheduler_slot(self):
+        """测试在调度器中排队时不发起对冲请求，对冲等待从获得名额开始计时"""
+        service = make_service(delay=0.03)
+        service.default_hedge_delay = 0.05
+        service.scheduler = LLMScheduler(max_concurrency=1)
+        await service.scheduler.acquire()
+        
+        task = asyncio.create_task(service.chat_completion_hedged(
+            messages=[{"role": "user", "content": "问题"}], hedge_model="fast-model"
+        ))
+        await asyncio.sleep(0.15)
+        assert service.hedged_requests == 0
+        assert service.client.chat.completions.calls == 0
+        
+        service.scheduler.release()
+        response = await task
+        assert response["content"] == "test-model:问题"
+        assert service.hedged_requests == 0
+        # 耗时样本不包含排队时间
+        assert service._latencies[-1] < 0.1
+    
+    @pytest.mark.asyncio
+    async def test_deadline_exceeded(self):
+        """测试超过时间预算时取消请求并抛出超时"""
+        service = make_service(delay=1.0)
+        
+        with pytest.raises(asyncio.TimeoutError):
+            await service.chat_completion_hedged(
+                messages=[{"role": "user", "content": "问题"}], budget=0.05, hedge=False
+            )
+        await asyncio.sleep(0.01)
+        assert service.client.chat.completions.cancelled == 1
+        assert service.deadline_exceeded == 1
+    
+    @pytest.mark.asyncio
+    async def test_deadline_applies_to_scheduler_queue(self):
+        """测试截止时间传递给调度器，排队超时不再等待"""
+        service = make_service(delay=1.0)
+        service.scheduler = LLMScheduler(max_concurrency=1)
+        await service.scheduler.acquire()
+        
+        with pytest.raises(asyncio.TimeoutError):
+            await service.chat_completion_hedged(
+                messages=[{"role": "user", "content": "问题"}], budget=0.05, hedge=False
+            )
+        await asyncio.sleep(0.01)
+        assert service.scheduler.queued() == 0
+        assert service.client.chat.completions.calls == 0
+    
+    def test_hedge_delay_from_p95(self):
+        """测试样本足够时对冲延迟取 p95"""
+        service = make_service()
+        assert service.hedge_delay() == service.default_hedge_delay
+        
+        service._latencies.extend([0.1] * 95 + [1.0] * 5)
+        assert 0.1 <= service.hedge_delay() <= 1.0
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
 
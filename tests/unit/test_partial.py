@@ -0,0 +1,79 @@
+"""
+测试中间识别结果处理模块
+"""
+import pytest
+import asyncio
+from backend.core.partial import PartialTranscriptTracker, EarlyReply, normalize_transcript
+from backend.core.role import Role
+
+
+class TestPartialTranscriptTracker:
+    """测试 PartialTranscriptTracker 类"""
+    
+    def test_stable_after_unchanged_updates(self):
+        """测试连续多次结果相同后判定稳定"""
+        tracker = PartialTranscriptTracker(stable_updates=3)
+        
+        assert not tracker.update("老师这个")
+        assert not tracker.update("老师这个公式")
+        assert not tracker.update("老师这个公式")
+        assert tracker.update("老师这个公式")
+        assert tracker.stable_text == "老师这个公式"
+    
+    def test_stable_on_question_ending(self):
+        """测试以疑问标记结尾时立即判定稳定"""
+        tracker = PartialTranscriptTracker(stable_updates=3)
+        assert tracker.update("这个公式怎么推导的呢")
+    
+    def test_short_text_ignored(self):
+        """测试过短的文本不判定稳定"""
+        tracker = PartialTranscriptTracker(stable_updates=2)
+        assert not tracker.update("好吗")
+        assert not tracker.update("好吗")
+    
+    def test_triggers_once_until_reset(self):
+        """测试每句话只触发一次"""
+        tracker = PartialTranscriptTracker(stable_updates=3)
+        assert tracker.update("这个公式怎么推导？")
+        assert not tracker.update("这个公式怎么推导？")
+        
+        tracker.reset()
+        assert tracker.stable_text is None
+        assert tracker.update("那这一步为什么？")
+
+
+class TestEarlyReply:
+    """测试 EarlyReply 类"""
+    
+    @pytest.mark.asyncio
+    async def test_matches(self):
+        """测试最终结果与中间结果的一致性判断"""
+        role_task = asyncio.create_task(asyncio.sleep(0, result=Role.STUDENT))
+        early = EarlyReply("老师这个公式怎么推导的", role_task)
+        
+        assert early.matches("老师，这个公式怎么推导的？")
+        assert early.matches("老师这个公式是怎么推导的")
+        assert not early.matches("老师这个公式怎么推导的，还有下一题怎么做")
+        
+        await role_task
+    
+    @pytest.mark.asyncio
+    async def test_cancel(self):
+        """测试取消提前启动的任务"""
+        role_task = asyncio.create_task(asyncio.sleep(10))
+        reply_task = asyncio.create_task(asyncio.sleep(10))
+        early = EarlyReply("这个公式怎么推导", role_task, reply_task)
+        
+        early.cancel()
+        await asyncio.sleep(0)
+        assert role_task.cancelled()
+        assert reply_task.cancelled()
+    
+    def test_normalize_transcript(self):
+        """测试规范化去除标点和空白"""
+        assert normalize_transcript("老师， 这个 What？") == "老师这个what"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
+
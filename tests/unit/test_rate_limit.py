@@ -0,0 +1,282 @@
+"""
+测试限流模块
+"""
+import pytest
+import asyncio
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from backend.utils.middleware import APIMiddleware
+from backend.utils.rate_limit import (
+    RateLimitRule,
+    RateLimiter,
+    MemoryRateLimitBackend,
+    SQLiteRateLimitBackend,
+    rate_limiter
+)
+
+
+class FakeClock:
+    """可手动推进的时钟"""
+    
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+    
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_scope(path: str = "/api/test", ip: str = "10.0.0.1", session: str = None):
+    """构造 ASGI 请求信息"""
+    headers = [(b"host", b"testserver")]
+    if session is not None:
+        headers.append((b"x-session-id", session.encode()))
+    return {"type": "http", "path": path, "headers": headers, "client": (ip, 50000)}
+
+
+@pytest.fixture
+def clock():
+    """测试时钟"""
+    return FakeClock()
+
+
+class TestRateLimiter:
+    """测试 GCRA 限流器"""
+    
+    def test_burst_then_limited(self, clock):
+        """测试额度用完后拒绝请求"""
+        limiter = RateLimiter([RateLimitRule("default", 5, 60)], clock=clock)
+        
+        results = [limiter.check(make_scope()) for _ in range(5)]
+        assert all(result.allowed for result in results)
+        assert [result.remaining for result in results] == [4, 3, 2, 1, 0]
+        
+        result = limiter.check(make_scope())
+        assert not result.allowed
+        assert result.rule == "default"
+        assert result.retry_after == pytest.approx(12.0)
+    
+    def test_refills_over_time(self, clock):
+        """测试额度按速率恢复"""
+        limiter = RateLimiter([RateLimitRule("default", 5, 60)], clock=clock)
+        for _ in range(5):
+            limiter.check(make_scope())
+        assert not limiter.check(make_scope()).allowed
+        
+        # 每 12 秒恢复一个请求
+        clock.now += 12
+        assert limiter.check(make_scope()).allowed
+        assert not limiter.check(make_scope()).allowed
+    
+    def test_clients_are_independent(self, clock):
+        """测试不同客户端的额度互不影响"""
+        limiter = RateLimiter([RateLimitRule("default", 1, 60)], clock=clock)
+        
+        assert limiter.check(make_scope(ip="10.0.0.1")).allowed
+        assert not limiter.check(make_scope(ip="10.0.0.1")).allowed
+        assert limiter.check(make_scope(ip="10.0.0.2")).allowed
+    
+    def test_route_rule(self, clock):
+        """测试路由专用的限额"""
+        limiter = RateLimiter([
+            RateLimitRule("generate", 2, 60, path_prefix="/api/test/generate"),
+            RateLimitRule("default", 100, 60),
+        ], clock=clock)
+        
+        assert limiter.check(make_scope("/api/test/generate")).allowed
+        assert limiter.check(make_scope("/api/test/generate")).allowed
+        result = limiter.check(make_scope("/api/test/generate"))
+        assert not result.allowed
+        assert result.rule == "generate"
+        
+        # 其他接口不受影响
+        assert limiter.check(make_scope("/api/stats")).allowed
+        assert limiter.limited == {"generate": 1, "default": 0}
+    
+    def test_session_rule(self, clock):
+        """测试按 IP + 会话限流，没有会话时按 IP"""
+        limiter = RateLimiter([RateLimitRule("generate", 1, 60, key_by="session")], clock=clock)
+        
+        assert limiter.check(make_scope(session="a")).allowed
+        assert not limiter.check(make_scope(session="a")).allowed
+        # 同一 IP 的另一个会话有自己的额度
+        assert limiter.check(make_scope(session="b")).allowed
+        assert limiter.check(make_scope()).allowed
+        assert not limiter.check(make_scope()).allowed
+        # 其他 IP 使用相同的会话 ID 不共享额度
+        assert limiter.check(make_scope(ip="10.0.0.2", session="a")).allowed
+    
+    def test_rotating_session_ids_hit_ip_budget(self, clock):
+        """测试每次更换会话 ID 也绕不过 IP 级的限额"""
+        limiter = RateLimiter([
+            RateLimitRule("generate_session", 1, 60, path_prefix="/api/test/generate", key_by="session"),
+            RateLimitRule("generate", 3, 60, path_prefix="/api/test/generate"),
+        ], clock=clock)
+        
+        results = [
+            limiter.check(make_scope("/api/test/generate", session=f"s{i}"))
+            for i in range(5)
+        ]
+        assert [result.allowed for result in results] == [True] * 3 + [False] * 2
+        assert results[-1].rule == "generate"
+    
+    def test_rejected_request_not_charged(self, clock):
+        """测试被某条规则拒绝时不消耗其他规则的额度"""
+        limiter = RateLimiter([
+            RateLimitRule("generate", 5, 60, path_prefix="/api/test/generate"),
+            RateLimitRule("default", 2, 60),
+        ], clock=clock)
+        
+        assert limiter.check(make_scope("/api/stats")).allowed
+        assert limiter.check(make_scope("/api/stats")).allowed
+        for _ in range(3):
+            result = limiter.check(make_scope("/api/test/generate"))
+            assert not result.allowed
+            assert result.rule == "default"
+        
+        # default 恢复后 generate 的额度仍是满的
+        clock.now += 60
+        results = [limiter.check(make_scope("/api/test/generate")) for _ in range(2)]
+        assert all(result.allowed for result in results)
+        assert results[0].rule == "default"
+        assert results[0].remaining == 1
+        assert limiter.backend._tats["generate:ip:10.0.0.1"] == pytest.approx(clock.now + 24)
+    
+    def test_sweep_removes_idle_keys(self, clock):
+        """测试清理额度已恢复的键"""
+        limiter = RateLimiter([RateLimitRule("default", 10, 10)], clock=clock)
+        for index in range(20):
+            limiter.check(make_scope(ip=f"10.0.0.{index}"))
+        assert len(limiter.backend) == 20
+        
+        assert limiter.sweep() == 0
+        clock.now += 1
+        assert limiter.sweep() == 20
+        assert len(limiter.backend) == 0
+    
+    @pytest.mark.asyncio
+    async def test_sweeper(self, clock):
+        """测试后台清理任务"""
+        limiter = RateLimiter([RateLimitRule("default", 10, 10)], sweep_interval=0.01, clock=clock)
+        limiter.check(make_scope())
+        clock.now += 10
+        
+        limiter.start_sweeper()
+        await asyncio.sleep(0.05)
+        await limiter.stop_sweeper()
+        
+        assert limiter.sweeps >= 1
+        assert len(limiter.backend) == 0
+    
+    def test_get_stats(self, clock):
+        """测试统计信息"""
+        limiter = RateLimiter([RateLimitRule("default", 1, 60)], clock=clock)
+        limiter.check(make_scope())
+        limiter.check(make_scope())
+        
+        stats = limiter.get_stats()
+        assert stats["backend"] == "MemoryRateLimitBackend"
+        assert stats["keys"] == 1
+        assert stats["allowed"] == 1
+        assert stats["limited"] == {"default": 1}
+    
+    def test_global_rate_limiter(self):
+        """测试全局限流器的规则"""
+        names = [rule.name for rule in rate_limiter.rules]
+        assert names == ["generate_session", "generate", "default"]
+
+
+class TestMemoryRateLimitBackend:
+    """测试内存后端"""
+    
+    def test_max_keys(self):
+        """测试超过最大键数时淘汰最久未使用的键"""
+        backend = MemoryRateLimitBackend(max_keys=3)
+        for key in ["a", "b", "c", "d"]:
+            backend.acquire([(key, 1.0, 10.0)], 0.0)
+        
+        assert len(backend) == 3
+        assert backend.evictions == 1
+        assert "a" not in backend._tats
+
+
+class TestSQLiteRateLimitBackend:
+    """测试 SQLite 后端"""
+    
+    def test_shared_between_workers(self, tmp_path, clock):
+        """测试多个后端实例共享同一个数据库时共用限额"""
+        path = tmp_path / "rate_limit.db"
+        rule = RateLimitRule("default", 3, 60)
+        worker1 = RateLimiter([rule], backend=SQLiteRateLimitBackend(path), clock=clock)
+        worker2 = RateLimiter([rule], backend=SQLiteRateLimitBackend(path), clock=clock)
+        
+        assert worker1.check(make_scope()).allowed
+        assert worker2.check(make_scope()).allowed
+        assert worker1.check(make_scope()).allowed
+        assert not worker2.check(make_scope()).allowed
+        
+        clock.now += 60
+        assert worker2.sweep() == 1
+        assert len(worker1.backend) == 0
+        
+        worker1.backend.close()
+        worker2.backend.close()
+    
+    @pytest.mark.asyncio
+    async def test_check_runs_off_event_loop(self, tmp_path, clock, monkeypatch):
+        """测试 SQLite 后端在线程池中检查，不阻塞事件循环"""
+        import threading
+        backend = SQLiteRateLimitBackend(tmp_path / "rate_limit.db")
+        limiter = RateLimiter([RateLimitRule("default", 3, 60)], backend=backend, clock=clock)
+        
+        threads = []
+        original = backend.acquire
+        
+        def acquire(limits, now):
+            threads.append(threading.current_thread())
+            return original(limits, now)
+        
+        monkeypatch.setattr(backend, "acquire", acquire)
+        assert (await limiter.check_async(make_scope())).allowed
+        assert threads and threads[0] is not threading.main_thread()
+        
+        # 内存后端直接在当前线程检查
+        memory = RateLimiter([RateLimitRule("default", 3, 60)], clock=clock)
+        assert (await memory.check_async(make_scope())).allowed
+        backend.close()
+    
+    def test_lazy_connection(self, tmp_path):
+        """测试首次使用时才创建数据库"""
+        path = tmp_path / "sub" / "rate_limit.db"
+        backend = SQLiteRateLimitBackend(path)
+        assert not path.exists()
+        
+        backend.acquire([("key", 1.0, 10.0)], 0.0)
+        assert path.exists()
+        backend.close()
+
+
+class TestRateLimitMiddleware:
+    """测试中间件使用限流器"""
+    
+    def test_retry_after_header(self, clock):
+        """测试被限流时返回 Retry-After"""
+        limiter = RateLimiter([RateLimitRule("default", 2, 60)], clock=clock)
+        app = FastAPI()
+        app.add_middleware(APIMiddleware, limiter=limiter)
+        
+        @app.get("/test")
+        async def test_endpoint():
+            return {"message": "ok"}
+        
+        client = TestClient(app)
+        assert client.get("/test").status_code == 200
+        assert client.get("/test").status_code == 200
+        
+        response = client.get("/test")
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "30"
+        assert response.json()["rule"] == "default"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
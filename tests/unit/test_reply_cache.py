@@ -0,0 +1,84 @@
+"""
+测试回复缓存模块
+"""
+import pytest
+import time
+from backend.core.reply_cache import ReplyCache
+
+
+class TestReplyCache:
+    """测试 ReplyCache 类"""
+    
+    def test_exact_hit_after_normalization(self):
+        """测试标点和空白不同的问题精确命中"""
+        cache = ReplyCache()
+        cache.set("老师这个再讲一遍可以吗？", "好的，我们再看一遍")
+        
+        assert cache.get("老师， 这个再讲一遍可以吗") == "好的，我们再看一遍"
+        assert cache.exact_hits == 1
+    
+    def test_near_duplicate_hit(self):
+        """测试近似问题命中"""
+        cache = ReplyCache(similarity_threshold=0.8)
+        cache.set("老师这个再讲一遍可以吗", "好的，我们再看一遍")
+        
+        assert cache.get("这个再讲一遍可以吗") == "好的，我们再看一遍"
+        assert cache.near_hits == 1
+    
+    def test_different_question_miss(self):
+        """测试意思不同的问题不命中"""
+        cache = ReplyCache()
+        cache.set("这个为什么是对的", "因为……")
+        
+        assert cache.get("这个为什么是错的") is None
+        assert cache.misses == 1
+    
+    def test_fingerprint_isolation(self):
+        """测试不同上下文指纹之间互不命中"""
+        cache = ReplyCache()
+        cache.set("老师这个再讲一遍可以吗", "回复一", fingerprint="a")
+        
+        assert cache.get("老师这个再讲一遍可以吗", fingerprint="b") is None
+        assert cache.get("老师这个再讲一遍可以吗", fingerprint="a") == "回复一"
+    
+    def test_ttl_expire(self):
+        """测试过期条目不返回并被移除"""
+        cache = ReplyCache(ttl=0.01)
+        cache.set("什么是变量", "变量是……")
+        
+        time.sleep(0.02)
+        assert cache.get("什么是变量") is None
+        assert cache.get_stats()["size"] == 0
+    
+    def test_lru_eviction(self):
+        """测试超过容量时淘汰最久未使用的条目"""
+        cache = ReplyCache(max_size=2)
+        cache.set("什么是变量", "1")
+        cache.set("什么是函数", "2")
+        cache.get("什么是变量")
+        cache.set("什么是循环", "3")
+        
+        assert cache.get("什么是函数") is None
+        assert cache.get("什么是变量") == "1"
+        assert cache.get("什么是循环") == "3"
+    
+    def test_stats(self):
+        """测试统计信息"""
+        cache = ReplyCache()
+        cache.set("什么是变量", "变量是……")
+        cache.get("什么是变量")
+        cache.get("什么是函数")
+        
+        stats = cache.get_stats()
+        assert stats["size"] == 1
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["hit_rate"] == 0.5
+        
+        cache.clear()
+        assert cache.get_stats()["total_requests"] == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
+
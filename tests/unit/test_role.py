@@ -3,7 +3,7 @@
 """
 import pytest
 import numpy as np
-from backend.core.role import Role, RoleIdentifier, VoiceFeature
+from backend.core.role import Role, RoleIdentifier, VoiceFeature, VoiceEmbedder, TextRoleClassifier
 
 
 class TestVoiceFeature:
@@ -29,6 +29,53 @@ class TestVoiceFeature:
         distance = f1.distance(f2)
         assert distance > 0
         assert distance < 20  # 应该是一个合理的值
+    
+    def test_distance_with_embedding(self):
+        """测试带嵌入向量时使用余弦距离"""
+        e1 = np.array([1.0, 0.0], dtype=np.float32)
+        e2 = np.array([0.0, 1.0], dtype=np.float32)
+        f1 = VoiceFeature(100.0, 0.5, 1.0, embedding=e1)
+        f2 = VoiceFeature(100.0, 0.5, 1.0, embedding=e2)
+        
+        assert f1.distance(f1) == pytest.approx(0.0)
+        assert f1.distance(f2) == pytest.approx(1.0)
+
+
+def make_voice(freq: float, seconds: float = 1.0) -> np.ndarray:
+    """生成带谐波的测试音频"""
+    t = np.arange(int(16000 * seconds)) / 16000
+    signal = sum(np.sin(2 * np.pi * freq * k * t) / k for k in range(1, 6))
+    return (signal * 6000).astype(np.int16)
+
+
+class TestVoiceEmbedder:
+    """测试 VoiceEmbedder 类"""
+    
+    def test_frame_is_strided_view(self):
+        """测试分帧形状"""
+        embedder = VoiceEmbedder()
+        audio = np.zeros(16000, dtype=np.int16)
+        
+        frames = embedder.frame(audio)
+        assert frames.shape == (98, 400)
+        assert not frames.flags.owndata
+    
+    def test_frame_short_audio(self):
+        """测试短于一帧的音频"""
+        embedder = VoiceEmbedder()
+        frames = embedder.frame(np.ones(100, dtype=np.int16))
+        assert frames.shape == (1, 400)
+    
+    def test_embed_fixed_length(self):
+        """测试嵌入向量定长且归一化"""
+        embedder = VoiceEmbedder()
+        
+        for seconds in (0.3, 1.0, 2.0):
+            frames = embedder.frame(make_voice(150, seconds)).astype(np.float32) / 32768.0
+            embedding = embedder.embed(frames)
+            assert embedding.dtype == np.float32
+            assert embedding.shape == (embedder.dim,)
+            assert np.linalg.norm(embedding) == pytest.approx(1.0, abs=1e-5)
 
 
 class TestRoleIdentifier:
@@ -106,6 +153,28 @@ class TestRoleIdentifier:
         # 由于是完全相同的音频，应该能识别出来
         assert result == Role.TEACHER
     
+    def test_identify_by_voice_distinguishes_speakers(self):
+        """测试区分不同音色的说话人"""
+        identifier = RoleIdentifier()
+        identifier.register_role(Role.TEACHER, make_voice(120))
+        identifier.register_role(Role.STUDENT, make_voice(900))
+        
+        assert identifier.identify_by_voice(make_voice(125)) == Role.TEACHER
+        assert identifier.identify_by_voice(make_voice(880)) == Role.STUDENT
+    
+    def test_feature_matrix_contiguous(self):
+        """测试已注册特征保存在连续矩阵中"""
+        identifier = RoleIdentifier()
+        identifier.register_role(Role.TEACHER, make_voice(120))
+        identifier.register_role(Role.STUDENT, make_voice(900))
+        
+        assert identifier._feature_matrix.shape == (2, identifier.embedder.dim)
+        assert identifier._feature_matrix.flags.c_contiguous
+        
+        identifier.clear_role_features()
+        assert identifier._feature_matrix.shape[0] == 0
+        assert identifier.identify_by_voice(make_voice(120)) is None
+    
     def test_clear_role_features_single(self):
         """测试清除单个角色特征"""
         identifier = RoleIdentifier()
@@ -152,6 +221,91 @@ class TestRoleIdentifier:
         
         role = await identifier.identify_by_content(text)
         assert role in [Role.STUDENT, Role.UNKNOWN]
+    
+    @pytest.mark.asyncio
+    async def test_identify_fast_path_skips_llm(self):
+        """测试明显的发言由本地分类器判断，不调用大模型"""
+        identifier = RoleIdentifier()
+        
+        async def fail(*args, **kwargs):
+            raise AssertionError("不应调用大模型")
+        identifier.identify_by_content = fail
+        
+        role = await identifier.identify("老师，我不太明白这个变量是什么意思，能再解释一下吗？")
+        assert role == Role.STUDENT
+        assert identifier.fast_path_count == 1
+        assert identifier.llm_count == 0
+    
+    @pytest.mark.asyncio
+    async def test_identify_ambiguous_escalates(self):
+        """测试难以判断的发言交给大模型"""
+        identifier = RoleIdentifier()
+        calls = []
+        
+        async def fake_content(text, context=None):
+            calls.append(text)
+            return Role.TEACHER
+        identifier.identify_by_content = fake_content
+        
+        role = await identifier.identify("同学们，这个知道吗？")
+        assert role == Role.TEACHER
+        assert calls == ["同学们，这个知道吗？"]
+        assert identifier.llm_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_identify_by_content_cached(self, monkeypatch):
+        """测试相同内容的大模型识别结果复用，同时到达的请求只调用一次"""
+        import asyncio
+        from backend.core import role as role_module
+        calls = []
+        
+        class FakeService:
+            async def simple_chat(self, prompt, **kwargs):
+                calls.append(prompt)
+                await asyncio.sleep(0.01)
+                return "teacher"
+        
+        monkeypatch.setattr(role_module, "openai_service", FakeService())
+        identifier = RoleIdentifier()
+        text = "这个缓存测试专用的句子只出现一次"
+        
+        roles = await asyncio.gather(
+            identifier.identify_by_content(text),
+            identifier.identify_by_content(text)
+        )
+        assert roles == [Role.TEACHER, Role.TEACHER]
+        assert await identifier.identify_by_content(text) == Role.TEACHER
+        assert len(calls) == 1
+
+
+class TestTextRoleClassifier:
+    """测试 TextRoleClassifier 类"""
+    
+    def test_classify_teacher(self):
+        """测试识别典型的教师发言"""
+        classifier = TextRoleClassifier()
+        role, confidence = classifier.classify("今天我们来学习 Python 的基础语法，首先是变量的定义。")
+        assert role == Role.TEACHER
+        assert confidence >= classifier.threshold
+    
+    def test_classify_student(self):
+        """测试识别典型的学生提问"""
+        classifier = TextRoleClassifier()
+        role, confidence = classifier.classify("老师这个再讲一遍可以吗？")
+        assert role == Role.STUDENT
+        assert confidence >= classifier.threshold
+    
+    def test_classify_ambiguous(self):
+        """测试缺少线索时不做判断"""
+        classifier = TextRoleClassifier()
+        assert classifier.classify("好的")[0] is None
+        assert classifier.classify("同学们，这个知道吗？")[0] is None
+    
+    def test_threshold(self):
+        """测试阈值控制判断范围"""
+        text = "这个怎么算"
+        assert TextRoleClassifier(threshold=0.95).classify(text)[0] is None
+        assert TextRoleClassifier(threshold=0.7).classify(text)[0] == Role.STUDENT
 
 
 if __name__ == "__main__":
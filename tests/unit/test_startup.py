@@ -0,0 +1,106 @@
+"""
+测试启动优化模块
+"""
+import pytest
+import asyncio
+from backend.utils.startup import WarmUp, parse_import_times, format_import_report
+
+
+class TestWarmUp:
+    """测试 WarmUp 类"""
+    
+    @pytest.mark.asyncio
+    async def test_run_steps(self):
+        """测试依次执行预热函数并记录耗时"""
+        warm_up = WarmUp()
+        calls = []
+        warm_up.register("a", lambda: calls.append("a"))
+        warm_up.register("b", lambda: calls.append("b"))
+        
+        assert warm_up.get_stats()["pending"] == ["a", "b"]
+        
+        await warm_up.start()
+        
+        assert calls == ["a", "b"]
+        stats = warm_up.get_stats()
+        assert stats["done"]
+        assert stats["pending"] == []
+        assert set(stats["durations"]) == {"a", "b"}
+    
+    @pytest.mark.asyncio
+    async def test_error_does_not_stop_others(self):
+        """测试单个预热失败不影响其他资源"""
+        warm_up = WarmUp()
+        calls = []
+        
+        def broken():
+            raise RuntimeError("boom")
+        
+        warm_up.register("broken", broken)
+        warm_up.register("ok", lambda: calls.append("ok"))
+        
+        await warm_up.start()
+        
+        assert calls == ["ok"]
+        assert warm_up.errors == {"broken": "boom"}
+        assert "ok" in warm_up.durations
+    
+    @pytest.mark.asyncio
+    async def test_stop_cancels_pending(self):
+        """测试关闭时取消未完成的预热"""
+        warm_up = WarmUp()
+        warm_up.register("slow", lambda: __import__("time").sleep(0.2))
+        warm_up.register("never", lambda: None)
+        
+        warm_up.start()
+        await asyncio.sleep(0.01)
+        await warm_up.stop()
+        
+        assert warm_up.done
+        assert "never" not in warm_up.durations
+    
+    @pytest.mark.asyncio
+    async def test_start_once(self):
+        """测试重复启动只执行一次"""
+        warm_up = WarmUp()
+        calls = []
+        warm_up.register("a", lambda: calls.append("a"))
+        
+        task = warm_up.start()
+        assert warm_up.start() is task
+        await task
+        assert calls == ["a"]
+
+
+class TestImportProfile:
+    """测试导入耗时分析"""
+    
+    def test_parse_import_times(self):
+        """测试解析 -X importtime 输出"""
+        output = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       120 |        120 |     encodings.utf_8",
+            "import time:      2000 |       2500 |   tiktoken",
+            "import time:       500 |       3000 | backend.utils.token",
+            "其他输出",
+        ])
+        
+        records = parse_import_times(output)
+        
+        assert [r["module"] for r in records] == ["encodings.utf_8", "tiktoken", "backend.utils.token"]
+        assert records[1]["self_ms"] == 2.0
+        assert records[2]["cumulative_ms"] == 3.0
+        assert [r["depth"] for r in records] == [2, 1, 0]
+    
+    def test_format_report(self):
+        """测试生成报告"""
+        records = [{"module": "tiktoken", "self_ms": 2.0, "cumulative_ms": 2.5, "depth": 1}]
+        report = format_import_report("backend.main", records, 3.0)
+        
+        assert "backend.main" in report
+        assert "tiktoken" in report
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
+
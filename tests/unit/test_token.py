@@ -13,6 +13,19 @@ class TestTokenCounter:
         counter = TokenCounter()
         assert counter.encoding is not None
     
+    def test_encoding_loaded_lazily(self):
+        """测试编码器首次使用时才加载"""
+        counter = TokenCounter()
+        assert not counter.loaded
+        
+        counter.estimate_tokens("你好")
+        counter.count_text("你好", exact=False)
+        assert not counter.loaded
+        
+        counter.warm_up()
+        assert counter.loaded
+        assert counter.get_stats()["loaded"]
+    
     def test_count_text_empty(self):
         """测试空文本"""
         counter = TokenCounter()
@@ -88,6 +101,78 @@ class TestTokenCounter:
         # 估算值应该在实际值的 50%-150% 范围内
         assert 0.5 * actual <= estimated <= 1.5 * actual
     
+    def test_count_text_memoized(self):
+        """测试相同文本重复计数命中缓存"""
+        counter = TokenCounter()
+        first = counter.count_text("你好，世界！")
+        second = counter.count_text("你好，世界！")
+        
+        assert first == second
+        assert counter.get_stats()["hits"] == 1
+        assert counter.get_stats()["misses"] == 1
+    
+    def test_memo_lru_limit(self):
+        """测试计数缓存不超过容量"""
+        counter = TokenCounter(cache_size=2)
+        for text in ["a", "b", "c"]:
+            counter.count_text(text)
+        
+        assert counter.get_stats()["size"] == 2
+        counter.count_text("a")
+        assert counter.get_stats()["misses"] == 4
+    
+    def test_count_batch(self):
+        """测试批量计数与逐条计数一致"""
+        counter = TokenCounter()
+        texts = ["Hello, world!", "", "你好，世界！", "Hello, world!"]
+        
+        expected = [TokenCounter().count_text(text) for text in texts]
+        assert counter.count_batch(texts) == expected
+        assert counter.get_stats()["misses"] == 2
+        
+        counter.count_batch(texts)
+        assert counter.get_stats()["misses"] == 2
+    
+    def test_small_batch_skips_thread_pool(self, monkeypatch):
+        """测试少量短文本逐条编码，不创建线程池"""
+        counter = TokenCounter()
+        
+        def fail(*args, **kwargs):
+            raise AssertionError("小批量不应调用 encode_batch")
+        
+        monkeypatch.setattr(counter.encoding, "encode_batch", fail)
+        messages = [{"role": "user", "content": f"问题 {i}"} for i in range(5)]
+        assert counter.count_messages(messages) > 0
+    
+    def test_large_batch_uses_thread_pool(self):
+        """测试未缓存文本较多时多线程编码，结果与逐条一致"""
+        counter = TokenCounter(batch_min_chars=10)
+        texts = [f"Hello, world {i}!" for i in range(5)]
+        
+        expected = [TokenCounter().count_text(text) for text in texts]
+        assert counter.count_batch(texts) == expected
+    
+    def test_count_messages_with_name(self):
+        """测试 name 字段少计 1 个 token"""
+        counter = TokenCounter()
+        messages = [{"role": "user", "content": "Hello"}]
+        named = [{"role": "user", "content": "Hello", "name": "a"}]
+        
+        assert counter.count_messages(named) == counter.count_messages(messages) + counter.count_text("a") - 1
+    
+    def test_inexact_uses_estimate(self):
+        """测试关闭精确计数时使用估算"""
+        counter = TokenCounter(exact=False)
+        text = "这是一个 test 句子 with mixed content。"
+        
+        assert counter.count_text(text) == counter.estimate_tokens(text)
+        assert counter.count_text(text, exact=True) == TokenCounter().count_text(text)
+        assert counter.count_batch([text, ""]) == [counter.estimate_tokens(text), 0]
+    
+    def test_estimate_tokens_empty(self):
+        """测试空文本估算"""
+        assert TokenCounter().estimate_tokens("") == 0
+    
     def test_global_instance(self):
         """测试全局实例"""
         assert token_counter is not None
@@ -0,0 +1,96 @@
+"""
+测试延迟追踪模块
+"""
+import pytest
+import asyncio
+from backend.utils.metrics import MetricsCollector
+from backend.utils.tracing import UtteranceTrace, current_trace, mark_stage, discard_stages, REPLY_STAGES
+
+
+class TestUtteranceTrace:
+    """测试 UtteranceTrace 类"""
+    
+    def test_mark_first_only(self):
+        """测试同一阶段只记录第一次"""
+        trace = UtteranceTrace(start=0.0)
+        trace.mark("asr_partial", 1.0)
+        trace.mark("asr_partial", 2.0)
+        
+        assert trace.marks["asr_partial"] == 1.0
+    
+    def test_breakdown_in_time_order(self):
+        """测试按时间先后计算各阶段耗时"""
+        trace = UtteranceTrace(start=0.0)
+        trace.mark("audio_received", 0.0)
+        trace.mark("asr_final", 1.0)
+        trace.mark("context_built", 1.2)  # 推测生成先于角色识别完成
+        trace.mark("role_identified", 1.5)
+        trace.mark("reply_sent", 3.0)
+        
+        assert trace.breakdown() == pytest.approx({
+            "audio_received": 0.0,
+            "asr_final": 1.0,
+            "context_built": 0.2,
+            "role_identified": 0.3,
+            "reply_sent": 1.5
+        })
+        assert trace.total() == 3.0
+        assert trace.elapsed("asr_final", "reply_sent") == 2.0
+        assert trace.elapsed("asr_final", "llm_first_token") is None
+    
+    def test_finish_records_histograms(self):
+        """测试结束时写入直方图且只写一次"""
+        collector = MetricsCollector()
+        trace = UtteranceTrace("ws-1", start=0.0)
+        trace.mark("asr_final", 0.5)
+        trace.mark("reply_sent", 2.0)
+        
+        report = trace.finish(collector)
+        trace.finish(collector)
+        
+        assert report["stages"] == {"asr_final": 500.0, "reply_sent": 2000.0}
+        assert report["breakdown"] == {"asr_final": 500.0, "reply_sent": 1500.0}
+        assert report["total_ms"] == 2000.0
+        assert collector.snapshot("pipeline.stage", tags={"stage": "reply_sent", "session": "ws-1"}).count == 1
+        assert collector.get_stats("pipeline.total")["count"] == 1
+    
+    def test_discard(self):
+        """测试删除被放弃的阶段"""
+        trace = UtteranceTrace(start=0.0)
+        trace.mark("context_built", 1.0)
+        trace.mark("role_identified", 1.0)
+        trace.discard(REPLY_STAGES)
+        
+        assert list(trace.marks) == ["role_identified"]
+
+
+class TestCurrentTrace:
+    """测试通过上下文传递追踪"""
+    
+    def test_mark_without_trace(self):
+        """测试没有追踪时忽略"""
+        mark_stage("context_built")
+        discard_stages(REPLY_STAGES)
+    
+    @pytest.mark.asyncio
+    async def test_propagates_to_tasks(self):
+        """测试追踪随任务传递"""
+        trace = UtteranceTrace()
+        token = current_trace.set(trace)
+        
+        async def generate():
+            mark_stage("context_built")
+            await asyncio.sleep(0)
+            mark_stage("llm_first_token")
+        
+        try:
+            await asyncio.create_task(generate())
+        finally:
+            current_trace.reset(token)
+        
+        assert set(trace.marks) == {"context_built", "llm_first_token"}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
+